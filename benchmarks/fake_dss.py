@@ -0,0 +1,412 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+"""
+Synthetic stand-in for the DSS public API client, used to benchmark the macros
+without a live DSS instance.
+
+The instance is generated from its sizes (projects x datasets x columns x ML
+tasks), every call counts towards its endpoint, sleeps for the configured
+latency and fails with a transient error at the configured rate.
+"""
+import io
+import json
+import random
+import threading
+import time
+
+GDPR_VALUES = ["YES", "NO", "UNSURE"]
+BASE_TIMESTAMP_MS = 1600000000000
+
+
+class FakeInstanceSpec(object):
+    def __init__(self, projects=10, datasets=20, columns=10, ml_tasks=2, trained_models=3, saved_models=1, latency=0.0,
+                 error_rate=0.0):
+        self.projects = projects
+        self.datasets = datasets
+        self.columns = columns
+        self.ml_tasks = ml_tasks
+        self.trained_models = trained_models
+        self.saved_models = saved_models
+        self.latency = latency
+        self.error_rate = error_rate
+
+
+def _copy_payload(payload):
+    # a deep copy, like a payload decoded from an API response
+    return json.loads(json.dumps(payload))
+
+
+class _Raw(object):
+    def __init__(self, raw):
+        self.raw = raw
+        self.settings = raw
+        self.details = raw
+
+    def get_raw(self):
+        return self.raw
+
+
+class FakeComputedMetrics(object):
+    def __init__(self, raw):
+        self.raw = raw
+
+    def get_all_ids(self):
+        return [metric["metric"]["id"] for metric in self.raw["metrics"]]
+
+    def get_metric_by_id(self, metric_id):
+        for metric in self.raw["metrics"]:
+            if metric["metric"]["id"] == metric_id:
+                return metric
+        return None
+
+
+class FakeTrainedModelDetails(object):
+    def __init__(self, start_time):
+        self.start_time = start_time
+
+    def get_train_info(self):
+        return {"startTime": self.start_time}
+
+
+class FakeDataset(object):
+    def __init__(self, project, name):
+        self.project = project
+        self.name = name
+
+    def get_definition(self):
+        return self.project.client.call("get_definition", lambda: _copy_payload(self.project.datasets[self.name]))
+
+    def get_metadata(self):
+        return self.project.client.call("get_metadata", lambda: {"description": "Dataset " + self.name, "tags": []})
+
+    def get_last_metric_values(self):
+        index = self.project.dataset_index(self.name)
+
+        def build():
+            values = [{"value": "2023-01-%02dT10:00:00.000Z" % (1 + (index + i) % 28)} for i in range(3)]
+            return FakeComputedMetrics({"metrics": [{"metric": {"id": "reporting:BUILD_START_DATE"}, "lastValues": values}]})
+        return self.project.client.call("get_last_metric_values", build)
+
+    def get_usages(self):
+        index = self.project.dataset_index(self.name)
+        return self.project.client.call("get_usages", lambda: [{"type": "RECIPE_OUTPUT"}] if index % 2 == 1 else [{"type": "RECIPE_INPUT"}])
+
+    def list_partitions(self):
+        partitioned = "partitioning" in self.project.datasets[self.name]
+        return self.project.client.call("list_partitions", lambda: ["2023-01-%02d" % (1 + day) for day in range(28)] if partitioned else [])
+
+
+class FakeMLTask(object):
+    def __init__(self, project, analysis_id, ml_task_id):
+        self.project = project
+        self.analysis_id = analysis_id
+        self.ml_task_id = ml_task_id
+
+    def get_settings(self):
+        columns = self.project.client.spec.columns
+        per_feature = dict(("col_%d" % i, {"role": "TARGET" if i == 1 else ("REJECT" if i % 3 == 2 else "INPUT")}) for i in range(columns))
+        return self.project.client.call("get_ml_task_settings", lambda: _Raw({
+            "taskType": "PREDICTION",
+            "predictionType": "BINARY_CLASSIFICATION",
+            "preprocessing": {"per_feature": per_feature}
+        }))
+
+    def get_trained_models_ids(self):
+        spec = self.project.client.spec
+        return self.project.client.call("get_trained_models_ids", lambda: [
+            "A-%s-%s-%s-s1-pp1-m%d" % (self.project.key, self.analysis_id, self.ml_task_id, i) for i in range(spec.trained_models)])
+
+    def get_trained_model_snippet(self, id=None, ids=None):
+        # like dataikuapi: the snippet of one model with id, otherwise the snippets
+        # of the given models, or of all of them, by model id
+        spec = self.project.client.spec
+
+        def build():
+            snippets = dict((
+                "A-%s-%s-%s-s1-pp1-m%d" % (self.project.key, self.analysis_id, self.ml_task_id, i),
+                {"trainInfo": {"state": "DONE", "startTime": BASE_TIMESTAMP_MS + i * 1000}}) for i in range(spec.trained_models))
+            if id is not None:
+                return snippets[id]
+            if ids is not None and len(ids) > 0:
+                return dict((model_id, snippets[model_id]) for model_id in ids)
+            return snippets
+        return self.project.client.call("get_trained_model_snippet", build)
+
+    def get_trained_model_details(self, trained_model_id):
+        index = int(trained_model_id.split("-m")[-1])
+        return self.project.client.call("get_trained_model_details", lambda: FakeTrainedModelDetails(BASE_TIMESTAMP_MS + index * 1000))
+
+
+class FakeAnalysis(object):
+    def __init__(self, project, analysis_id):
+        self.project = project
+        self.analysis_id = analysis_id
+
+    def get_definition(self):
+        return self.project.client.call("get_analysis_definition", lambda: _Raw({
+            "id": self.analysis_id,
+            "name": "Analysis " + self.analysis_id,
+            "inputDatasetSmartName": "ds_0",
+            "creationTag": {"lastModifiedOn": BASE_TIMESTAMP_MS}
+        }))
+
+    def list_ml_tasks(self):
+        return self.project.client.call("list_analysis_ml_tasks", lambda: {"mlTasks": [
+            ml_task for ml_task in self.project.ml_tasks if ml_task["analysisId"] == self.analysis_id]})
+
+
+class FakeSavedModel(object):
+    def __init__(self, project, saved_model_id):
+        self.project = project
+        self.saved_model_id = saved_model_id
+
+    def get_active_version(self):
+        return self.project.client.call("get_active_version", lambda: {"id": "v1", "trainDate": BASE_TIMESTAMP_MS, "active": True})
+
+    def list_versions(self):
+        return self.project.client.call("list_versions", lambda: [{"id": "v1", "trainDate": BASE_TIMESTAMP_MS, "active": True}])
+
+    def get_version_details(self, version_id):
+        return self.project.client.call("get_version_details", lambda: _Raw({
+            "coreParams": {"prediction_type": "BINARY_CLASSIFICATION"},
+            "preprocessing": {"per_feature": {"col_0": {"role": "INPUT"}, "col_1": {"role": "TARGET"}}},
+            "smOrigin": {"fullModelId": "A-%s-an0-t0-s1-pp1-m0" % self.project.key}
+        }))
+
+
+class FakeProject(object):
+    def __init__(self, client, key, index):
+        self.client = client
+        self.key = key
+        self.index = index
+        spec = client.spec
+        self.datasets = {}
+        self._dataset_indices = {}
+        for i in range(spec.datasets):
+            name = "ds_%d" % i
+            self._dataset_indices[name] = i
+            self.datasets[name] = {
+                "projectKey": key,
+                "name": name,
+                "type": "PostgreSQL",
+                "params": {"connection": "conn_%d" % (i % 3)},
+                "schema": {"columns": [{
+                    "name": "col_%d" % j,
+                    "type": "string" if j % 2 == 0 else "bigint",
+                    "meaning": "Email" if j == 0 else ""
+                } for j in range(spec.columns)]},
+                "customFields": {"gdpr_contains_personal_data": GDPR_VALUES[i % 3], "gdpr_retention_policy": "1 year"},
+                "creationTag": {"lastModifiedOn": BASE_TIMESTAMP_MS},
+                "versionTag": {"lastModifiedOn": BASE_TIMESTAMP_MS, "versionNumber": 1}
+            }
+            if i % 5 == 0:
+                self.datasets[name]["partitioning"] = {"dimensions": [{"name": "day", "type": "time", "params": {"period": "DAY"}}]}
+        self.ml_tasks = [{
+            "analysisId": "an%d" % (i // 2),
+            "mlTaskId": "t%d" % i,
+            "inputDataset": "ds_%d" % (i % max(1, spec.datasets)) if i % 2 == 0 or index == 0 else "%s.ds_0" % client.project_keys[0],
+            "creationTag": {"lastModifiedOn": BASE_TIMESTAMP_MS},
+            "versionTag": {"lastModifiedOn": BASE_TIMESTAMP_MS, "versionNumber": 1}
+        } for i in range(spec.ml_tasks)]
+
+    def dataset_index(self, name):
+        return self._dataset_indices[name]
+
+    def get_metadata(self):
+        return self.client.call("get_project_metadata", lambda: {
+            "label": "Project " + self.key,
+            "tags": ["bu_%d" % (self.index % 4)],
+            "customFields": {"gdpr_forbid_dataset_sharing": self.index % 2 == 0, "gdpr_forbidden_connections": ["conn_2"]}
+        })
+
+    def get_permissions(self):
+        return self.client.call("get_permissions", lambda: {"permissions": [
+            {"group": "readers", "readProjectContent": True},
+            {"group": "writers", "writeProjectContent": True}
+        ]})
+
+    def get_settings(self):
+        return self.client.call("get_project_settings", lambda: _Raw({"exposedObjects": {"objects": [
+            {"type": "DATASET", "localName": "ds_0", "rules": [{"targetProject": key}]}
+            for key in self.client.project_keys[self.index + 1:self.index + 2]
+        ]}}))
+
+    def list_datasets(self):
+        return self.client.call("list_datasets", lambda: [_copy_payload(dataset) for dataset in self.datasets.values()])
+
+    def get_dataset(self, name):
+        return FakeDataset(self, name)
+
+    def list_recipes(self):
+        return self.client.call("list_recipes", lambda: [{
+            "name": "compute_ds_%d" % i,
+            "inputs": {"main": {"items": [{"ref": "ds_%d" % (i - 1)}]}},
+            "outputs": {"main": {"items": [{"ref": "ds_%d" % i}]}},
+            "versionTag": {"lastModifiedOn": BASE_TIMESTAMP_MS, "versionNumber": 1}
+        } for i in range(1, len(self.datasets), 2)])
+
+    def list_ml_tasks(self):
+        return self.client.call("list_ml_tasks", lambda: {"mlTasks": [dict(ml_task) for ml_task in self.ml_tasks]})
+
+    def list_analyses(self):
+        return self.client.call("list_analyses", lambda: [{
+            "analysisId": analysis_id,
+            "creationTag": {"lastModifiedOn": BASE_TIMESTAMP_MS},
+            "versionTag": {"lastModifiedOn": BASE_TIMESTAMP_MS, "versionNumber": 1}
+        } for analysis_id in sorted(set(ml_task["analysisId"] for ml_task in self.ml_tasks))])
+
+    def get_analysis(self, analysis_id):
+        return FakeAnalysis(self, analysis_id)
+
+    def get_ml_task(self, analysis_id, ml_task_id):
+        return FakeMLTask(self, analysis_id, ml_task_id)
+
+    def list_saved_models(self):
+        return self.client.call("list_saved_models", lambda: [
+            {"id": "sm%d" % i, "name": "Model %d" % i, "type": "PREDICTION",
+             "versionTag": {"lastModifiedOn": BASE_TIMESTAMP_MS, "versionNumber": 1}} for i in range(self.client.spec.saved_models)])
+
+    def get_saved_model(self, saved_model_id):
+        return FakeSavedModel(self, saved_model_id)
+
+
+class FakeProjectFolder(object):
+    def __init__(self, client, name, project_keys, children):
+        self.client = client
+        self.name = name
+        self.project_keys = project_keys
+        self.children = children
+
+    def get_name(self):
+        return self.name
+
+    def list_child_folders(self):
+        return self.client.call("list_child_folders", lambda: list(self.children))
+
+    def list_project_keys(self):
+        return self.client.call("list_project_keys", lambda: list(self.project_keys))
+
+
+class FakeDSSClient(object):
+    def __init__(self, spec):
+        self.spec = spec
+        self.call_counts = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self.project_keys = ["PRJ_%04d" % i for i in range(spec.projects)]
+        self.projects = dict((key, FakeProject(self, key, i)) for i, key in enumerate(self.project_keys))
+
+    def call(self, endpoint, build):
+        with self._lock:
+            self.call_counts[endpoint] = self.call_counts.get(endpoint, 0) + 1
+        if self.spec.latency > 0:
+            time.sleep(self.spec.latency)
+        if self.spec.error_rate > 0 and self._random.random() < self.spec.error_rate:
+            raise Exception("HTTP 503: Service Unavailable on " + endpoint)
+        return build()
+
+    def reset_counts(self):
+        with self._lock:
+            self.call_counts = {}
+
+    def list_projects(self):
+        return self.call("list_projects", lambda: [{"projectKey": key, "name": "Project " + key, "tags": ["bu_%d" % (i % 4)]}
+                                                   for i, key in enumerate(self.project_keys)])
+
+    def get_root_project_folder(self):
+        # one folder per business unit, like the project tags
+        children = [FakeProjectFolder(self, "bu_%d" % bu, self.project_keys[bu::4], []) for bu in range(min(4, len(self.project_keys)))]
+        return FakeProjectFolder(self, "", [], children)
+
+    def get_project(self, project_key):
+        # handles are free, like in dataikuapi
+        return self.projects[project_key]
+
+    def list_connections(self):
+        return self.call("list_connections", lambda: dict(("conn_%d" % i, {
+            "type": "PostgreSQL",
+            "params": {"host": "db%d.example.com" % i, "port": 5432},
+            "detailsReadability": {"readableBy": "ALLOWED", "allowedGroups": ["admins"]},
+            "usableBy": "ALL"
+        }) for i in range(3)))
+
+
+class FakeDataDataset(object):
+    """
+    Data of the synthetic datasets: emails in col_0, first names in col_2 and
+    opaque codes elsewhere, generated chunk by chunk
+    """
+    rows = 100000
+
+    def __init__(self, name, project_key=None):
+        self.name = name
+        self.project_key = project_key
+
+    def _get_value(self, column, row):
+        if column == "col_0":
+            return "user%d@example.com" % row
+        if column == "col_2":
+            return ["Mary", "John", "Sophie", "Ahmed"][row % 4] + " X."
+        return "code-%d-%s" % (row, column)
+
+    def iter_dataframes(self, chunksize=10000, infer_with_pandas=True, sampling="head", limit=None, columns=None, **kwargs):
+        import pandas
+        total = min(self.rows, limit) if limit is not None else self.rows
+        for start in range(0, total, chunksize):
+            rows = range(start, min(total, start + chunksize))
+            yield pandas.DataFrame(dict((column, [self._get_value(column, row) for row in rows]) for column in columns or []))
+
+
+class FakeFolderWriter(object):
+    def __init__(self, folder, path):
+        self.folder = folder
+        self.path = path
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def close(self):
+        self.folder.files[self.path] = self.size
+
+
+class FakeFolder(object):
+    """
+    Managed folder that only records the size of the files written to it, and
+    keeps the JSON documents in memory for the next runs
+    """
+    _stores = {}
+
+    def __init__(self, lookup, project_key=None):
+        self.lookup = lookup
+        store = FakeFolder._stores.setdefault((project_key, lookup), {"files": {}, "json": {}})
+        self.files = store["files"]
+        self.json = store["json"]
+
+    def get_writer(self, path):
+        return FakeFolderWriter(self, path)
+
+    def list_paths_in_partition(self, partition=""):
+        return ["/" + path for path in sorted(set(self.files.keys()) | set(self.json.keys()))]
+
+    def get_download_stream(self, path):
+        return io.BytesIO(b"")
+
+    def upload_file(self, path, local_path):
+        self.files[path] = 0
+
+    def upload_stream(self, path, stream):
+        self.files[path] = len(stream.read())
+
+    def read_json(self, path):
+        return json.loads(self.json[path])
+
+    def write_json(self, path, obj):
+        self.json[path] = json.dumps(obj)
+
+    def delete_path(self, path):
+        self.files.pop(path, None)
+        self.json.pop(path, None)
@@ -0,0 +1,132 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+"""
+Offline benchmark of the GDPR audit and datasets check up macros.
+
+Runs GDPRAuditRunnable.run and GDPRDSCheckUpRunnable.run against a synthetic
+instance served by benchmarks/fake_dss.py, and reports wall time, API calls per
+endpoint and peak Python memory. Example:
+
+    python benchmarks/run_benchmarks.py --projects 50 --datasets 40 --columns 20 --latency 0.005
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+import types
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "python-lib"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_dss import FakeDataDataset, FakeDSSClient, FakeFolder, FakeInstanceSpec
+
+MACROS = {
+    "audit": ("gdpr-audit", "GDPRAuditRunnable"),
+    "check-up": ("gdpr-ds-check-up", "GDPRDSCheckUpRunnable")
+}
+
+
+def install_dataiku(client):
+    """
+    Points dataiku.api_client() to the fake client. Outside of DSS, where the
+    dataiku package is not available, registers a minimal one instead.
+    """
+    try:
+        import dataiku
+    except ImportError:
+        dataiku = types.ModuleType("dataiku")
+        runnables = types.ModuleType("dataiku.runnables")
+
+        class Runnable(object):
+            pass
+        runnables.Runnable = Runnable
+        dataiku.runnables = runnables
+        sys.modules["dataiku"] = dataiku
+        sys.modules["dataiku.runnables"] = runnables
+    dataiku.api_client = lambda: client
+    dataiku.Folder = FakeFolder
+    dataiku.Dataset = FakeDataDataset
+    return dataiku
+
+
+def load_runnable_class(macro):
+    directory, class_name = MACROS[macro]
+    path = os.path.join(ROOT_DIR, "python-runnables", directory, "runnable.py")
+    spec = importlib.util.spec_from_file_location("bench_" + directory.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)
+
+
+def run_macro(macro, client, config):
+    runnable_class = load_runnable_class(macro)
+    client.reset_counts()
+    progress = []
+    tracemalloc.start()
+    start = time.time()
+    runnable = runnable_class(client.project_keys[0], config, {})
+    result = runnable.run(lambda value, *args: progress.append(value))
+    wall_time = time.time() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "macro": macro,
+        "wall_time_s": round(wall_time, 3),
+        "peak_memory_mb": round(peak_memory / (1024.0 * 1024.0), 2),
+        "result_size": len(result) if result is not None else 0,
+        "api_calls": sum(client.call_counts.values()),
+        "calls_per_endpoint": dict(sorted(client.call_counts.items()))
+    }
+
+
+def print_result(result):
+    print("== " + result["macro"])
+    print("wall time:      %.3f s" % result["wall_time_s"])
+    print("peak memory:    %.2f MB" % result["peak_memory_mb"])
+    print("result size:    %d chars" % result["result_size"])
+    print("API calls:      %d" % result["api_calls"])
+    for endpoint, count in result["calls_per_endpoint"].items():
+        print("  %-28s %d" % (endpoint, count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the GDPR macros on a synthetic DSS instance")
+    parser.add_argument("--projects", type=int, default=10)
+    parser.add_argument("--datasets", type=int, default=20, help="datasets per project")
+    parser.add_argument("--columns", type=int, default=10, help="columns per dataset")
+    parser.add_argument("--ml-tasks", type=int, default=2, help="ML tasks per project")
+    parser.add_argument("--trained-models", type=int, default=3, help="trained models per ML task")
+    parser.add_argument("--saved-models", type=int, default=1, help="saved models per project")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds slept by each API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the API calls failing with a transient error")
+    parser.add_argument("--macro", choices=sorted(MACROS.keys()) + ["all"], default="all")
+    parser.add_argument("--config", default="{}", help="JSON macro config, merged over allProjects=true")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    spec = FakeInstanceSpec(projects=args.projects, datasets=args.datasets, columns=args.columns, ml_tasks=args.ml_tasks,
+                            trained_models=args.trained_models, saved_models=args.saved_models, latency=args.latency,
+                            error_rate=args.error_rate)
+    client = FakeDSSClient(spec)
+    install_dataiku(client)
+    config = {"allProjects": True, "includeConnections": True}
+    config.update(json.loads(args.config))
+
+    macros = sorted(MACROS.keys()) if args.macro == "all" else [args.macro]
+    results = [run_macro(macro, client, config) for macro in macros]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print_result(result)
+
+
+if __name__ == "__main__":
+    main()
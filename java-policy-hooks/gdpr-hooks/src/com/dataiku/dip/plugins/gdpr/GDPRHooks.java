@@ -319,6 +319,7 @@ public class GDPRHooks extends CustomPolicyHooks {
             docCfs.add(new CustomFieldNameWithDefaultValue("gdpr_contains_personal_data", new JsonPrimitive("UNSURE")));
             docCfs.add(new CustomFieldNameWithDefaultValue("gdpr_purposes", null));
             docCfs.add(new CustomFieldNameWithDefaultValue("gdpr_retention_policy", null));
+            docCfs.add(new CustomFieldNameWithDefaultValue("gdpr_retention_days", null));
             docCfs.add(new CustomFieldNameWithDefaultValue("gdpr_legal_consent", null));
             CustomFieldsChangeRule docRule = new CustomFieldsChangeRule(pluginSettings, "gdpr_doc_groups", docCfs);
             handleCustomFieldsChange(user, before == null ? null : before.customFields, after == null ? null : after.customFields, docRule, mc);
@@ -0,0 +1,5 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
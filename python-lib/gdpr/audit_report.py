@@ -0,0 +1,481 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+from datetime import datetime
+
+from gdpr.records import format_feature
+
+# HTML rendering of the audit records, written part by part to an HTMLReportWriter
+
+
+def format_date(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp > 0 else ""
+
+
+def _write_lines(report, lines):
+    if len(lines) > 0:
+        report.write("<pre>", "\n".join(lines), "</pre>")
+
+
+def write_connections_section(report, connection_records):
+    # header
+    report.write("<h3>Connections</h3>")
+    report.write("<table><thead>",
+        "<tr>",
+        "<th rowspan=\"2\">Connection</th>",
+        "<th rowspan=\"2\">Type</th>",
+        "<th rowspan=\"2\">Host</th>",
+        "<th colspan=\"2\">DSS Groups</th>",
+        "<th rowspan=\"2\">Datasets with personal data</th>",
+        "</tr>",
+        "<tr>",
+        "<th>Read</th>",
+        "<th>Usage</th>",
+        "</tr>",
+        "</thead><tbody>")
+
+    for record in connection_records:
+        report.write("<tr>",
+            "<td>", record["connection"], "</td>",
+            "<td>", record["type"], "</td>",
+            "<td>", record["host"], "</td>",
+            "<td>")
+        if record["readable_by"] == "NONE":
+            report.write("NONE")
+        elif record["readable_by"] == "ALL":
+            report.write("ALL")
+        elif record["readable_by"] == "ALLOWED":
+            report.write("<pre>", "\n".join(record["read_groups"]), "</pre>")
+        report.write("</td>",
+            "<td>")
+        if record["usable_by"] == "ALL":
+            report.write("ALL")
+        elif record["usable_by"] == "ALLOWED":
+            report.write("<pre>", "\n".join(record["usage_groups"]), "</pre>")
+        report.write("</td>",
+            "<td>")
+        _write_lines(report, record["personal_data_datasets"])
+        report.write("</td>",
+            "</tr>")
+
+    report.write("</tbody></table>")
+
+
+def write_projects_header(report):
+    report.write("<h3>Projects</h3>")
+    report.write("<table><thead>",
+        "<tr>",
+        "<th rowspan=\"2\">Project</th>",
+        "<th colspan=\"2\">DSS groups</th>",
+        "<th colspan=\"5\">GDPR fields</th>",
+        "<th colspan=\"4\">Dataset counts</th>",
+        "<th colspan=\"2\">Model counts</th>",
+        "</tr>",
+        "<tr>",
+        "<th>Read</th>",
+        "<th>Write</th>",
+        "<th>Forbid DS sharing</th>",
+        "<th>Forbid DS export</th>",
+        "<th>Forbid model creation</th>",
+        "<th>Forbid uploaded datasets</th>",
+        "<th>Forbidden connections</th>",
+        "<th>Pers. data</th>",
+        "<th>Unsure</th>",
+        "<th>No pers. data</th>",
+        "<th>Total</th>",
+        "<th>Pers. data or unsure</th>",
+        "<th>Total</th>",
+        "</tr>",
+        "</thead><tbody>")
+
+
+def write_project_row(report, record):
+    report.write("<tr>",
+        "<td>", record["project_label"], " (", record["project_key"], ")", "</td>",
+        "<td>")
+    _write_lines(report, record["read_groups"])
+    report.write("</td>",
+        "<td>")
+    _write_lines(report, record["write_groups"])
+    report.write("</td>",
+        "<td>", str(record["forbid_dataset_sharing"]), "</td>",
+        "<td>", str(record["forbid_dataset_export"]), "</td>",
+        "<td>", str(record["forbid_model_creation"]), "</td>",
+        "<td>", str(record["forbid_uploaded_datasets"]), "</td>",
+        "<td>")
+    _write_lines(report, record["forbidden_connections"])
+    report.write("</td>",
+        "<td>", str(record["datasets_personal_data"]), "</td>",
+        "<td>", str(record["datasets_unsure"]), "</td>",
+        "<td>", str(record["datasets_no_personal_data"]), "</td>",
+        "<td>", str(record["datasets_total"]), "</td>",
+        "<td>", str(record["ml_tasks_personal_data"]), "</td>",
+        "<td>", str(record["ml_tasks_total"]), "</td>",
+        "</tr>")
+
+
+def write_projects_footer(report):
+    report.write("</tbody></table>")
+
+
+def write_all_objects_header(report):
+    report.write("<h3>All objects</h3>")
+
+
+def write_project_objects_header(report, project_label, project_key):
+    report.write("<h4>Project ", project_label, " (", project_key, ")", "</h4>")
+
+
+def _has(columns, column):
+    return columns is None or column in columns
+
+
+def _write_column_cells(report, column):
+    report.write("<td>", column["name"], "</td>",
+        "<td>", column["type"], "</td>",
+        "<td>", column["comment"], "</td>",
+        "<td>", column["meaning"], "</td>")
+
+
+def write_datasets_table(report, dataset_records, columns=None):
+    has_schema = _has(columns, "schema")
+    has_gdpr_fields = _has(columns, "gdpr_fields")
+    has_pii_suggestion = _has(columns, "pii_suggestion")
+    header_rowspan_html = " rowspan=\"2\"" if has_schema or has_gdpr_fields or has_pii_suggestion else ""
+
+    report.write("<h5>Datasets</h5>",
+        "<table><thead>",
+        "<tr>",
+        "<th", header_rowspan_html, ">Dataset</td>")
+    if _has(columns, "source"):
+        report.write("<th", header_rowspan_html, ">Is source?</td>")
+    if has_schema:
+        report.write("<th colspan=\"4\">Columns</th>")
+    if _has(columns, "creation_date"):
+        report.write("<th", header_rowspan_html, ">Creation date</th>")
+    if _has(columns, "last_build_date"):
+        report.write("<th", header_rowspan_html, ">Last build date</th>")
+    if _has(columns, "sharing"):
+        report.write("<th", header_rowspan_html, ">Projects shared with</th>")
+    if _has(columns, "description"):
+        report.write("<th", header_rowspan_html, ">Description</th>")
+    if has_gdpr_fields:
+        report.write("<th colspan=\"4\">GDPR fields</th>")
+    if has_pii_suggestion:
+        report.write("<th colspan=\"2\">Suggested from schema</th>")
+    report.write("</tr>")
+    if has_schema or has_gdpr_fields or has_pii_suggestion:
+        report.write("<tr>")
+        if has_schema:
+            report.write("<th>Name</th>",
+                "<th>Type</th>",
+                "<th>Comment</th>",
+                "<th>Meaning</th>")
+        if has_gdpr_fields:
+            report.write("<th>Contains pers. data</th>",
+                "<th>Purposes</th>",
+                "<th>Retention policy</th>",
+                "<th>Legal consent</th>")
+        if has_pii_suggestion:
+            report.write("<th>Pers. data</th>",
+                "<th>Columns</th>")
+        report.write("</tr>")
+    report.write("</thead><tbody>")
+
+    for record in dataset_records:
+        dataset_columns = record["columns"]
+
+        # get the number of columns for the rowspan layout
+        dataset_col_nb = len(dataset_columns)
+        dataset_rowspan_html = " rowspan=\"" + str(dataset_col_nb) + "\"" if dataset_col_nb > 1 else ""
+
+        report.write("<tr>",
+            "<td", dataset_rowspan_html, ">", record["dataset"], "</td>")
+        if _has(columns, "source"):
+            report.write("<td", dataset_rowspan_html, ">", ("YES" if record["is_source"] else ""), "</td>")
+        if has_schema:
+            if dataset_col_nb > 0:
+                _write_column_cells(report, dataset_columns[0])
+            else:
+                report.write("<td></td>",
+                    "<td></td>",
+                    "<td></td>",
+                    "<td></td>")
+        if _has(columns, "creation_date"):
+            report.write("<td", dataset_rowspan_html, ">", format_date(record["creation_date"]), "</td>")
+        if _has(columns, "last_build_date"):
+            report.write("<td", dataset_rowspan_html, ">", format_date(record["last_build_date"]), "</td>")
+        if _has(columns, "sharing"):
+            report.write("<td", dataset_rowspan_html, ">")
+            _write_lines(report, record["shared_with_projects"])
+            report.write("</td>")
+        if _has(columns, "description"):
+            report.write("<td", dataset_rowspan_html, ">", record["description"], "</td>")
+        if has_gdpr_fields:
+            report.write("<td", dataset_rowspan_html, ">", record["contains_personal_data"], "</td>",
+                "<td", dataset_rowspan_html, ">", record["purposes"], "</td>",
+                "<td", dataset_rowspan_html, ">", record["retention_policy"], "</td>",
+                "<td", dataset_rowspan_html, ">", record["legal_consent"], "</td>")
+        if has_pii_suggestion:
+            report.write("<td", dataset_rowspan_html, ">", record["suggested_personal_data"], "</td>",
+                "<td", dataset_rowspan_html, ">")
+            _write_lines(report, record["personal_data_columns"])
+            report.write("</td>")
+        report.write("</tr>")
+
+        for column in dataset_columns[1:]:
+            report.write("<tr>")
+            _write_column_cells(report, column)
+            report.write("</tr>")
+
+    report.write("</tbody></table>")
+
+
+def format_model_type(task_type, prediction_type):
+    return task_type + ((": " + prediction_type) if task_type == "PREDICTION" and prediction_type is not None else "")
+
+
+def _write_model_cells(report, ml_task, columns):
+    if _has(columns, "model_settings"):
+        report.write("<td>", format_model_type(ml_task["task_type"], ml_task["prediction_type"]), "</td>",
+            "<td>")
+        _write_lines(report, [format_feature(feature) for feature in ml_task["features"]])
+        report.write("</td>")
+    if _has(columns, "personal_data_features"):
+        report.write("<td>")
+        _write_lines(report, ml_task["personal_data_features"])
+        report.write("</td>")
+    if _has(columns, "last_train_date"):
+        report.write("<td>", format_date(ml_task["last_train_date"]), "</td>")
+
+
+def write_analyses_table(report, analysis_records, columns=None):
+    model_colspan = (2 if _has(columns, "model_settings") else 0) + (1 if _has(columns, "personal_data_features") else 0) \
+        + (1 if _has(columns, "last_train_date") else 0)
+    header_rowspan_html = " rowspan=\"2\"" if model_colspan > 0 else ""
+
+    report.write("<h5>Analysis</h5>",
+        "<table><thead>",
+        "<tr>",
+        "<th", header_rowspan_html, ">ID</th>",
+        "<th", header_rowspan_html, ">Name</th>",
+        "<th", header_rowspan_html, ">Creation date</th>",
+        "<th", header_rowspan_html, ">Dataset</th>")
+    if model_colspan > 0:
+        report.write("<th colspan=\"" + str(model_colspan) + "\">Models</th>",
+            "</tr>",
+            "<tr>")
+        if _has(columns, "model_settings"):
+            report.write("<th>Type</th>",
+                "<th>Features</th>")
+        if _has(columns, "personal_data_features"):
+            report.write("<th>Personal data features</th>")
+        if _has(columns, "last_train_date"):
+            report.write("<th>Last train date</th>")
+    report.write("</tr>",
+        "</thead><tobdy>")
+
+    for record in analysis_records:
+        # one row per ml task, when the table shows them
+        analysis_ml_tasks = record["ml_tasks"] if model_colspan > 0 else []
+
+        # get the number of ml tasks
+        analysis_ml_tasks_nb = len(analysis_ml_tasks)
+        analysis_rowspan_html = " rowspan=\"" + str(analysis_ml_tasks_nb) + "\"" if analysis_ml_tasks_nb > 1 else ""
+
+        report.write("<tr>",
+            "<td", analysis_rowspan_html, ">", record["analysis_id"], "</td>",
+            "<td", analysis_rowspan_html, ">", record["name"], "</td>",
+            "<td", analysis_rowspan_html, ">", format_date(record["creation_date"]), "</td>",
+            "<td", analysis_rowspan_html, ">", record["dataset"], "</td>")
+        if analysis_ml_tasks_nb > 0:
+            _write_model_cells(report, analysis_ml_tasks[0], columns)
+        else:
+            report.write("<td></td>" * model_colspan)
+        report.write("</tr>")
+
+        for ml_task in analysis_ml_tasks[1:]:
+            _write_model_cells(report, ml_task, columns)
+            report.write("</tr>")
+
+    report.write("</tbody></table>")
+
+
+def write_saved_models_table(report, saved_model_records, columns=None):
+    has_model_details = _has(columns, "model_details")
+
+    report.write("<h5>Saved models</h5>",
+        "<table><thead>",
+        "<tr>",
+        "<th>Name</th>",
+        "<th>Type</th>")
+    if has_model_details:
+        report.write("<th>Features</th>")
+    if _has(columns, "personal_data_features"):
+        report.write("<th>Personal data features</th>")
+    if has_model_details:
+        report.write("<th>Original analysis ID</th>")
+    if _has(columns, "train_date"):
+        report.write("<th>Train date</th>")
+    report.write("</tr>",
+        "</thead><tobdy>")
+
+    for record in saved_model_records:
+        report.write("<tr>",
+            "<td>", record["name"], "</td>",
+            "<td>", format_model_type(record["type"], record["prediction_type"]), "</td>")
+        if has_model_details:
+            report.write("<td>")
+            _write_lines(report, [format_feature(feature) for feature in record["features"]])
+            report.write("</td>")
+        if _has(columns, "personal_data_features"):
+            report.write("<td>")
+            _write_lines(report, record["personal_data_features"])
+            report.write("</td>")
+        if has_model_details:
+            report.write("<td>", record["original_analysis_id"], "</td>")
+        if _has(columns, "train_date"):
+            report.write("<td>", format_date(record["train_date"]), "</td>")
+        report.write("</tr>")
+
+    report.write("</tbody></table>")
+
+
+def write_retention_header(report):
+    report.write("<h3>Retention compliance</h3>")
+
+
+def write_retention_table(report, project_label, project_key, retention_records, max_listed_partitions=10):
+    report.write("<h4>Project ", project_label, " (", project_key, ")", "</h4>")
+    if len(retention_records) == 0:
+        report.write("<p>No dataset with personal data or a retention period.</p>")
+        return
+    report.write("<table><thead>",
+        "<tr>",
+        "<th>Dataset</th>",
+        "<th>Contains personal data</th>",
+        "<th>Retention policy</th>",
+        "<th>Retention (days)</th>",
+        "<th>Status</th>",
+        "<th>Detail</th>",
+        "<th>Expired partitions</th>",
+        "</tr>",
+        "</thead><tbody>")
+
+    for record in retention_records:
+        expired_partitions = record["expired_partitions"]
+        listed_partitions = expired_partitions[:max_listed_partitions]
+        if len(expired_partitions) > max_listed_partitions:
+            listed_partitions.append("... and " + str(len(expired_partitions) - max_listed_partitions) + " more")
+        report.write("<tr>",
+            "<td>", record["dataset"], "</td>",
+            "<td>", record["contains_personal_data"], "</td>",
+            "<td>", record["retention_policy"], "</td>",
+            "<td>", str(record["retention_days"]) if record["retention_days"] is not None else "", "</td>",
+            "<td>", record["status"], "</td>",
+            "<td>", record["detail"], "</td>",
+            "<td>")
+        _write_lines(report, listed_partitions)
+        report.write("</td>",
+            "</tr>")
+
+    report.write("</tbody></table>")
+
+
+def write_lineage_section(report, lineage_records):
+    report.write("<h3>Personal data lineage</h3>")
+    if len(lineage_records) == 0:
+        report.write("<p>No dataset derived from personal data is declared without personal data.</p>")
+        return
+    report.write("<table><thead>",
+        "<tr>",
+        "<th>Project</th>",
+        "<th>Dataset</th>",
+        "<th>Declared pers. data</th>",
+        "<th>Inferred pers. data</th>",
+        "<th>Derived from</th>",
+        "</tr>",
+        "</thead><tbody>")
+
+    for record in lineage_records:
+        report.write("<tr>",
+            "<td>", record["project_key"], "</td>",
+            "<td>", record["dataset"], "</td>",
+            "<td>", record["declared"], "</td>",
+            "<td>", record["inferred"], "</td>",
+            "<td>", record["origin"], "</td>",
+            "</tr>")
+
+    report.write("</tbody></table>")
+
+
+def iter_search_entries(section, records):
+    """
+    (type, project key, name, keywords) of the objects of a part of the audit,
+    for the search index of the paged reports
+    """
+    def keywords(values):
+        return " ".join([value for value in values if value])
+
+    for record in records.get("connections", []):
+        yield "connection", "", record["connection"], keywords([record["type"], record["host"]])
+    for record in records.get("projects", []):
+        yield "project", record["project_key"], record["project_label"], ""
+    for record in records.get("datasets", []):
+        yield "dataset", record["project_key"], record["dataset"], \
+            keywords([record["contains_personal_data"]] + [column["name"] for column in record["columns"]])
+    for record in records.get("analyses", []):
+        yield "analysis", record["project_key"], record["name"], \
+            keywords([record["dataset"]] + [ml_task["ml_task_id"] for ml_task in record["ml_tasks"]])
+    for record in records.get("saved_models", []):
+        yield "saved_model", record["project_key"], record["name"], keywords([record["saved_model_id"], record["type"]])
+    for record in records.get("retention", []):
+        yield "retention", record["project_key"], record["dataset"], keywords([record["status"]])
+    for record in records.get("lineage", []):
+        yield "lineage", record["project_key"], record["dataset"], keywords([record["origin"]])
+
+
+def _format_change_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return "\n".join([str(item) for item in value])
+    return str(value)
+
+
+def write_changes_section(report, change_records, old_created_on, new_created_on):
+    report.write("<h3>Changes from ", old_created_on.strftime('%Y-%m-%d %H:%M'), " UTC to ", new_created_on.strftime('%Y-%m-%d %H:%M'), " UTC</h3>")
+    if len(change_records) == 0:
+        report.write("<p>No object was added, removed or changed.</p>")
+        return
+    report.write("<table><thead>",
+        "<tr>",
+        "<th>Change</th>",
+        "<th>Type</th>",
+        "<th>Object</th>",
+        "<th>Field</th>",
+        "<th>Before</th>",
+        "<th>After</th>",
+        "</tr>",
+        "</thead><tbody>")
+
+    for record in change_records:
+        fields = record["fields"] if len(record["fields"]) > 0 else [("", None, None)]
+        report.write("<tr>",
+            "<td rowspan=\"", str(len(fields)), "\">", record["change"], "</td>",
+            "<td rowspan=\"", str(len(fields)), "\">", record["object_type"], "</td>",
+            "<td rowspan=\"", str(len(fields)), "\">", record["object"], "</td>")
+        for index, (field, old_value, new_value) in enumerate(fields):
+            # only the items removed from and added to the lists
+            if isinstance(old_value, list) and isinstance(new_value, list):
+                old_value, new_value = [item for item in old_value if item not in new_value], [item for item in new_value if item not in old_value]
+            if index > 0:
+                report.write("<tr>")
+            report.write("<td>", field, "</td>",
+                "<td><pre>", _format_change_value(old_value), "</pre></td>",
+                "<td><pre>", _format_change_value(new_value), "</pre></td>",
+                "</tr>")
+
+    report.write("</tbody></table>")
@@ -0,0 +1,133 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+import dataiku
+
+from gdpr.inventory import split_smart_name
+
+CACHE_FILE_NAME = "gdpr-audit-cache.sqlite"
+
+
+class AuditCache(object):
+    """
+    Persistent per-object cache of the API results of an audit, stored in a
+    SQLite file.
+
+    An entry is only served when the signature it was stored with matches the
+    current one, and the entries of the audited projects that were not looked up
+    during the run (deleted objects) are dropped when the cache is saved. Only
+    the kinds of entries looked up for a project are purged: a run auditing
+    other sections, or replaying the project from a checkpoint, keeps them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._seen = set()
+        self._audited = set()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                           + "kind TEXT NOT NULL, project_key TEXT NOT NULL, object_key TEXT NOT NULL, "
+                           + "signature TEXT NOT NULL, value TEXT NOT NULL, "
+                           + "PRIMARY KEY (kind, project_key, object_key))")
+
+    def get(self, kind, project_key, object_key, signature, loader):
+        if signature is None:
+            return loader()
+        with self._lock:
+            self._seen.add((kind, project_key, object_key))
+            self._audited.add((kind, project_key))
+            row = self._conn.execute("SELECT signature, value FROM entries WHERE kind = ? AND project_key = ? AND object_key = ?",
+                                     (kind, project_key, object_key)).fetchone()
+        if row is not None and row[0] == signature:
+            with self._lock:
+                self.hits += 1
+            return json.loads(row[1])
+        value = loader()
+        with self._lock:
+            self.misses += 1
+            self._conn.execute("INSERT OR REPLACE INTO entries (kind, project_key, object_key, signature, value) VALUES (?, ?, ?, ?, ?)",
+                               (kind, project_key, object_key, signature, json.dumps(value)))
+        return value
+
+    def purge(self, project_keys):
+        with self._lock:
+            for project_key in project_keys:
+                rows = self._conn.execute("SELECT kind, object_key FROM entries WHERE project_key = ?", (project_key,)).fetchall()
+                removed = [(kind, project_key, object_key) for kind, object_key in rows
+                           if (kind, project_key) in self._audited and (kind, project_key, object_key) not in self._seen]
+                self._conn.executemany("DELETE FROM entries WHERE kind = ? AND project_key = ? AND object_key = ?", removed)
+
+    def save(self):
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return (100.0 * self.hits / total) if total > 0 else 0.0
+
+    def get_summary_html(self):
+        return "<p>Incremental cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses (" \
+            + ("%.1f" % self.get_hit_rate()) + "% hit rate)</p>"
+
+
+class FolderAuditCache(object):
+    """
+    AuditCache persisted in a managed folder: the SQLite file is downloaded
+    when the run starts and uploaded back once the run is complete
+    """
+
+    def __init__(self, default_project_key, folder_ref):
+        folder_project_key, folder_id = split_smart_name(folder_ref, default_project_key)
+        self.folder = dataiku.Folder(folder_id, project_key=folder_project_key)
+        self._tmp_dir = tempfile.mkdtemp()
+        self.local_path = os.path.join(self._tmp_dir, CACHE_FILE_NAME)
+        if CACHE_FILE_NAME in [path.lstrip("/") for path in self.folder.list_paths_in_partition()]:
+            with self.folder.get_download_stream(CACHE_FILE_NAME) as stream, open(self.local_path, "wb") as local_file:
+                shutil.copyfileobj(stream, local_file)
+        self.cache = AuditCache(self.local_path)
+
+    def __enter__(self):
+        return self.cache
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.cache.save()
+                self.cache.close()
+                self.folder.upload_file(CACHE_FILE_NAME, self.local_path)
+            else:
+                self.cache.close()
+        finally:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+class _DisabledAuditCache(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def open_audit_cache(default_project_key, config):
+    if not config.get("incremental", False):
+        return _DisabledAuditCache()
+    folder_ref = config.get("cacheFolder", None)
+    if folder_ref is None or len(folder_ref) == 0:
+        raise Exception("Select a cache folder to run an incremental audit")
+    return FolderAuditCache(default_project_key, folder_ref)
@@ -0,0 +1,151 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+import dataiku
+
+from gdpr.inventory import split_smart_name
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = "gdpr-audit-checkpoint"
+MANIFEST_PATH = CHECKPOINT_DIR + "/run.json"
+
+# parameters that change how an audit runs, not what it reports
+NON_CONTENT_PARAMS = ["checkpointFolder", "resumeFromCheckpoint", "reportFolder", "previewMaxSizeMb", "reportLayout", "maxConcurrentRequests",
+                      "includeProfile", "incremental", "cacheFolder", "exportFolder", "exportFormat", "snapshotFolder",
+                      "forceRefresh", "snapshotRetention", "reportMode", "maxRequestsPerSecond", "adaptiveThrottling", "maxRetries",
+                      "shardMode", "shardCount", "shardIndex", "shardFolder"]
+
+
+def get_run_fingerprint(config, project_keys):
+    """
+    Identifies the content of an audit: a checkpoint is only resumed by a run
+    over the same projects with the same sections and columns
+    """
+    content_config = dict((key, value) for key, value in config.items() if key not in NON_CONTENT_PARAMS)
+    payload = json.dumps({"config": content_config, "projectKeys": list(project_keys)}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class AuditCheckpoint(object):
+    """
+    Per-project progress of an audit, saved to a managed folder as soon as each
+    project of each section is complete: its rendered HTML and its records.
+
+    A run resuming the checkpoint of an identical run replays the completed
+    projects instead of auditing them again. Without a folder, nothing is saved.
+    """
+
+    def __init__(self, default_project_key, config, project_keys):
+        self.folder = None
+        self.project_keys = project_keys
+        self.resumed = set()
+        folder_ref = config.get("checkpointFolder", None)
+        if folder_ref is None or len(folder_ref) == 0:
+            return
+        folder_project_key, folder_id = split_smart_name(folder_ref, default_project_key)
+        self.folder = dataiku.Folder(folder_id, project_key=folder_project_key)
+        fingerprint = get_run_fingerprint(config, project_keys)
+
+        paths = self._list_paths()
+        manifest = self.folder.read_json(MANIFEST_PATH) if MANIFEST_PATH in paths else None
+        if config.get("resumeFromCheckpoint", False) and manifest is not None and manifest.get("fingerprint", None) == fingerprint:
+            for path in paths:
+                if path != MANIFEST_PATH and path.endswith(".json"):
+                    section, project_key = path[len(CHECKPOINT_DIR) + 1:-len(".json")].split("/", 1)
+                    self.resumed.add((section, project_key))
+            logger.info("Resuming the audit checkpoint of %s, %d parts done", manifest.get("startedOn", ""), len(self.resumed))
+        else:
+            if manifest is not None and config.get("resumeFromCheckpoint", False):
+                logger.warning("The checkpoint does not match the parameters of this audit, starting over")
+            self._delete_paths(paths)
+            self.folder.write_json(MANIFEST_PATH, {
+                "fingerprint": fingerprint,
+                "startedOn": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            })
+
+    def _list_paths(self):
+        paths = [path.lstrip("/") for path in self.folder.list_paths_in_partition()]
+        return [path for path in paths if path.startswith(CHECKPOINT_DIR + "/")]
+
+    def _delete_paths(self, paths):
+        for path in paths:
+            self.folder.delete_path(path)
+
+    def _get_path(self, section, project_key):
+        return CHECKPOINT_DIR + "/" + section + "/" + project_key + ".json"
+
+    def is_enabled(self):
+        return self.folder is not None
+
+    def is_done(self, section, project_key):
+        return (section, project_key) in self.resumed
+
+    def get_pending(self, sections, project_keys):
+        return [project_key for project_key in project_keys
+                if len([section for section in sections if not self.is_done(section, project_key)]) > 0]
+
+    def load(self, section, project_key):
+        """
+        Rendered HTML and records per table of a completed project
+        """
+        part = self.folder.read_json(self._get_path(section, project_key))
+        return part["html"], part["records"]
+
+    def save(self, section, project_key, html, records):
+        if self.folder is None:
+            return
+        self.folder.write_json(self._get_path(section, project_key), {"html": html, "records": records})
+
+    def clear(self):
+        if self.folder is None:
+            return
+        self._delete_paths(self._list_paths())
+
+    def get_summary_html(self):
+        if len(self.resumed) == 0:
+            return ""
+        # the instance-wide parts are not about a project
+        audited_project_keys = set(self.project_keys)
+        project_keys = set(project_key for section, project_key in self.resumed if project_key in audited_project_keys)
+        return "<p>Resumed from checkpoint: " + str(len(self.resumed)) + " completed parts over " + str(len(project_keys)) + " projects reused</p>"
+
+
+class ProjectErrors(object):
+    """
+    Failures isolated to one project of one section: the audit goes on with the
+    other projects and lists them in the report
+    """
+
+    def __init__(self):
+        self.errors = []
+
+    def __len__(self):
+        return len(self.errors)
+
+    def add(self, section, project_key, error):
+        logger.exception("Failed to audit the %s of project %s", section, project_key)
+        self.errors.append((section, project_key, str(error)))
+
+    def add_message(self, section, project_key, message):
+        # failure reported by another process, such as a shard of the audit
+        logger.warning("Failed to audit the %s of project %s: %s", section, project_key, message)
+        self.errors.append((section, project_key, message))
+
+    def get_error_html(self, section, project_key, error):
+        return "<p><b>Could not audit the " + section + " of project " + project_key + ":</b> " + str(error) + "</p>"
+
+    def get_summary_html(self):
+        if len(self.errors) == 0:
+            return ""
+        html = "<h3>Errors</h3><ul>"
+        for section, project_key, message in self.errors:
+            html += "<li>" + project_key + " (" + section + "): " + message + "</li>"
+        return html + "</ul>"
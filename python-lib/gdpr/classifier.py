@@ -0,0 +1,146 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import re
+
+# (target, pattern, category, suggested status): patterns are searched,
+# case-insensitive, in the column meaning or in the column name turned to
+# snake_case
+DEFAULT_PII_RULES = [
+    ("meaning", r"e-?mail", "email", "YES"),
+    ("meaning", r"phone", "phone", "YES"),
+    ("meaning", r"ip.?address|ipv[46]", "ip_address", "YES"),
+    ("meaning", r"credit.?card|iban", "bank", "YES"),
+    ("name", r"e_?mail", "email", "YES"),
+    ("name", r"phone|mobile|(^|_)tel(_|$)|(^|_)fax(_|$)", "phone", "YES"),
+    ("name", r"first_?name|last_?name|sur_?name|full_?name|given_?name|family_?name|maiden", "name", "YES"),
+    ("name", r"birth|(^|_)dob(_|$)", "birth_date", "YES"),
+    ("name", r"address|street|zip_?code|post_?code|postal", "address", "YES"),
+    ("name", r"iban|(^|_)bic(_|$)|credit_?card|card_?number|account_?number", "bank", "YES"),
+    ("name", r"(^|_)ssn(_|$)|social_?security|passport|national_?id|tax_?id|driver_?licen[cs]e", "national_id", "YES"),
+    ("name", r"(^|_)ip(_|$)|ip_?address", "ip_address", "YES"),
+    ("name", r"latitude|longitude|(^|_)(lat|lon|lng)(_|$)|geo_?point", "location", "UNSURE"),
+    ("name", r"gender|(^|_)sex(_|$)|(^|_)age(_|$)|nationality|religion|ethnic", "demographics", "UNSURE"),
+    ("name", r"(^|_)(user|customer|client|employee|person|patient|member)_?id(_|$)", "identifier", "UNSURE"),
+]
+
+RULE_TARGETS = ["name", "meaning"]
+RULE_STATUSES = ["YES", "UNSURE"]
+
+_CAMEL_CASE_BOUNDARY = re.compile(r"([a-z0-9])([A-Z])")
+_SEPARATORS = re.compile(r"[^A-Za-z0-9]+")
+
+
+def normalize_column_name(name):
+    return _SEPARATORS.sub("_", _CAMEL_CASE_BOUNDARY.sub(r"\1_\2", name)).lower()
+
+
+def parse_pii_rules(text):
+    """
+    Rules given one per line as target;pattern;category;status, such as
+    name;(^|_)nir(_|$);national_id;YES. Empty lines and lines starting with #
+    are ignored.
+    """
+    rules = []
+    for line_number, line in enumerate((text or "").splitlines()):
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        parts = [part.strip() for part in line.split(";")]
+        if len(parts) != 4 or parts[0] not in RULE_TARGETS or parts[3] not in RULE_STATUSES:
+            raise Exception("Invalid PII rule on line " + str(line_number + 1) + ", expected target;pattern;category;status with target in "
+                            + "/".join(RULE_TARGETS) + " and status in " + "/".join(RULE_STATUSES) + ": " + line)
+        try:
+            re.compile(parts[1])
+        except re.error as e:
+            raise Exception("Invalid pattern in PII rule on line " + str(line_number + 1) + ": " + str(e))
+        rules.append(tuple(parts))
+    return rules
+
+
+class _RuleMatcher(object):
+    """
+    All the patterns of a target and status compiled into one alternation, so
+    that a single search finds the first matching rule
+    """
+
+    def __init__(self, rules):
+        self.categories = {}
+        alternatives = []
+        for index, (target, pattern, category, status) in enumerate(rules):
+            group = "r" + str(index)
+            self.categories[group] = category
+            alternatives.append("(?P<" + group + ">" + pattern + ")")
+        self.regex = re.compile("|".join(alternatives), re.IGNORECASE) if len(alternatives) > 0 else None
+
+    def match(self, value):
+        if self.regex is None or len(value) == 0:
+            return None
+        match = self.regex.search(value)
+        if match is None:
+            return None
+        return self.categories[match.lastgroup]
+
+
+class SchemaClassifier(object):
+    """
+    Suggests whether a dataset contains personal data from its schema alone,
+    matching the column names and meanings against a rules table.
+
+    Columns are memoized by name and meaning, which repeat a lot across the
+    datasets of an instance.
+    """
+
+    def __init__(self, rules=None):
+        rules = DEFAULT_PII_RULES if rules is None else rules
+        self._matchers = []
+        for status in RULE_STATUSES:
+            for target in RULE_TARGETS:
+                matcher = _RuleMatcher([rule for rule in rules if rule[0] == target and rule[3] == status])
+                self._matchers.append((target, status, matcher))
+        self._columns = {}
+
+    def classify_column(self, name, meaning):
+        """
+        (category, status) of the first matching rule, YES rules first, or None
+        """
+        key = (name, meaning)
+        if key not in self._columns:
+            values = {"name": normalize_column_name(name), "meaning": meaning or ""}
+            result = None
+            for target, status, matcher in self._matchers:
+                category = matcher.match(values[target])
+                if category is not None:
+                    result = (category, status)
+                    break
+            self._columns[key] = result
+        return self._columns[key]
+
+    def classify(self, dataset):
+        """
+        Suggested gdpr_contains_personal_data value of a dataset summary, and the
+        (column, category) that motivate it
+        """
+        suggestion = "NO"
+        matched_columns = []
+        for column in dataset.columns:
+            result = self.classify_column(column.name, column.meaning)
+            if result is None:
+                continue
+            category, status = result
+            matched_columns.append((column.name, category))
+            if status == "YES":
+                suggestion = "YES"
+            elif suggestion == "NO":
+                suggestion = "UNSURE"
+        return suggestion, matched_columns
+
+
+def get_schema_classifier(config):
+    return SchemaClassifier(DEFAULT_PII_RULES + parse_pii_rules(config.get("piiRules", "")))
+
+
+def format_matched_column(matched_column):
+    return matched_column[0] + " (" + matched_column[1] + ")"
@@ -0,0 +1,51 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+
+
+def get_max_concurrent_requests(config):
+    try:
+        value = int(config.get("maxConcurrentRequests", DEFAULT_MAX_CONCURRENT_REQUESTS))
+    except (TypeError, ValueError):
+        value = DEFAULT_MAX_CONCURRENT_REQUESTS
+    return max(1, value)
+
+
+class ParallelFetcher(object):
+    """
+    Bounded worker pool running blocking DSS API calls concurrently.
+
+    Results are always returned in the order of the submitted items, so the
+    reports stay identical whatever the number of workers.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_CONCURRENT_REQUESTS):
+        self.max_workers = max(1, int(max_workers))
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def map(self, func, items):
+        items = list(items)
+        if self.max_workers == 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return list(self._executor.map(func, items))
+
+    def run_all(self, funcs):
+        return self.map(lambda func: func(), funcs)
@@ -0,0 +1,162 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import hashlib
+import json
+
+# Objects of the audit compared between two snapshots, normalized to the fields
+# that describe the processing of personal data: volatile fields such as dates
+# and counts are left out. Fields of column groups that were not audited (None)
+# are left out too.
+INSTANCE_GROUP = "_instance"
+
+
+def _sorted(values):
+    return sorted(values) if values is not None else None
+
+
+def _prune(fields):
+    return dict((name, value) for name, value in fields.items() if value is not None)
+
+
+def iter_normalized_objects(section, records):
+    """
+    (group, object id, normalized fields) of the audited objects of a part: the
+    group is the project of the object, or the instance for the connections
+    """
+    if section == "connections":
+        for record in records.get("connections", []):
+            yield INSTANCE_GROUP, "connection:" + record["connection"], _prune({
+                "readable_by": record["readable_by"],
+                "read_groups": _sorted(record["read_groups"]),
+                "usable_by": record["usable_by"],
+                "usage_groups": _sorted(record["usage_groups"])
+            })
+    for record in records.get("projects", []):
+        yield record["project_key"], "project:" + record["project_key"], _prune({
+            "read_groups": _sorted(record["read_groups"]),
+            "write_groups": _sorted(record["write_groups"]),
+            "gdpr_forbid_dataset_sharing": record["forbid_dataset_sharing"],
+            "gdpr_forbid_dataset_export": record["forbid_dataset_export"],
+            "gdpr_forbid_model_creation": record["forbid_model_creation"],
+            "gdpr_forbid_uploaded_datasets": record["forbid_uploaded_datasets"],
+            "gdpr_forbidden_connections": _sorted(record["forbidden_connections"])
+        })
+    for record in records.get("datasets", []):
+        yield record["project_key"], "dataset:" + record["project_key"] + "." + record["dataset"], _prune({
+            "gdpr_contains_personal_data": record["contains_personal_data"],
+            "gdpr_purposes": record["purposes"],
+            "gdpr_retention_policy": record["retention_policy"],
+            "gdpr_legal_consent": record["legal_consent"],
+            "columns": [column["name"] + " " + column["type"] + ((" " + column["meaning"]) if column["meaning"] else "")
+                        for column in record["columns"]] if len(record["columns"]) > 0 else None
+        })
+    for record in records.get("analyses", []):
+        for ml_task in record["ml_tasks"]:
+            features = ml_task["features"]
+            yield record["project_key"], "ml_task:" + record["project_key"] + "." + record["analysis_id"] + "/" + ml_task["ml_task_id"], _prune({
+                "dataset": record["dataset"],
+                "features": sorted([feature[0] + " " + feature[1] for feature in features]) if features is not None else None
+            })
+    for record in records.get("saved_models", []):
+        features = record["features"]
+        yield record["project_key"], "saved_model:" + record["project_key"] + "." + record["saved_model_id"], _prune({
+            "version_id": record["version_id"],
+            "features": sorted([feature[0] + " " + feature[1] for feature in features]) if features is not None else None
+        })
+
+
+def hash_object(fields):
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def get_group_hash(object_hashes):
+    return hash_object(sorted(object_hashes.items()))
+
+
+class ObjectHashes(object):
+    """
+    Hash of every audited object of a snapshot, by group, with one hash per
+    group over the hashes of its objects
+    """
+
+    def __init__(self, groups=None, group_hashes=None):
+        self.groups = groups if groups is not None else {}
+        self._group_hashes = group_hashes if group_hashes is not None else {}
+
+    def add(self, group, object_id, object_hash):
+        if group not in self.groups:
+            self.groups[group] = {}
+        self.groups[group][object_id] = object_hash
+        self._group_hashes.pop(group, None)
+
+    def get_group_hash(self, group):
+        if group not in self._group_hashes:
+            self._group_hashes[group] = get_group_hash(self.groups.get(group, {}))
+        return self._group_hashes[group]
+
+    def to_json(self):
+        return dict((group, {"hash": self.get_group_hash(group), "objects": objects}) for group, objects in self.groups.items())
+
+    @staticmethod
+    def from_json(data):
+        return ObjectHashes(dict((group, entry["objects"]) for group, entry in data.items()),
+                            dict((group, entry["hash"]) for group, entry in data.items()))
+
+
+def compare_hashes(old, new):
+    """
+    Ids of the added, removed and changed objects. Groups with the same hash
+    are skipped without looking at their objects, so that the cost follows the
+    number of changed groups rather than the size of the instance.
+    """
+    added = []
+    removed = []
+    changed = []
+    for group in sorted(set(old.groups.keys()) | set(new.groups.keys())):
+        if group in old.groups and group in new.groups and old.get_group_hash(group) == new.get_group_hash(group):
+            continue
+        old_objects = old.groups.get(group, {})
+        new_objects = new.groups.get(group, {})
+        for object_id, object_hash in new_objects.items():
+            if object_id not in old_objects:
+                added.append(object_id)
+            elif old_objects[object_id] != object_hash:
+                changed.append(object_id)
+        removed.extend([object_id for object_id in old_objects if object_id not in new_objects])
+    return sorted(added), sorted(removed), sorted(changed)
+
+
+def get_changed_fields(old_fields, new_fields):
+    """
+    (field, old value, new value) of the fields that differ
+    """
+    return [(name, old_fields.get(name, None), new_fields.get(name, None))
+            for name in sorted(set(old_fields.keys()) | set(new_fields.keys()))
+            if old_fields.get(name, None) != new_fields.get(name, None)]
+
+
+def build_change_records(old_snapshot, new_snapshot):
+    """
+    Added, removed and changed objects between two snapshots. The objects
+    themselves are only read back when some of them changed.
+    """
+    added, removed, changed = compare_hashes(old_snapshot.get_object_hashes(), new_snapshot.get_object_hashes())
+    records = []
+    if len(added) + len(removed) + len(changed) == 0:
+        return records
+    old_objects = old_snapshot.load_objects(set(removed) | set(changed))
+    new_objects = new_snapshot.load_objects(set(added) | set(changed))
+    for change, object_ids in [("ADDED", added), ("REMOVED", removed), ("CHANGED", changed)]:
+        for object_id in object_ids:
+            object_type, name = object_id.split(":", 1)
+            fields = get_changed_fields(old_objects.get(object_id, {}), new_objects.get(object_id, {}))
+            records.append({
+                "change": change,
+                "object_type": object_type,
+                "object": name,
+                "fields": fields
+            })
+    return records
@@ -0,0 +1,301 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import csv
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import dataiku
+
+from gdpr.inventory import split_smart_name
+from gdpr.records import format_feature
+from gdpr.report import EncodingSink
+
+# One flat table per section of the audit, with DSS storage types
+SECTION_SCHEMAS = {
+    "connections": [
+        ("connection", "string"),
+        ("type", "string"),
+        ("host", "string"),
+        ("readable_by", "string"),
+        ("read_groups", "array"),
+        ("usable_by", "string"),
+        ("usage_groups", "array"),
+        ("personal_data_datasets", "array")
+    ],
+    "projects": [
+        ("project_key", "string"),
+        ("project_label", "string"),
+        ("read_groups", "array"),
+        ("write_groups", "array"),
+        ("forbid_dataset_sharing", "boolean"),
+        ("forbid_dataset_export", "boolean"),
+        ("forbid_model_creation", "boolean"),
+        ("forbid_uploaded_datasets", "boolean"),
+        ("forbidden_connections", "array"),
+        ("datasets_personal_data", "bigint"),
+        ("datasets_unsure", "bigint"),
+        ("datasets_no_personal_data", "bigint"),
+        ("datasets_total", "bigint"),
+        ("ml_tasks_personal_data", "bigint"),
+        ("ml_tasks_total", "bigint")
+    ],
+    "datasets": [
+        ("project_key", "string"),
+        ("dataset", "string"),
+        ("is_source", "boolean"),
+        ("column_index", "bigint"),
+        ("column_name", "string"),
+        ("column_type", "string"),
+        ("column_comment", "string"),
+        ("column_meaning", "string"),
+        ("creation_date", "date"),
+        ("last_build_date", "date"),
+        ("shared_with_projects", "array"),
+        ("description", "string"),
+        ("contains_personal_data", "string"),
+        ("purposes", "string"),
+        ("retention_policy", "string"),
+        ("legal_consent", "string"),
+        ("suggested_personal_data", "string"),
+        ("personal_data_columns", "array")
+    ],
+    "analyses": [
+        ("project_key", "string"),
+        ("analysis_id", "string"),
+        ("name", "string"),
+        ("creation_date", "date"),
+        ("dataset", "string"),
+        ("ml_task_id", "string"),
+        ("task_type", "string"),
+        ("prediction_type", "string"),
+        ("features", "array"),
+        ("personal_data_features", "array"),
+        ("last_train_date", "date")
+    ],
+    "saved_models": [
+        ("project_key", "string"),
+        ("saved_model_id", "string"),
+        ("name", "string"),
+        ("type", "string"),
+        ("prediction_type", "string"),
+        ("version_id", "string"),
+        ("features", "array"),
+        ("personal_data_features", "array"),
+        ("original_analysis_id", "string"),
+        ("train_date", "date")
+    ],
+    "retention": [
+        ("project_key", "string"),
+        ("dataset", "string"),
+        ("contains_personal_data", "string"),
+        ("retention_policy", "string"),
+        ("retention_days", "bigint"),
+        ("partitions", "bigint"),
+        ("expired_partitions", "array"),
+        ("status", "string"),
+        ("detail", "string")
+    ],
+    "lineage": [
+        ("project_key", "string"),
+        ("dataset", "string"),
+        ("declared", "string"),
+        ("inferred", "string"),
+        ("origin", "string")
+    ],
+    "changes": [
+        ("change", "string"),
+        ("object_type", "string"),
+        ("object", "string"),
+        ("field", "string"),
+        ("old_value", "string"),
+        ("new_value", "string")
+    ]
+}
+
+EXPORT_FORMATS = ["CSV", "PARQUET"]
+
+
+def iter_section_rows(section, record):
+    """
+    Flattens a record of a section into the rows of its table: one row per
+    column for the datasets, one row per ML task for the analyses, one row per
+    changed field for the changes
+    """
+    if section == "datasets":
+        columns = record["columns"] if len(record["columns"]) > 0 else [None]
+        for column_index, column in enumerate(columns):
+            row = dict(record)
+            del row["columns"]
+            row["column_index"] = column_index if column is not None else None
+            for key in ["name", "type", "comment", "meaning"]:
+                row["column_" + key] = column[key] if column is not None else ""
+            yield row
+    elif section == "analyses":
+        ml_tasks = record["ml_tasks"] if len(record["ml_tasks"]) > 0 else [None]
+        for ml_task in ml_tasks:
+            row = dict(record)
+            del row["ml_tasks"]
+            for key in ["ml_task_id", "task_type", "prediction_type", "features", "personal_data_features", "last_train_date"]:
+                row[key] = ml_task[key] if ml_task is not None else None
+            yield row
+    elif section == "changes":
+        for field, old_value, new_value in record["fields"]:
+            row = dict(record)
+            del row["fields"]
+            row["field"] = field
+            row["old_value"] = json.dumps(old_value) if old_value is not None else None
+            row["new_value"] = json.dumps(new_value) if new_value is not None else None
+            yield row
+    else:
+        yield record
+
+
+def _to_csv_value(value, storage_type):
+    if value is None:
+        return ""
+    if storage_type == "array":
+        return json.dumps([format_feature(item) if isinstance(item, (tuple, list)) else item for item in value])
+    if storage_type == "date":
+        return datetime.utcfromtimestamp(value).strftime('%Y-%m-%dT%H:%M:%S.000Z') if value > 0 else ""
+    if storage_type == "boolean":
+        return "true" if value in [True, "true", "True"] else "false"
+    return str(value)
+
+
+class _CSVSectionWriter(object):
+    def __init__(self, folder, path, schema):
+        self.schema = schema
+        self._sink = EncodingSink(folder.get_writer(path))
+        self._writer = csv.writer(self._sink, lineterminator="\n")
+        self._writer.writerow([name for name, storage_type in schema])
+
+    def write_row(self, row):
+        self._writer.writerow([_to_csv_value(row.get(name, None), storage_type) for name, storage_type in self.schema])
+
+    def close(self):
+        self._sink.close()
+
+
+class _ParquetSectionWriter(object):
+    """
+    Writes row groups of a bounded size to a local Parquet file, uploaded to
+    the folder once complete
+    """
+
+    def __init__(self, folder, path, schema, row_group_size=10000):
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        self.schema = schema
+        self._folder = folder
+        self._path = path
+        self._row_group_size = row_group_size
+        self._buffer = []
+        self._tmp_dir = tempfile.mkdtemp()
+        self._local_path = os.path.join(self._tmp_dir, "section.parquet")
+        types = {
+            "string": pyarrow.string(),
+            "bigint": pyarrow.int64(),
+            "boolean": pyarrow.bool_(),
+            "date": pyarrow.timestamp("ms", tz="UTC"),
+            "array": pyarrow.list_(pyarrow.string())
+        }
+        self._arrow_schema = pyarrow.schema([(name, types[storage_type]) for name, storage_type in schema])
+        self._writer = pyarrow.parquet.ParquetWriter(self._local_path, self._arrow_schema)
+
+    def _to_value(self, value, storage_type):
+        if value is None:
+            return None
+        if storage_type == "array":
+            return [format_feature(item) if isinstance(item, (tuple, list)) else item for item in value]
+        if storage_type == "date":
+            return int(value * 1000) if value > 0 else None
+        if storage_type == "boolean":
+            return value in [True, "true", "True"]
+        return value
+
+    def write_row(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self._row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._buffer) == 0:
+            return
+        columns = [self._pyarrow.array([self._to_value(row.get(name, None), storage_type) for row in self._buffer], type=field.type)
+                   for (name, storage_type), field in zip(self.schema, self._arrow_schema)]
+        self._writer.write_table(self._pyarrow.Table.from_arrays(columns, schema=self._arrow_schema))
+        self._buffer = []
+
+    def close(self):
+        try:
+            self._flush()
+            self._writer.close()
+            self._folder.upload_file(self._path, self._local_path)
+        finally:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+
+class AuditExporter(object):
+    """
+    Bulk export of the audit records to a managed folder, as one CSV or Parquet
+    file per section, rewritten at each run so that folder-based datasets can be
+    built on top of them
+    """
+
+    def __init__(self, default_project_key, config):
+        self.folder = None
+        self.export_format = config.get("exportFormat", "CSV")
+        if self.export_format not in EXPORT_FORMATS:
+            raise Exception("Unknown export format: " + str(self.export_format))
+        folder_ref = config.get("exportFolder", None)
+        if folder_ref is not None and len(folder_ref) > 0:
+            folder_project_key, folder_id = split_smart_name(folder_ref, default_project_key)
+            self.folder = dataiku.Folder(folder_id, project_key=folder_project_key)
+        self._writers = {}
+        self.row_counts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_enabled(self):
+        return self.folder is not None
+
+    def _get_writer(self, section):
+        if section not in self._writers:
+            path = section + "/" + section + (".csv" if self.export_format == "CSV" else ".parquet")
+            if self.export_format == "CSV":
+                self._writers[section] = _CSVSectionWriter(self.folder, path, SECTION_SCHEMAS[section])
+            else:
+                self._writers[section] = _ParquetSectionWriter(self.folder, path, SECTION_SCHEMAS[section])
+            self.row_counts[section] = 0
+        return self._writers[section]
+
+    def write(self, section, records):
+        if self.folder is None:
+            return
+        writer = self._get_writer(section)
+        for record in records:
+            for row in iter_section_rows(section, record):
+                writer.write_row(row)
+                self.row_counts[section] += 1
+
+    def close(self):
+        writers = self._writers
+        self._writers = {}
+        for writer in writers.values():
+            writer.close()
+
+    def get_summary_html(self):
+        if len(self.row_counts) == 0:
+            return ""
+        return "<p>Exported tables: " + ", ".join([section + " (" + str(self.row_counts[section]) + " rows)" for section in sorted(self.row_counts.keys())]) + "</p>"
@@ -0,0 +1,202 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import json
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# methods returning a handle without calling the backend: their result is
+# instrumented in turn, but they are not recorded
+HANDLE_METHODS = set(["get_project", "get_dataset", "get_analysis", "get_ml_task", "get_saved_model",
+                      "get_managed_folder", "get_recipe"])
+
+
+def _percentile(sorted_values, percent):
+    if len(sorted_values) == 0:
+        return 0.0
+    # nearest-rank method
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def _estimate_payload_size(result):
+    for attr in ["raw", "settings", "details"]:
+        if hasattr(result, attr) and not callable(getattr(result, attr)):
+            result = getattr(result, attr)
+            break
+    if isinstance(result, (dict, list, str)):
+        try:
+            return len(json.dumps(result, default=str))
+        except (TypeError, ValueError):
+            return 0
+    return 0
+
+
+class ApiProfiler(object):
+    """
+    Records the count, latency and payload size of the DSS API calls of a run,
+    per section of the report and per endpoint.
+
+    Payload sizes come from the HTTP responses when available. Estimating them
+    from the returned objects costs a serialization per call, so it is opt-in.
+    """
+
+    def __init__(self, estimate_payloads=False):
+        self.estimate_payloads = estimate_payloads
+        self.section = "setup"
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def set_section(self, section):
+        self.section = section
+
+    def add_response_size(self, size):
+        if getattr(self._local, "recording", False):
+            self._local.payload_size += size
+
+    def call(self, endpoint, func, args, kwargs):
+        self._local.recording = True
+        self._local.payload_size = 0
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            duration = time.time() - start
+            self._local.recording = False
+        payload_size = self._local.payload_size
+        if payload_size == 0 and self.estimate_payloads:
+            payload_size = _estimate_payload_size(result)
+        with self._lock:
+            stats = self._stats.get((self.section, endpoint))
+            if stats is None:
+                stats = {"durations": [], "payload_size": 0}
+                self._stats[(self.section, endpoint)] = stats
+            stats["durations"].append(duration)
+            stats["payload_size"] += payload_size
+        return result
+
+    def get_summary(self):
+        """
+        One entry per section and endpoint, in order of total time spent
+        """
+        with self._lock:
+            items = list(self._stats.items())
+        summary = []
+        for (section, endpoint), stats in items:
+            durations = sorted(stats["durations"])
+            total = sum(durations)
+            summary.append({
+                "section": section,
+                "endpoint": endpoint,
+                "calls": len(durations),
+                "total_s": total,
+                "mean_ms": 1000.0 * total / len(durations),
+                "p50_ms": 1000.0 * _percentile(durations, 50),
+                "p95_ms": 1000.0 * _percentile(durations, 95),
+                "p99_ms": 1000.0 * _percentile(durations, 99),
+                "payload_bytes": stats["payload_size"]
+            })
+        summary.sort(key=lambda entry: -entry["total_s"])
+        return summary
+
+    def log_summary(self, macro):
+        for entry in self.get_summary():
+            logger.info("API profile %s", json.dumps(dict(entry, macro=macro), sort_keys=True))
+
+    def get_summary_html(self):
+        html = "<h3>Performance profile</h3>" \
+            + "<table><thead>" \
+            + "<tr>" \
+            + "<th>Section</th>" \
+            + "<th>Endpoint</th>" \
+            + "<th>Calls</th>" \
+            + "<th>Total (s)</th>" \
+            + "<th>Mean (ms)</th>" \
+            + "<th>p50 (ms)</th>" \
+            + "<th>p95 (ms)</th>" \
+            + "<th>p99 (ms)</th>" \
+            + "<th>Payload (KB)</th>" \
+            + "</tr>" \
+            + "</thead><tbody>"
+        rows = []
+        for entry in self.get_summary():
+            rows.append("<tr>"
+                        + "<td>" + entry["section"] + "</td>"
+                        + "<td>" + entry["endpoint"] + "</td>"
+                        + "<td>" + str(entry["calls"]) + "</td>"
+                        + "<td>" + ("%.3f" % entry["total_s"]) + "</td>"
+                        + "<td>" + ("%.1f" % entry["mean_ms"]) + "</td>"
+                        + "<td>" + ("%.1f" % entry["p50_ms"]) + "</td>"
+                        + "<td>" + ("%.1f" % entry["p95_ms"]) + "</td>"
+                        + "<td>" + ("%.1f" % entry["p99_ms"]) + "</td>"
+                        + "<td>" + ("%.1f" % (entry["payload_bytes"] / 1024.0)) + "</td>"
+                        + "</tr>")
+        return html + "".join(rows) + "</tbody></table>"
+
+
+class InstrumentedHandle(object):
+    """
+    Proxy over a dataikuapi handle (client, project, dataset...) recording each
+    of its calls in an ApiProfiler, and running them within the budget of a
+    RequestThrottle when given
+    """
+
+    def __init__(self, target, profiler, throttle=None):
+        self._target = target
+        self._profiler = profiler
+        self._throttle = throttle
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        profiler = self._profiler
+        throttle = self._throttle
+        if name in HANDLE_METHODS:
+            def get_handle(*args, **kwargs):
+                return InstrumentedHandle(attr(*args, **kwargs), profiler, throttle)
+            return get_handle
+        endpoint = type(self._target).__name__ + "." + name
+
+        def call(*args, **kwargs):
+            if throttle is None:
+                return profiler.call(endpoint, attr, args, kwargs)
+            # each attempt is profiled on its own
+            return throttle.call(endpoint, name, profiler.call, (endpoint, attr, args, kwargs), {})
+        return call
+
+
+class InstrumentedClient(InstrumentedHandle):
+    """
+    Instrumented DSS client. When the client exposes its HTTP session, payload
+    sizes are taken from the response headers, otherwise they are estimated from
+    the returned objects.
+    """
+
+    def __init__(self, client, profiler, throttle=None):
+        super(InstrumentedClient, self).__init__(client, profiler, throttle)
+        self._session = getattr(client, "_session", None)
+        self._hook = None
+        if self._session is not None and hasattr(self._session, "hooks"):
+            def record_size(response, *args, **kwargs):
+                profiler.add_response_size(int(response.headers.get("Content-Length", 0) or 0))
+            self._hook = record_size
+            self._session.hooks.setdefault("response", []).append(self._hook)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._hook is not None:
+            self._session.hooks["response"].remove(self._hook)
+            self._hook = None
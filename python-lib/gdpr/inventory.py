@@ -0,0 +1,305 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import hashlib
+import logging
+import threading
+
+from gdpr.crawler import ParallelFetcher
+from gdpr.model import DatasetSummary, get_allowed_groups, get_dataset_shares, get_last_build_date, is_source_dataset
+
+logger = logging.getLogger(__name__)
+
+# fields of the dataset definitions the summaries are projected from, that some
+# DSS versions also return in the dataset listings
+LISTED_FIELDS = ("customFields", "schema")
+
+
+def get_object_signature(obj):
+    """
+    Change-detection signature of a DSS object, from its creation and version
+    tags, or None when the object carries no tags
+    """
+    version_tag = obj.get("versionTag", None)
+    if version_tag is None:
+        return None
+    creation_tag = obj.get("creationTag", {})
+    return str(creation_tag.get("lastModifiedOn", 0)) + "-" + str(version_tag.get("lastModifiedOn", 0)) \
+        + "-" + str(version_tag.get("versionNumber", 0))
+
+
+def split_smart_name(smart_name, default_project_key):
+    if "." in smart_name:
+        project_key, object_name = smart_name.split(".", 1)
+        return project_key, object_name
+    return default_project_key, smart_name
+
+
+class Memo(object):
+    """
+    Thread-safe memoization table: concurrent requests for the same key wait
+    for the first one instead of issuing a duplicate API call
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, loader):
+        while True:
+            with self._lock:
+                if key in self._values:
+                    return self._values[key]
+                event = self._pending.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._pending[key] = event
+                    break
+            event.wait()
+        try:
+            value = loader()
+            with self._lock:
+                self._values[key] = value
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+
+class InstanceInventory(object):
+    """
+    In-memory store of the DSS objects read during a run.
+
+    Every project handle, metadata, permission set, settings blob, dataset list
+    and dataset definition is fetched at most once, then served from memory to
+    all the sections of the report, including cross-project lookups. Permissions,
+    settings, listings and definitions are kept as their compact projections
+    (see gdpr.model), the payloads are released once projected.
+    """
+
+    def __init__(self, client, fetcher=None, cache=None):
+        self.client = client
+        self.fetcher = fetcher if fetcher is not None else ParallelFetcher(1)
+        self.cache = cache
+        self._projects = Memo()
+        self._project_metadata = Memo()
+        self._project_groups = Memo()
+        self._dataset_shares = Memo()
+        self._project_analyses = Memo()
+        self._project_ml_tasks = Memo()
+        self._project_saved_models = Memo()
+        self._dataset_listings = Memo()
+        self._project_recipes = Memo()
+        self._flow_signatures = Memo()
+        self._dataset_summaries = Memo()
+        self._dataset_descriptions = Memo()
+        self._dataset_build_dates = Memo()
+        self._dataset_sources = Memo()
+        self._dataset_partitions = Memo()
+
+    def get_project(self, project_key):
+        return self._projects.get(project_key, lambda: self.client.get_project(project_key))
+
+    def get_project_metadata(self, project_key):
+        return self._project_metadata.get(project_key, lambda: self.get_project(project_key).get_metadata())
+
+    def get_project_label(self, project_key):
+        return self.get_project_metadata(project_key).get("label", project_key)
+
+    def get_project_groups(self, project_key):
+        """
+        (read groups, write groups) of a project
+        """
+        return self._project_groups.get(project_key, lambda: get_allowed_groups(self.get_project(project_key).get_permissions()))
+
+    def get_dataset_shares(self, project_key):
+        """
+        Target projects of the datasets shared by a project, by dataset name
+        """
+        return self._dataset_shares.get(project_key, lambda: get_dataset_shares(self.get_project(project_key).get_settings().settings))
+
+    def list_project_analyses(self, project_key):
+        return self._project_analyses.get(project_key, lambda: self.get_project(project_key).list_analyses())
+
+    def list_project_ml_tasks(self, project_key):
+        return self._project_ml_tasks.get(project_key, lambda: self.get_project(project_key).list_ml_tasks().get("mlTasks", []))
+
+    def list_project_saved_models(self, project_key):
+        return self._project_saved_models.get(project_key, lambda: self.get_project(project_key).list_saved_models())
+
+    def list_project_recipes(self, project_key):
+        return self._project_recipes.get(project_key, lambda: list(self.get_project(project_key).list_recipes()))
+
+    def list_dataset_items(self, project_key):
+        """
+        (signature, summary) of the datasets of a project by name, the summary
+        being None when the listing lacks the fields it is projected from
+        """
+        def load():
+            items = {}
+            for dataset_item in self.get_project(project_key).list_datasets():
+                listed = all(key in dataset_item for key in LISTED_FIELDS)
+                items[dataset_item["name"]] = (get_object_signature(dataset_item), DatasetSummary.from_definition(dataset_item) if listed else None)
+            return items
+        return self._dataset_listings.get(project_key, load)
+
+    def list_dataset_names(self, project_key):
+        return list(self.list_dataset_items(project_key).keys())
+
+    def get_dataset(self, project_key, dataset_name):
+        # handles are cheap, only their calls hit the backend
+        return self.get_project(project_key).get_dataset(dataset_name)
+
+    def cached(self, kind, project_key, object_key, signature, loader):
+        if self.cache is None:
+            return loader()
+        return self.cache.get(kind, project_key, object_key, signature, loader)
+
+    def get_dataset_signature(self, project_key, dataset_name):
+        # only projects that are listed anyway can tell which of their datasets changed
+        if self.cache is None or project_key not in self._dataset_listings:
+            return None
+        dataset_item = self.list_dataset_items(project_key).get(dataset_name, None)
+        return dataset_item[0] if dataset_item is not None else None
+
+    def get_flow_signature(self, project_key):
+        # usages change with the recipes around the dataset, not with the dataset itself
+        def compute():
+            signatures = []
+            for recipe in self.list_project_recipes(project_key):
+                signature = get_object_signature(recipe)
+                if signature is None:
+                    return None
+                signatures.append(recipe["name"] + ":" + signature)
+            return hashlib.sha1("\n".join(sorted(signatures)).encode("utf-8")).hexdigest()
+        return self._flow_signatures.get(project_key, compute)
+
+    def get_dataset_summary(self, project_key, dataset_name):
+        def load():
+            return DatasetSummary.from_json(self.cached(
+                "dataset_summary", project_key, dataset_name, self.get_dataset_signature(project_key, dataset_name),
+                lambda: DatasetSummary.from_definition(self.get_dataset(project_key, dataset_name).get_definition()).to_json()))
+        return self._dataset_summaries.get((project_key, dataset_name), load)
+
+    def get_dataset_description(self, project_key, dataset_name):
+        def load():
+            return self.cached("dataset_description", project_key, dataset_name, self.get_dataset_signature(project_key, dataset_name),
+                               lambda: self.get_dataset(project_key, dataset_name).get_metadata().get("description", ""))
+        return self._dataset_descriptions.get((project_key, dataset_name), load)
+
+    def get_dataset_last_build_date(self, project_key, dataset_name):
+        # metrics move with each build, without any change of the dataset version tag
+        return self._dataset_build_dates.get((project_key, dataset_name),
+                                             lambda: get_last_build_date(self.get_dataset(project_key, dataset_name).get_last_metric_values()))
+
+    def get_dataset_partitions(self, project_key, dataset_name):
+        # partitions are built without any change of the dataset version tag
+        return self._dataset_partitions.get((project_key, dataset_name), lambda: self.get_dataset(project_key, dataset_name).list_partitions())
+
+    def is_source_dataset(self, project_key, dataset_name):
+        def load():
+            signature = self.get_dataset_signature(project_key, dataset_name)
+            flow_signature = self.get_flow_signature(project_key) if signature is not None else None
+            return self.cached("dataset_is_source", project_key, dataset_name, (signature + "-" + flow_signature) if flow_signature is not None else None,
+                               lambda: is_source_dataset(self.get_dataset(project_key, dataset_name).get_usages()))
+        return self._dataset_sources.get((project_key, dataset_name), load)
+
+    def resolve_dataset_summary(self, smart_name, default_project_key):
+        project_key, dataset_name = split_smart_name(smart_name, default_project_key)
+        return self.get_dataset_summary(project_key, dataset_name)
+
+    def get_listed_dataset_summary(self, project_key, dataset_name):
+        """
+        Summary of the dataset from the listing of its project when it carries
+        the fields of the definition, which saves the definition call, otherwise
+        from the definition. The listing only has the GDPR fields and the schema.
+        """
+        dataset_item = self.list_dataset_items(project_key).get(dataset_name, None)
+        if dataset_item is not None and dataset_item[1] is not None:
+            return dataset_item[1]
+        return self.get_dataset_summary(project_key, dataset_name)
+
+    def iter_dataset_summaries(self, project_key, from_listing=False):
+        for dataset_name in self.list_dataset_names(project_key):
+            if from_listing:
+                yield dataset_name, self.get_listed_dataset_summary(project_key, dataset_name)
+            else:
+                yield dataset_name, self.get_dataset_summary(project_key, dataset_name)
+
+    def _prefetch(self, calls, on_done=None):
+        # best effort: a failed call is not memoized, it is retried and raises
+        # again when a section actually reads the object
+        def call_quietly(call):
+            try:
+                call()
+            except Exception as e:
+                logger.info("Prefetch failed, deferred to the report: %s", e)
+            if on_done is not None:
+                on_done()
+        self.fetcher.map(call_quietly, calls)
+
+    def _list_prefetched(self, lister, project_key):
+        try:
+            return lister(project_key)
+        except Exception:
+            return []
+
+    def prefetch_projects(self, project_keys, metadata=True, permissions=False, settings=False, ml_tasks=False, dataset_names=True,
+                          recipes=False, saved_models=False):
+        calls = []
+        for project_key in project_keys:
+            if metadata:
+                calls.append(lambda project_key=project_key: self.get_project_metadata(project_key))
+            if permissions:
+                calls.append(lambda project_key=project_key: self.get_project_groups(project_key))
+            if settings:
+                calls.append(lambda project_key=project_key: self.get_dataset_shares(project_key))
+            if ml_tasks:
+                calls.append(lambda project_key=project_key: self.list_project_ml_tasks(project_key))
+            if dataset_names:
+                calls.append(lambda project_key=project_key: self.list_dataset_names(project_key))
+            if recipes:
+                calls.append(lambda project_key=project_key: self.list_project_recipes(project_key))
+            if saved_models:
+                calls.append(lambda project_key=project_key: self.list_project_saved_models(project_key))
+        self._prefetch(calls)
+
+    def prefetch_datasets(self, project_keys, definition=True, metadata=False, metrics=False, usages=False, from_listing=False,
+                          on_progress=None):
+        # flat fan-out over all the datasets of all the projects, after the listings;
+        # from the listings, only the definitions they lack fields of are fetched.
+        # on_progress gets the share of a dataset fetched by each call
+        self.prefetch_projects(project_keys, metadata=False)
+        getters = []
+        if definition and from_listing:
+            getters.append(self.get_listed_dataset_summary)
+        elif definition:
+            getters.append(self.get_dataset_summary)
+        if metadata:
+            getters.append(self.get_dataset_description)
+        if metrics:
+            getters.append(self.get_dataset_last_build_date)
+        if usages:
+            getters.append(self.is_source_dataset)
+        calls = []
+        for project_key in project_keys:
+            for dataset_name in self._list_prefetched(self.list_dataset_names, project_key):
+                for getter in getters:
+                    calls.append(lambda getter=getter, project_key=project_key, dataset_name=dataset_name: getter(project_key, dataset_name))
+        self._prefetch(calls, (lambda: on_progress(1.0 / len(getters))) if on_progress is not None and len(getters) > 0 else None)
+
+    def prefetch_ml_task_inputs(self, project_keys):
+        smart_names = []
+        for project_key in project_keys:
+            for ml_task in self._list_prefetched(self.list_project_ml_tasks, project_key):
+                ml_ds_smartname = ml_task.get("inputDataset", "")
+                if len(ml_ds_smartname) > 0:
+                    smart_names.append(split_smart_name(ml_ds_smartname, project_key))
+        self._prefetch([lambda key=key: self.get_dataset_summary(key[0], key[1]) for key in smart_names])
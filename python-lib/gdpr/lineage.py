@@ -0,0 +1,131 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+from collections import deque
+
+
+def _get_recipe_refs(recipe, key):
+    refs = []
+    for role in recipe.get(key, {}).values():
+        for item in role.get("items", []):
+            ref = item.get("ref", "")
+            if len(ref) > 0:
+                refs.append(ref)
+    return refs
+
+
+class LineageGraph(object):
+    """
+    Flow graph of a set of projects, built from the recipe listing and the
+    dataset shares of each project.
+
+    Nodes are (project key, name) tuples in the namespace of the project using
+    them: a foreign dataset read by project B is (B, "A.name"), linked to its
+    source (A, "name") by the sharing rules of project A. Recipes are nodes too,
+    (project key, name, "recipe"), so the graph stays linear in the size of the
+    flows.
+    """
+
+    def __init__(self):
+        self.downstream = {}
+
+    def add_edge(self, source, target):
+        if source not in self.downstream:
+            self.downstream[source] = []
+        self.downstream[source].append(target)
+
+    def get_node(self, project_key, ref):
+        if "." in ref:
+            ref_project_key, name = ref.split(".", 1)
+            if ref_project_key == project_key:
+                return (project_key, name)
+        return (project_key, ref)
+
+    def add_recipe(self, project_key, recipe):
+        recipe_node = (project_key, recipe.get("name", ""), "recipe")
+        for ref in _get_recipe_refs(recipe, "inputs"):
+            self.add_edge(self.get_node(project_key, ref), recipe_node)
+        for ref in _get_recipe_refs(recipe, "outputs"):
+            self.add_edge(recipe_node, self.get_node(project_key, ref))
+
+    def add_dataset_shares(self, project_key, dataset_shares, target_project_keys):
+        for local_name, shared_project_keys in dataset_shares.items():
+            for target_project_key in shared_project_keys:
+                if target_project_key != project_key and target_project_key in target_project_keys:
+                    self.add_edge((project_key, local_name), (target_project_key, project_key + "." + local_name))
+
+    def propagate(self, seeds):
+        """
+        Nodes downstream of the seeds, mapped to the seed they derive from, in
+        one breadth-first traversal
+        """
+        origins = {}
+        queue = deque()
+        for seed in seeds:
+            if seed not in origins:
+                origins[seed] = seed
+                queue.append(seed)
+        while len(queue) > 0:
+            node = queue.popleft()
+            for target in self.downstream.get(node, []):
+                if target not in origins:
+                    origins[target] = origins[node]
+                    queue.append(target)
+        return origins
+
+
+def build_lineage_graph(inventory, project_keys, on_error=None):
+    """
+    Projects whose flow cannot be read are passed to on_error, when given, and
+    left out of the graph
+    """
+    inventory.prefetch_projects(project_keys, metadata=False, settings=True, dataset_names=False, recipes=True)
+    graph = LineageGraph()
+    target_project_keys = set(project_keys)
+    for project_key in project_keys:
+        try:
+            recipes = inventory.list_project_recipes(project_key)
+            dataset_shares = inventory.get_dataset_shares(project_key)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(project_key, e)
+            continue
+        for recipe in recipes:
+            graph.add_recipe(project_key, recipe)
+        graph.add_dataset_shares(project_key, dataset_shares, target_project_keys)
+    return graph
+
+
+def build_lineage_records(inventory, project_keys, on_error=None, from_listing=False):
+    """
+    Datasets derived from a dataset declared with personal data, while they are
+    not declared so themselves. From the listings, the declarations are read from
+    the dataset listings when they carry the GDPR fields.
+    """
+    graph = build_lineage_graph(inventory, project_keys, on_error)
+    declared = []
+    for project_key in project_keys:
+        try:
+            for dataset_name, dataset in inventory.iter_dataset_summaries(project_key, from_listing):
+                declared.append(((project_key, dataset_name), dataset.contains_personal_data))
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(project_key, e)
+
+    origins = graph.propagate([node for node, status in declared if status == "YES"])
+    records = []
+    for node, status in declared:
+        if status != "YES" and node in origins:
+            origin_project_key, origin_name = origins[node]
+            records.append({
+                "project_key": node[0],
+                "dataset": node[1],
+                "declared": status,
+                "inferred": "YES",
+                "origin": origin_project_key + "." + origin_name
+            })
+    return records
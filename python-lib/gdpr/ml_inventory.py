@@ -0,0 +1,165 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import logging
+
+from gdpr.classifier import SchemaClassifier, format_matched_column
+from gdpr.inventory import Memo, get_object_signature, split_smart_name
+from gdpr.model import AnalysisSummary, ModelSummary
+
+logger = logging.getLogger(__name__)
+
+
+def _get_trained_model_snippets(ml_task):
+    # one call for all the trained models of the ML task: without ids, the snippets
+    # of all of them by trained model id, on the dataikuapi versions that have it
+    if not hasattr(ml_task, "get_trained_model_snippet"):
+        return None
+    try:
+        return ml_task.get_trained_model_snippet()
+    except Exception as e:
+        logger.info("Trained model snippets unavailable, falling back to the model details: %s", e)
+        return None
+
+
+def get_last_train_date(inventory, project_key, ml_task):
+    """
+    Latest start time of the trained models of an ML task, taken from their
+    snippets; the details of a model are only fetched when its snippet has no
+    train info
+    """
+    snippets = _get_trained_model_snippets(ml_task)
+    if snippets is None:
+        snippets = dict((trained_model_id, {}) for trained_model_id in ml_task.get_trained_models_ids())
+    max_train_date = 0
+    for trained_model_id, snippet in snippets.items():
+        start_time = snippet.get("trainInfo", {}).get("startTime", 0)
+        if not start_time:
+            # a trained model never changes once trained
+            start_time = inventory.cached("trained_model_start_time", project_key, trained_model_id, "",
+                                          lambda: ml_task.get_trained_model_details(trained_model_id).get_train_info().get("startTime", 0))
+        if start_time / 1000 > max_train_date:
+            max_train_date = start_time / 1000
+    return max_train_date
+
+
+def _find_listed_signature(items, id_field, object_id):
+    for item in items:
+        if item.get(id_field, None) == object_id:
+            return get_object_signature(item)
+    return None
+
+
+class MLInventory(object):
+    """
+    Analyses, ML tasks and saved models of the audited projects, on top of an
+    InstanceInventory: the ML tasks of a project are listed once and shared by
+    the projects counts and the analyses table, each analysis definition, ML
+    task setting and saved model active version is fetched once, and the
+    personal data of the input datasets are resolved once per smart name. The
+    analysis definitions and ML task settings are kept as their compact
+    projections (see gdpr.model).
+
+    With the incremental cache, the analysis definitions, ML task settings and
+    last train dates, and the saved model active versions are stored under the
+    signature of the analysis, ML task or saved model in the listings of its
+    project: training an ML task, or activating a saved model version, saves
+    the object again. Objects listed without tags are always fetched.
+    """
+
+    def __init__(self, inventory, classifier=None):
+        self.inventory = inventory
+        self.classifier = classifier if classifier is not None else SchemaClassifier()
+        self._analysis_definitions = Memo()
+        self._ml_task_settings = Memo()
+        self._last_train_dates = Memo()
+        self._active_versions = Memo()
+        self._input_statuses = Memo()
+        self._input_columns = Memo()
+
+    def list_ml_tasks(self, project_key, analysis_id=None):
+        ml_tasks = self.inventory.list_project_ml_tasks(project_key)
+        if analysis_id is None:
+            return ml_tasks
+        return [ml_task for ml_task in ml_tasks if ml_task.get("analysisId", "") == analysis_id]
+
+    def get_analysis_signature(self, project_key, analysis_id):
+        if self.inventory.cache is None:
+            return None
+        return _find_listed_signature(self.inventory.list_project_analyses(project_key), "analysisId", analysis_id)
+
+    def get_ml_task_signature(self, project_key, analysis_id, ml_task_id):
+        if self.inventory.cache is None:
+            return None
+        return _find_listed_signature(self.list_ml_tasks(project_key, analysis_id), "mlTaskId", ml_task_id)
+
+    def get_saved_model_signature(self, project_key, saved_model_id):
+        if self.inventory.cache is None:
+            return None
+        return _find_listed_signature(self.inventory.list_project_saved_models(project_key), "id", saved_model_id)
+
+    def get_analysis_definition(self, project_key, analysis_id):
+        def load():
+            return AnalysisSummary.from_json(self.inventory.cached(
+                "analysis_summary", project_key, analysis_id, self.get_analysis_signature(project_key, analysis_id),
+                lambda: AnalysisSummary.from_definition(self.inventory.get_project(project_key).get_analysis(analysis_id).get_definition().get_raw()).to_json()))
+        return self._analysis_definitions.get((project_key, analysis_id), load)
+
+    def get_ml_task(self, project_key, analysis_id, ml_task_id):
+        # handles are cheap, only their calls hit the backend
+        return self.inventory.get_project(project_key).get_ml_task(analysis_id, ml_task_id)
+
+    def get_ml_task_settings(self, project_key, analysis_id, ml_task_id):
+        def load():
+            return ModelSummary.from_json(self.inventory.cached(
+                "ml_task_summary", project_key, analysis_id + "/" + ml_task_id, self.get_ml_task_signature(project_key, analysis_id, ml_task_id),
+                lambda: ModelSummary.from_ml_task_settings(self.get_ml_task(project_key, analysis_id, ml_task_id).get_settings().get_raw()).to_json()))
+        return self._ml_task_settings.get((project_key, analysis_id, ml_task_id), load)
+
+    def get_last_train_date(self, project_key, analysis_id, ml_task_id):
+        def load():
+            return self.inventory.cached(
+                "ml_task_last_train_date", project_key, analysis_id + "/" + ml_task_id, self.get_ml_task_signature(project_key, analysis_id, ml_task_id),
+                lambda: get_last_train_date(self.inventory, project_key, self.get_ml_task(project_key, analysis_id, ml_task_id)))
+        return self._last_train_dates.get((project_key, analysis_id, ml_task_id), load)
+
+    def get_saved_model(self, project_key, saved_model_id):
+        return self.inventory.get_project(project_key).get_saved_model(saved_model_id)
+
+    def get_active_version(self, project_key, saved_model_id):
+        """
+        id and trainDate of the active version of a saved model
+        """
+        def load():
+            def fetch():
+                version_info = self.get_saved_model(project_key, saved_model_id).get_active_version()
+                return {"id": version_info.get("id", ""), "trainDate": version_info.get("trainDate", 0)}
+            return self.inventory.cached("saved_model_active_version", project_key, saved_model_id,
+                                         self.get_saved_model_signature(project_key, saved_model_id), fetch)
+        return self._active_versions.get((project_key, saved_model_id), load)
+
+    def get_input_personal_data_status(self, smart_name, project_key):
+        key = split_smart_name(smart_name, project_key)
+        return self._input_statuses.get(key, lambda: self.inventory.get_dataset_summary(key[0], key[1]).contains_personal_data)
+
+    def get_input_personal_data_columns(self, smart_name, project_key):
+        """
+        Columns of an input dataset matching the personal data rules, by name
+        """
+        key = split_smart_name(smart_name, project_key)
+
+        def load():
+            suggestion, matched_columns = self.classifier.classify(self.inventory.get_dataset_summary(key[0], key[1]))
+            return dict(matched_columns)
+        return self._input_columns.get(key, load)
+
+    def get_personal_data_features(self, smart_name, project_key, features):
+        """
+        Features of a model that are personal data columns of its input dataset
+        """
+        if len(smart_name) == 0:
+            return []
+        columns = self.get_input_personal_data_columns(smart_name, project_key)
+        return [format_matched_column((feature[0], columns[feature[0]])) for feature in features if feature[0] in columns]
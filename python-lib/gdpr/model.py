@@ -0,0 +1,260 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import calendar
+import collections
+import re
+import time
+
+import dateutil.parser
+
+# Compact projections of the DSS objects kept in memory during a run: the
+# inventories only keep the fields the report uses, in slotted records, and drop
+# the API payloads as soon as they are projected. The strings that repeat across
+# an instance (column names, types and meanings, connections, groups, GDPR field
+# values) are shared between the records.
+MAX_INTERNED_STRINGS = 500000
+
+_interned = {}
+
+
+def intern_string(value):
+    """
+    Shared copy of a repeated string, or the value itself when it is not hashable
+    """
+    try:
+        interned = _interned.get(value, None)
+    except TypeError:
+        return value
+    if interned is None:
+        if len(_interned) >= MAX_INTERNED_STRINGS:
+            _interned.clear()
+        _interned[value] = value
+        interned = value
+    return interned
+
+
+Column = collections.namedtuple("Column", ["name", "type", "comment", "meaning"])
+
+
+def get_time_dimension(dataset_definition):
+    """
+    (index, period) of the time dimension of a partitioned dataset, or None
+    """
+    dimensions = dataset_definition.get("partitioning", {}).get("dimensions", [])
+    for index, dimension in enumerate(dimensions):
+        if dimension.get("type", "") == "time":
+            return index, intern_string(dimension.get("params", {}).get("period", "DAY"))
+    return None
+
+
+class DatasetSummary(object):
+    """
+    Fields of a dataset definition the report uses. Dates are UTC epoch
+    seconds, 0 when unknown; retention_days is the raw gdpr_retention_days field.
+    """
+
+    __slots__ = ["connection", "contains_personal_data", "purposes", "retention_policy", "legal_consent", "retention_days",
+                 "columns", "created_on", "modified_on", "time_dimension"]
+
+    def __init__(self, connection="", contains_personal_data="UNSURE", purposes="", retention_policy="", legal_consent="",
+                 retention_days=None, columns=(), created_on=0, modified_on=0, time_dimension=None):
+        self.connection = connection
+        self.contains_personal_data = contains_personal_data
+        self.purposes = purposes
+        self.retention_policy = retention_policy
+        self.legal_consent = legal_consent
+        self.retention_days = retention_days
+        self.columns = columns
+        self.created_on = created_on
+        self.modified_on = modified_on
+        self.time_dimension = time_dimension
+
+    @classmethod
+    def from_definition(cls, definition):
+        custom_fields = definition.get("customFields", {})
+        return cls(connection=intern_string(definition.get("params", {}).get("connection", "")),
+                   contains_personal_data=intern_string(custom_fields.get("gdpr_contains_personal_data", "UNSURE")),
+                   purposes=intern_string(custom_fields.get("gdpr_purposes", "")),
+                   retention_policy=intern_string(custom_fields.get("gdpr_retention_policy", "")),
+                   legal_consent=intern_string(custom_fields.get("gdpr_legal_consent", "")),
+                   retention_days=custom_fields.get("gdpr_retention_days", None),
+                   columns=tuple(Column(intern_string(column.get("name", "")), intern_string(column.get("type", "")),
+                                        intern_string(column.get("comment", "")), intern_string(column.get("meaning", "")))
+                                 for column in definition.get("schema", {}).get("columns", [])),
+                   created_on=definition.get("creationTag", {}).get("lastModifiedOn", 0) / 1000,
+                   modified_on=definition.get("versionTag", {}).get("lastModifiedOn", 0) / 1000,
+                   time_dimension=get_time_dimension(definition))
+
+    @classmethod
+    def from_json(cls, value):
+        summary = cls(*value)
+        summary.columns = tuple(Column(*[intern_string(field) for field in column]) for column in summary.columns)
+        summary.time_dimension = tuple(summary.time_dimension) if summary.time_dimension is not None else None
+        return summary
+
+    def to_json(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+
+# DSS writes its dates as UTC ISO 8601 with milliseconds: such strings sort like
+# the dates they hold, and parse without dateutil
+ISO_UTC_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z$")
+MAX_PARSED_DATES = 100000
+
+_parsed_dates = {}
+
+
+def parse_date(value):
+    """
+    UTC epoch seconds of a date string, memoized
+    """
+    timestamp = _parsed_dates.get(value, None)
+    if timestamp is None:
+        if ISO_UTC_DATE.match(value):
+            timestamp = calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+        else:
+            timestamp = calendar.timegm(dateutil.parser.parse(value).timetuple())
+        if len(_parsed_dates) >= MAX_PARSED_DATES:
+            _parsed_dates.clear()
+        _parsed_dates[value] = timestamp
+    return timestamp
+
+
+def get_max_date(values):
+    """
+    Latest of date strings as UTC epoch seconds, 0 when there is none. When
+    all of them are DSS dates, only the latest one is parsed.
+    """
+    if len(values) == 0:
+        return 0
+    if all(ISO_UTC_DATE.match(value) for value in values):
+        return max(0, parse_date(max(values)))
+    return max([0] + [parse_date(value) for value in values])
+
+
+def get_last_build_date(dataset_metrics):
+    """
+    Latest build start date of a dataset, from its last metric values
+    """
+    if "reporting:BUILD_START_DATE" not in dataset_metrics.get_all_ids():
+        return 0
+    return get_max_date([val.get("value", "") for val in dataset_metrics.get_metric_by_id("reporting:BUILD_START_DATE").get("lastValues", [])])
+
+
+def get_features(preprocessing):
+    features = []
+    for feat_name, feat_info in preprocessing.get("per_feature", {}).items():
+        feat_role = feat_info.get("role", "REJECT")
+        if feat_role == "REJECT":
+            continue
+        features.append((intern_string(feat_name), intern_string(feat_role)))
+    return tuple(features)
+
+
+class ModelSummary(object):
+    """
+    Fields of the settings of an ML task, or of the details of a saved model
+    version, the report uses. features are the (name, role) of the features
+    that are not rejected.
+    """
+
+    __slots__ = ["task_type", "prediction_type", "features", "full_model_id"]
+
+    def __init__(self, task_type="", prediction_type="", features=(), full_model_id=""):
+        self.task_type = task_type
+        self.prediction_type = prediction_type
+        self.features = features
+        self.full_model_id = full_model_id
+
+    @classmethod
+    def from_ml_task_settings(cls, settings):
+        return cls(task_type=intern_string(settings.get("taskType", "")),
+                   prediction_type=intern_string(settings.get("predictionType", "")),
+                   features=get_features(settings.get("preprocessing", {})))
+
+    @classmethod
+    def from_version_details(cls, details):
+        return cls(prediction_type=intern_string(details.get("coreParams", {}).get("prediction_type", "")),
+                   features=get_features(details.get("preprocessing", {})),
+                   full_model_id=details.get("smOrigin", {}).get("fullModelId", ""))
+
+    @classmethod
+    def from_json(cls, value):
+        summary = cls(*value)
+        summary.features = tuple((intern_string(name), intern_string(role)) for name, role in summary.features)
+        return summary
+
+    def to_json(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+
+class AnalysisSummary(object):
+    """
+    Fields of the definition of a visual analysis the report uses
+    """
+
+    __slots__ = ["analysis_id", "name", "created_on", "input_dataset"]
+
+    def __init__(self, analysis_id="", name="", created_on=0, input_dataset=""):
+        self.analysis_id = analysis_id
+        self.name = name
+        self.created_on = created_on
+        self.input_dataset = input_dataset
+
+    @classmethod
+    def from_definition(cls, definition):
+        return cls(analysis_id=definition.get("id", ""),
+                   name=definition.get("name", ""),
+                   created_on=definition.get("creationTag", {}).get("lastModifiedOn", 0) / 1000,
+                   input_dataset=intern_string(definition.get("inputDatasetSmartName", "")))
+
+    @classmethod
+    def from_json(cls, value):
+        summary = cls(*value)
+        summary.input_dataset = intern_string(summary.input_dataset)
+        return summary
+
+    def to_json(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+
+def is_source_dataset(dataset_usages):
+    """
+    Whether no recipe outputs to a dataset, from its usages
+    """
+    return len([item for item in dataset_usages if item.get("type", "") == "RECIPE_OUTPUT"]) == 0
+
+
+def get_allowed_groups(permissions):
+    """
+    (read groups, write groups) of a project, from its permissions
+    """
+    read_grps = []
+    write_grps = []
+    for perm in permissions.get("permissions", []):
+        if "group" in perm:
+            if perm.get("writeProjectContent", False):
+                write_grps.append(intern_string(perm.get("group", "")))
+                read_grps.append(intern_string(perm.get("group", "")))
+                continue
+            if perm.get("readProjectContent", False):
+                read_grps.append(intern_string(perm.get("group", "")))
+    return tuple(read_grps), tuple(write_grps)
+
+
+def get_dataset_shares(settings):
+    """
+    Target projects of the datasets a project shares, by dataset name, from the
+    exposed objects of its settings
+    """
+    shares = collections.OrderedDict()
+    for obj in settings.get("exposedObjects", {}).get("objects", []):
+        if obj.get("type", "") != "DATASET":
+            continue
+        local_name = intern_string(obj.get("localName", ""))
+        target_project_keys = tuple(intern_string(rule.get("targetProject", "")) for rule in obj.get("rules", []))
+        shares[local_name] = shares.get(local_name, ()) + target_project_keys
+    return shares
@@ -0,0 +1,134 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+from gdpr.progress import count_listed
+
+# Column groups of the "All objects" tables, each one served by its own API calls:
+#  - datasets: the schema, creation date, GDPR fields and schema-based personal data
+#    suggestion come with the definition, the
+#    other groups cost one call per dataset (usages, metrics, metadata) or per project
+#    (settings for the sharing)
+#  - analyses: the model type and features need the settings of each ML task, the
+#    personal data features also the definition of its input dataset, the last train
+#    date the snippets of its trained models
+#  - saved models: the type and features need the details of the active version, the
+#    personal data features also the definition of the input dataset of its ML task
+DATASET_COLUMNS = ["source", "schema", "creation_date", "last_build_date", "sharing", "description", "gdpr_fields", "pii_suggestion"]
+ANALYSIS_COLUMNS = ["model_settings", "personal_data_features", "last_train_date"]
+SAVED_MODEL_COLUMNS = ["model_details", "personal_data_features", "train_date"]
+
+COLUMN_PRESETS = {
+    "ALL": (DATASET_COLUMNS, ANALYSIS_COLUMNS, SAVED_MODEL_COLUMNS),
+    "GDPR_FIELDS": (["gdpr_fields", "pii_suggestion"], [], [])
+}
+
+
+def _get_selected_columns(config, param_name, all_columns):
+    selected = config.get(param_name, None)
+    if selected is None:
+        return set(all_columns)
+    unknown = [column for column in selected if column not in all_columns]
+    if len(unknown) > 0:
+        raise Exception("Unknown columns in " + param_name + ": " + ", ".join(unknown))
+    return set(selected)
+
+
+class AuditPlan(object):
+    """
+    Sections and columns requested for a GDPR audit, and the minimal set of
+    API calls they need
+    """
+
+    def __init__(self, config):
+        self.include_connections = config.get('includeConnections', True)
+        self.include_projects = config.get('includeProjects', True)
+        include_all_objects = config.get('includeAllObjects', True)
+        self.include_datasets = include_all_objects and config.get('includeDatasets', True)
+        self.include_analyses = include_all_objects and config.get('includeAnalyses', True)
+        self.include_saved_models = include_all_objects and config.get('includeSavedModels', True)
+        self.include_all_objects = self.include_datasets or self.include_analyses or self.include_saved_models
+        # the lineage needs the settings and recipes of every project, it is only
+        # audited when asked for, whatever the columns
+        self.include_lineage = config.get('includeLineage', False)
+        self.include_retention = config.get('includeRetention', False)
+
+        preset = config.get('columnSelection', "ALL")
+        if preset == "CUSTOM":
+            self.dataset_columns = _get_selected_columns(config, 'datasetColumns', DATASET_COLUMNS)
+            self.analysis_columns = _get_selected_columns(config, 'analysisColumns', ANALYSIS_COLUMNS)
+            self.saved_model_columns = _get_selected_columns(config, 'savedModelColumns', SAVED_MODEL_COLUMNS)
+        elif preset in COLUMN_PRESETS:
+            dataset_columns, analysis_columns, saved_model_columns = COLUMN_PRESETS[preset]
+            self.dataset_columns = set(dataset_columns)
+            self.analysis_columns = set(analysis_columns)
+            self.saved_model_columns = set(saved_model_columns)
+        else:
+            raise Exception("Unknown column selection: " + str(preset))
+
+    def get_project_sections(self):
+        """
+        Sections audited project by project, as named in the checkpoints
+        """
+        sections = []
+        if self.include_projects:
+            sections.append("projects")
+        if self.include_all_objects:
+            sections.append("objects")
+        if self.include_retention:
+            sections.append("retention")
+        return sections
+
+    def count_objects(self, inventory, section, project_key, project_keys):
+        """
+        Objects audited by the part of a section about a project, or about all
+        the given projects for the instance-wide sections, from the listings
+        """
+        if section in ["connections", "lineage"]:
+            return len(project_keys) + sum([count_listed(inventory.list_dataset_names, key) for key in project_keys])
+        objects = 1 if section == "projects" else 0
+        if section in ["projects", "retention", "flow"] or (section == "objects" and self.include_datasets):
+            objects += count_listed(inventory.list_dataset_names, project_key)
+        if section == "projects" or (section == "objects" and self.include_analyses):
+            objects += count_listed(inventory.list_project_ml_tasks, project_key)
+        if section == "objects" and self.include_saved_models:
+            objects += count_listed(inventory.list_project_saved_models, project_key)
+        return max(1, objects)
+
+    def has_dataset_column(self, column):
+        return self.include_datasets and column in self.dataset_columns
+
+    def _has_sections(self):
+        return self.include_connections or self.include_projects or self.include_all_objects or self.include_retention or self.include_lineage
+
+    def prefetch_projects(self, inventory, project_keys):
+        """
+        Fans out the per-project calls shared by the sections, including the
+        listings that size the progress, skipping the ones no requested column
+        needs
+        """
+        if not self._has_sections():
+            return
+        inventory.prefetch_projects(project_keys, metadata=self.include_projects or self.include_all_objects,
+                                    permissions=self.include_projects,
+                                    settings=self.has_dataset_column("sharing") or self.include_lineage,
+                                    ml_tasks=self.include_projects or self.include_analyses,
+                                    recipes=self.include_lineage,
+                                    saved_models=self.include_saved_models)
+
+    def prefetch_datasets(self, inventory, project_keys, on_progress=None):
+        """
+        Fans out the per-dataset calls shared by the sections, after the
+        per-project ones. on_progress gets the share of a dataset fetched by
+        each call.
+        """
+        if not self._has_sections():
+            return
+        # the retention checks only fetch the metrics of the non-partitioned datasets
+        # with a retention period, on demand
+        inventory.prefetch_datasets(project_keys, metadata=self.has_dataset_column("description"),
+                                    metrics=self.has_dataset_column("last_build_date"),
+                                    usages=self.has_dataset_column("source"), on_progress=on_progress)
+        if self.include_projects:
+            inventory.prefetch_ml_task_inputs(project_keys)
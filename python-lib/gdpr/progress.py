@@ -0,0 +1,207 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# seconds between two progress log lines
+LOG_INTERVAL = 10.0
+SLOWEST_PROJECTS = 10
+
+
+def count_listed(lister, project_key):
+    """
+    Length of a listing of a project, 0 when it fails: the failure is reported
+    by the part of the report reading it
+    """
+    try:
+        return len(lister(project_key))
+    except Exception:
+        return 0
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, (seconds % 3600) // 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+class _Phase(object):
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.duration = 0.0
+        self.objects = 0
+
+
+class ProgressTracker(object):
+    """
+    Progress of a run in audited objects (projects, datasets, ML tasks, saved
+    models): the parts of the report are sized up front from the listings, and
+    each completed part advances the progress by its objects. DSS gets the
+    percentage, the logs also get the throughput and the estimated time left.
+    Long parts, such as the prefetch, also advance while they run.
+
+    The run is split into phases, the sections of the ApiProfiler when given,
+    timed along with each project. Parts are completed one after the other: the
+    time of a part is the time since the previous one completed. The parts about
+    the whole instance, under instance_key, are left out of the project timings.
+    """
+
+    def __init__(self, progress_callback, profiler=None, instance_key=None, log_interval=LOG_INTERVAL):
+        self.progress_callback = progress_callback
+        self.profiler = profiler
+        self.instance_key = instance_key
+        self.log_interval = log_interval
+        self.total = 0
+        self.done = 0
+        self.phases = []
+        self.project_durations = {}
+        self.project_objects = {}
+        self._parts = {}
+        self._part_objects = {}
+        self._start = time.time()
+        self._last_part = self._start
+        self._last_log = self._start
+        self._reported_step = -1
+        self._lock = threading.Lock()
+
+    def start_phase(self, name):
+        now = time.time()
+        with self._lock:
+            self._end_phase(now)
+            self.phases.append(_Phase(name, now))
+            self._last_part = now
+        if self.profiler is not None:
+            self.profiler.set_section(name)
+
+    def _end_phase(self, now):
+        if len(self.phases) > 0:
+            self.phases[-1].duration = now - self.phases[-1].start
+
+    def add_part(self, section, project_key, objects):
+        """
+        Objects of a part left to audit, counted in the total
+        """
+        with self._lock:
+            self._parts[(section, project_key)] = objects
+            self._part_objects[(section, project_key)] = objects
+            self.total += objects
+
+    def advance_part(self, section, project_key, objects):
+        """
+        Advances by some of the objects of a part while it runs, from any thread
+        """
+        with self._lock:
+            remaining = self._parts.get((section, project_key), None)
+            if remaining is None:
+                return
+            objects = min(objects, remaining)
+            self._parts[(section, project_key)] = remaining - objects
+            self._advance(objects)
+        self._report()
+
+    def complete_part(self, section, project_key):
+        """
+        Advances by the objects left of a part, parts left out of the total (such
+        as the ones replayed from a checkpoint) only restart the clock
+        """
+        now = time.time()
+        with self._lock:
+            objects = self._parts.pop((section, project_key), None)
+            duration = now - self._last_part
+            self._last_part = now
+            if objects is None:
+                return
+            self._advance(objects)
+            part_objects = self._part_objects.pop((section, project_key))
+            if project_key != self.instance_key:
+                self.project_durations[project_key] = self.project_durations.get(project_key, 0.0) + duration
+                self.project_objects[project_key] = self.project_objects.get(project_key, 0) + part_objects
+        self._report()
+
+    def _advance(self, objects):
+        self.done += objects
+        if len(self.phases) > 0:
+            self.phases[-1].objects += objects
+
+    def _report(self):
+        now = time.time()
+        with self._lock:
+            percent = (100.0 * self.done / self.total) if self.total > 0 else 100.0
+            # DSS only gets the steps of a tenth of percent, in order
+            step = int(10 * percent)
+            if step > self._reported_step:
+                self._reported_step = step
+                self.progress_callback(percent)
+            log_now = now - self._last_log >= self.log_interval or self.done >= self.total
+            if log_now:
+                self._last_log = now
+        if log_now:
+            logger.info("Progress: %s", self.get_label())
+
+    def get_rate(self):
+        elapsed = time.time() - self._start
+        return (self.done / elapsed) if elapsed > 0 else 0.0
+
+    def get_label(self):
+        """
+        Objects done, throughput and estimated time left, such as
+        "1200 / 5000 objects (24%), 15.2 objects/s, 4m10s left"
+        """
+        rate = self.get_rate()
+        label = "%d / %d objects" % (self.done, self.total)
+        if self.total > 0:
+            label += " (%d%%)" % (100 * self.done // self.total)
+        label += ", %.1f objects/s" % rate
+        if rate > 0 and self.done < self.total:
+            label += ", " + format_duration((self.total - self.done) / rate) + " left"
+        return label
+
+    def finish(self):
+        with self._lock:
+            self._end_phase(time.time())
+        self.progress_callback(100)
+
+    def get_slowest_projects(self):
+        projects = sorted(self.project_durations.items(), key=lambda item: -item[1])
+        return [(project_key, duration, self.project_objects[project_key]) for project_key, duration in projects[:SLOWEST_PROJECTS]]
+
+    def log_summary(self, macro):
+        for phase in self.phases:
+            logger.info("Run timing %s", json.dumps({"macro": macro, "phase": phase.name, "duration_s": round(phase.duration, 3),
+                                                     "objects": int(round(phase.objects))}, sort_keys=True))
+        for project_key, duration, objects in self.get_slowest_projects():
+            logger.info("Run timing %s", json.dumps({"macro": macro, "project_key": project_key, "duration_s": round(duration, 3),
+                                                     "objects": objects}, sort_keys=True))
+
+    def get_summary_html(self):
+        html = "<h3>Run timings</h3>" \
+            + "<p>" + ("%d" % self.done) + " objects in " + format_duration(time.time() - self._start) + " (" \
+            + ("%.1f" % self.get_rate()) + " objects/s)</p>" \
+            + "<table><thead><tr><th>Phase</th><th>Duration (s)</th><th>Objects</th><th>Objects/s</th></tr></thead><tbody>"
+        for phase in self.phases:
+            html += "<tr>" \
+                + "<td>" + phase.name + "</td>" \
+                + "<td>" + ("%.1f" % phase.duration) + "</td>" \
+                + "<td>" + ("%d" % phase.objects) + "</td>" \
+                + "<td>" + (("%.1f" % (phase.objects / phase.duration)) if phase.duration > 0 and phase.objects > 0 else "") + "</td>" \
+                + "</tr>"
+        html += "</tbody></table>"
+        slowest_projects = self.get_slowest_projects()
+        if len(slowest_projects) > 0:
+            html += "<h4>Slowest projects</h4>" \
+                + "<table><thead><tr><th>Project</th><th>Duration (s)</th><th>Objects</th></tr></thead><tbody>"
+            for project_key, duration, objects in slowest_projects:
+                html += "<tr><td>" + project_key + "</td><td>" + ("%.1f" % duration) + "</td><td>" + str(objects) + "</td></tr>"
+            html += "</tbody></table>"
+        return html
@@ -0,0 +1,277 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import logging
+import re
+
+from gdpr.classifier import SchemaClassifier, format_matched_column
+from gdpr.ml_inventory import MLInventory
+from gdpr.model import ModelSummary
+
+logger = logging.getLogger(__name__)
+
+# Typed records of the audit sections, as plain dicts. Dates are UTC epoch
+# seconds, 0 when unknown. The builders take the requested column groups (see
+# gdpr.planner, all of them by default): the fields of the other groups are left
+# to None, without fetching what they need.
+
+
+def format_feature(feature):
+    return feature[0] + ((" (" + feature[1] + ")") if feature[1] != "INPUT" else "")
+
+
+def get_connection_host(conn):
+    if "host" in conn.get("params", {}):
+        return conn.get("params", {}).get("host", "") + ":" + str(conn.get("params", {}).get("port", ""))
+    elif "jdbcurl" in conn.get("params", {}):
+        m = re.match(".*:\\/\\/([^\\/]*)\\/.*", conn.get("params", {}).get("jdbcurl", ""))
+        return m.group(1) if m is not None else ""
+    return ""
+
+
+def build_connection_records(connections, inventory, project_keys):
+    # prebuild the dataset per connection map
+    datasets_per_conn = {}
+    for project_key in project_keys:
+        for dataset_name, dataset in inventory.iter_dataset_summaries(project_key):
+            dataset_conn = dataset.connection
+            has_pers_data = dataset.contains_personal_data
+            if has_pers_data != "NO":
+                if not dataset_conn in datasets_per_conn:
+                    datasets_per_conn[dataset_conn] = []
+                datasets_per_conn[dataset_conn].append(project_key + "." + dataset_name + " (" + has_pers_data + ")")
+
+    records = []
+    for conn_name, conn in connections.items():
+        readability = conn.get("detailsReadability", {})
+        records.append({
+            "connection": conn_name,
+            "type": conn.get("type", ""),
+            "host": get_connection_host(conn),
+            "readable_by": readability.get("readableBy", "NONE"),
+            "read_groups": readability.get("allowedGroups", []),
+            "usable_by": conn.get("usableBy", "ALL"),
+            "usage_groups": conn.get("allowedGroups", []),
+            "personal_data_datasets": datasets_per_conn.get(conn_name, [])
+        })
+    return records
+
+
+def build_project_record(inventory, project_key, ml_inventory=None):
+    ml_inventory = ml_inventory if ml_inventory is not None else MLInventory(inventory)
+    project_metadata = inventory.get_project_metadata(project_key)
+    custom_fields = project_metadata.get("customFields", {})
+    read_grps, write_grps = inventory.get_project_groups(project_key)
+
+    # dataset counts
+    ds_yes = 0
+    ds_unsure = 0
+    ds_no = 0
+    ds_total = 0
+    for dataset_name, dataset in inventory.iter_dataset_summaries(project_key):
+        ds_total += 1
+        has_pers_data = dataset.contains_personal_data
+        if has_pers_data == "YES":
+            ds_yes += 1
+        elif has_pers_data == "UNSURE":
+            ds_unsure += 1
+        elif has_pers_data == "NO":
+            ds_no += 1
+
+    # model counts
+    count_mlt_total = 0
+    count_mlt_pers_data = 0
+    for ml_task in ml_inventory.list_ml_tasks(project_key):
+        count_mlt_total += 1
+        ml_ds_smartname = ml_task.get("inputDataset", "")
+        if len(ml_ds_smartname) > 0:
+            if ml_inventory.get_input_personal_data_status(ml_ds_smartname, project_key) != "NO":
+                count_mlt_pers_data += 1
+
+    return {
+        "project_key": project_key,
+        "project_label": project_metadata.get("label", project_key),
+        "read_groups": list(read_grps),
+        "write_groups": list(write_grps),
+        "forbid_dataset_sharing": custom_fields.get("gdpr_forbid_dataset_sharing", False),
+        "forbid_dataset_export": custom_fields.get("gdpr_forbid_dataset_export", False),
+        "forbid_model_creation": custom_fields.get("gdpr_forbid_model_creation", False),
+        "forbid_uploaded_datasets": custom_fields.get("gdpr_forbid_uploaded_datasets", False),
+        "forbidden_connections": custom_fields.get("gdpr_forbidden_connections", []),
+        "datasets_personal_data": ds_yes,
+        "datasets_unsure": ds_unsure,
+        "datasets_no_personal_data": ds_no,
+        "datasets_total": ds_total,
+        "ml_tasks_personal_data": count_mlt_pers_data,
+        "ml_tasks_total": count_mlt_total
+    }
+
+
+def build_dataset_records(inventory, project_key, columns=None, classifier=None):
+    def has(column):
+        return columns is None or column in columns
+
+    if has("pii_suggestion") and classifier is None:
+        classifier = SchemaClassifier()
+
+    dataset_shares = inventory.get_dataset_shares(project_key) if has("sharing") else {}
+    records = []
+    for dataset_name, dataset in inventory.iter_dataset_summaries(project_key):
+        record = {
+            "project_key": project_key,
+            "dataset": dataset_name,
+            "is_source": None,
+            "columns": [],
+            "creation_date": None,
+            "last_build_date": None,
+            "shared_with_projects": None,
+            "description": None,
+            "contains_personal_data": None,
+            "purposes": None,
+            "retention_policy": None,
+            "legal_consent": None,
+            "suggested_personal_data": None,
+            "personal_data_columns": None
+        }
+
+        if has("source"):
+            record["is_source"] = inventory.is_source_dataset(project_key, dataset_name)
+        if has("schema"):
+            record["columns"] = [{
+                "name": column.name,
+                "type": column.type,
+                "comment": column.comment,
+                "meaning": column.meaning
+            } for column in dataset.columns]
+        if has("creation_date"):
+            record["creation_date"] = dataset.created_on
+        if has("last_build_date"):
+            record["last_build_date"] = inventory.get_dataset_last_build_date(project_key, dataset_name)
+        if has("sharing"):
+            record["shared_with_projects"] = [target_prj for target_prj in dataset_shares.get(dataset_name, ()) if target_prj != ""]
+        if has("description"):
+            record["description"] = inventory.get_dataset_description(project_key, dataset_name)
+        if has("gdpr_fields"):
+            record["contains_personal_data"] = dataset.contains_personal_data
+            record["purposes"] = dataset.purposes
+            record["retention_policy"] = dataset.retention_policy
+            record["legal_consent"] = dataset.legal_consent
+        if has("pii_suggestion"):
+            suggestion, matched_columns = classifier.classify(dataset)
+            record["suggested_personal_data"] = suggestion
+            record["personal_data_columns"] = [format_matched_column(matched_column) for matched_column in matched_columns]
+        records.append(record)
+    return records
+
+
+def load_analysis_record(inventory, project_key, analysis_id, columns=None, ml_inventory=None):
+    def has(column):
+        return columns is None or column in columns
+
+    ml_inventory = ml_inventory if ml_inventory is not None else MLInventory(inventory)
+    analysis_definition = ml_inventory.get_analysis_definition(project_key, analysis_id)
+    ml_tasks = []
+    for analysis_ml_task in ml_inventory.list_ml_tasks(project_key, analysis_id):
+        ml_task_id = analysis_ml_task.get("mlTaskId", "")
+        ml_task_record = {
+            "ml_task_id": ml_task_id,
+            "task_type": None,
+            "prediction_type": None,
+            "features": None,
+            "personal_data_features": None,
+            "last_train_date": None
+        }
+        if has("model_settings") or has("personal_data_features"):
+            ml_task_settings = ml_inventory.get_ml_task_settings(project_key, analysis_id, ml_task_id)
+            features = list(ml_task_settings.features)
+            if has("model_settings"):
+                ml_task_record["task_type"] = ml_task_settings.task_type
+                ml_task_record["prediction_type"] = ml_task_settings.prediction_type if ml_task_settings.task_type == "PREDICTION" else ""
+                ml_task_record["features"] = features
+            if has("personal_data_features"):
+                input_dataset = analysis_ml_task.get("inputDataset", "") or analysis_definition.input_dataset
+                ml_task_record["personal_data_features"] = ml_inventory.get_personal_data_features(input_dataset, project_key, features)
+        if has("last_train_date"):
+            ml_task_record["last_train_date"] = ml_inventory.get_last_train_date(project_key, analysis_id, ml_task_id)
+        ml_tasks.append(ml_task_record)
+    return {
+        "project_key": project_key,
+        "analysis_id": analysis_definition.analysis_id,
+        "name": analysis_definition.name,
+        "creation_date": analysis_definition.created_on,
+        "dataset": analysis_definition.input_dataset,
+        "ml_tasks": ml_tasks
+    }
+
+
+def build_analysis_records(inventory, project_key, columns=None, ml_inventory=None):
+    ml_inventory = ml_inventory if ml_inventory is not None else MLInventory(inventory)
+    analysis_ids = [analysis_info.get("analysisId", "") for analysis_info in inventory.list_project_analyses(project_key)]
+    return inventory.fetcher.map(lambda analysis_id: load_analysis_record(inventory, project_key, analysis_id, columns, ml_inventory), analysis_ids)
+
+
+def load_saved_model_record(inventory, project_key, saved_model_info, columns=None, ml_inventory=None):
+    def has(column):
+        return columns is None or column in columns
+
+    ml_inventory = ml_inventory if ml_inventory is not None else MLInventory(inventory)
+    saved_model_id = saved_model_info.get("id", "")
+    saved_model_type = saved_model_info.get("type", "")
+    record = {
+        "project_key": project_key,
+        "saved_model_id": saved_model_id,
+        "name": saved_model_info.get("name", ""),
+        "type": saved_model_type,
+        "prediction_type": None,
+        "version_id": None,
+        "features": None,
+        "personal_data_features": None,
+        "original_analysis_id": None,
+        "train_date": None
+    }
+    if not (has("model_details") or has("personal_data_features") or has("train_date")):
+        return record
+
+    saved_model_version_info = ml_inventory.get_active_version(project_key, saved_model_id)
+    saved_model_version_id = saved_model_version_info.get("id", "")
+    record["version_id"] = saved_model_version_id
+    if has("train_date"):
+        record["train_date"] = saved_model_version_info.get("trainDate", 0) / 1000
+    if has("model_details") or has("personal_data_features"):
+        # a saved model version never changes once trained
+        saved_model = ml_inventory.get_saved_model(project_key, saved_model_id)
+        saved_model_version = ModelSummary.from_json(inventory.cached(
+            "saved_model_summary", project_key, saved_model_id + "/" + saved_model_version_id, "",
+            lambda: ModelSummary.from_version_details(saved_model.get_version_details(saved_model_version_id).details).to_json()))
+
+        original_analysis_id = ""
+        original_ml_task_id = ""
+        full_model_id = saved_model_version.full_model_id
+        if full_model_id != "":
+            full_model_id_parts = full_model_id.split("-")
+            if len(full_model_id_parts) > 2:
+                original_analysis_id = full_model_id_parts[2]
+            if len(full_model_id_parts) > 3:
+                original_ml_task_id = full_model_id_parts[3]
+        features = list(saved_model_version.features)
+
+        if has("model_details"):
+            record["prediction_type"] = saved_model_version.prediction_type if saved_model_type == "PREDICTION" else ""
+            record["features"] = features
+            record["original_analysis_id"] = original_analysis_id
+        if has("personal_data_features"):
+            # trained on the input dataset of the ML task it comes from, when it is still there
+            input_datasets = [ml_task.get("inputDataset", "") for ml_task in ml_inventory.list_ml_tasks(project_key, original_analysis_id)
+                              if ml_task.get("mlTaskId", "") == original_ml_task_id] if original_analysis_id != "" else []
+            record["personal_data_features"] = ml_inventory.get_personal_data_features(input_datasets[0] if len(input_datasets) > 0 else "",
+                                                                                      project_key, features)
+    return record
+
+
+def build_saved_model_records(inventory, project_key, columns=None, ml_inventory=None):
+    ml_inventory = ml_inventory if ml_inventory is not None else MLInventory(inventory)
+    saved_model_infos = inventory.list_project_saved_models(project_key)
+    return inventory.fetcher.map(lambda saved_model_info: load_saved_model_record(inventory, project_key, saved_model_info, columns, ml_inventory),
+                                 saved_model_infos)
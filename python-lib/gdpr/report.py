@@ -0,0 +1,296 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import json
+from datetime import datetime
+
+import dataiku
+
+from gdpr.inventory import split_smart_name
+
+DEFAULT_PREVIEW_MAX_SIZE_MB = 20
+
+HTML_HEADER = "<html><head><style>" \
+    + "h3 { margin-top: 1em; } " \
+    + "table { border-collapse: collapse; } " \
+    + "thead { font-weight: bold; } " \
+    + "table, th, td { border: 1px solid black; }" \
+    + "</style></head><body>"
+
+HTML_FOOTER = "</body></html>"
+
+REPORT_LAYOUTS = ["SINGLE", "PAGED"]
+SEARCH_INDEX_FILE = "search-index.json"
+SEARCH_INDEX_FIELDS = ["type", "project", "name", "page", "keywords"]
+MAX_SEARCH_RESULTS = 100
+
+# the search index is embedded in the index page, as the entries of each page
+# are written, and the pages are plain relative links: the report needs no
+# request to work from a copy of the report folder, opened from the disk
+PAGED_REPORT_SCRIPT = "<script>" \
+    + "var gdprIndex = [];" \
+    + "function gdprAdd(page, entries) {" \
+    + " for (var i = 0; i < entries.length; i++) { gdprIndex.push([entries[i][0], entries[i][1], entries[i][2], page]); } }" \
+    + "function gdprSearch() {" \
+    + " var query = document.getElementById('gdpr-search').value.toLowerCase(), results = document.getElementById('gdpr-search-results');" \
+    + " results.innerHTML = '';" \
+    + " if (query.length < 2) { return; }" \
+    + " var count = 0;" \
+    + " for (var i = 0; i < gdprIndex.length && count < " + str(MAX_SEARCH_RESULTS) + "; i++) {" \
+    + "  var entry = gdprIndex[i];" \
+    + "  if ((entry[2] + ' ' + entry[1] + ' ' + entry[0]).toLowerCase().indexOf(query) < 0) { continue; }" \
+    + "  var item = document.createElement('li'), link = document.createElement('a');" \
+    + "  link.href = entry[3] || '#'; link.textContent = entry[0] + ' ' + (entry[1] ? entry[1] + '.' : '') + entry[2];" \
+    + "  item.appendChild(link); results.appendChild(item); count++; } }" \
+    + "</script>"
+
+PAGED_REPORT_SEARCH = "<p>Search: <input id=\"gdpr-search\" type=\"text\" oninput=\"gdprSearch()\"/> " \
+    + "(names of the datasets, analyses, saved models and projects, at most " + str(MAX_SEARCH_RESULTS) + " results, " \
+    + "the columns are in " + SEARCH_INDEX_FILE + ")</p>" \
+    + "<ul id=\"gdpr-search-results\"></ul>"
+
+
+def get_preview_max_size(config):
+    try:
+        value = int(config.get("previewMaxSizeMb", DEFAULT_PREVIEW_MAX_SIZE_MB))
+    except (TypeError, ValueError):
+        value = DEFAULT_PREVIEW_MAX_SIZE_MB
+    return max(1, value) * 1024 * 1024
+
+
+class EncodingSink(object):
+    """
+    Buffered text sink on top of a binary stream, such as a managed folder writer
+    """
+
+    def __init__(self, stream, buffer_size=1024 * 1024):
+        self._stream = stream
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            self._stream.write("".join(self._buffer).encode("utf-8"))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._stream.close()
+
+
+class HTMLReportWriter(object):
+    """
+    Streams a report to a sink as it is rendered, so memory stays flat whatever
+    the size of the instance.
+
+    Only the beginning of the report is kept in memory, as the preview returned
+    by the macro. Without a preview max size, the whole report is kept.
+    """
+
+    def __init__(self, sink=None, preview_max_size=DEFAULT_PREVIEW_MAX_SIZE_MB * 1024 * 1024):
+        self.sink = sink
+        self.preview_max_size = preview_max_size
+        self.size = 0
+        self.truncated = False
+        self._preview = []
+        self._preview_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def write(self, *parts):
+        for part in parts:
+            if self.sink is not None:
+                self.sink.write(part)
+            self.size += len(part)
+            if not self.truncated:
+                if self.preview_max_size is None or self._preview_size + len(part) <= self.preview_max_size:
+                    self._preview.append(part)
+                    self._preview_size += len(part)
+                else:
+                    self.truncated = True
+
+    # pages and records only matter to the paged reports
+    def start_page(self, path, title):
+        pass
+
+    def end_page(self):
+        pass
+
+    def write_records(self, section, project_key, records):
+        pass
+
+    def get_preview(self, note=""):
+        if not self.truncated:
+            return "".join(self._preview)
+        return "".join(self._preview) \
+            + "<p><b>The report has been truncated to its first " + str(self._preview_size) + " characters out of " + str(self.size) + ".</b> " \
+            + note + "</p>" + HTML_FOOTER
+
+
+class PagedReportWriter(HTMLReportWriter):
+    """
+    HTMLReportWriter splitting a report into a folder: an index page with the
+    summary tables, and separate pages, such as one per project, linked from the
+    index. A search index lists the objects of all the pages, from the records
+    of the report: in full, with their keywords such as the column names, as a
+    JSON file for other tools, and without the keywords in the index page, so
+    that the index page does not grow with the columns of the instance.
+
+    The preview is the index page. The links and the search only work once the
+    report folder is downloaded, the macro result does not resolve the pages.
+    """
+
+    def __init__(self, folder, directory, preview_max_size=DEFAULT_PREVIEW_MAX_SIZE_MB * 1024 * 1024, search_entries=None):
+        HTMLReportWriter.__init__(self, EncodingSink(folder.get_writer(directory + "/index.html")), preview_max_size)
+        self.folder = folder
+        self.directory = directory
+        self.search_entries = search_entries
+        self.page_count = 0
+        self._page = None
+        self._page_path = ""
+        self._search_count = 0
+        self._search_sink = EncodingSink(folder.get_writer(directory + "/" + SEARCH_INDEX_FILE))
+        self._search_sink.write("{\"fields\": " + json.dumps(SEARCH_INDEX_FIELDS) + ", \"entries\": [")
+        self._script_written = False
+
+    def _write_script(self):
+        if not self._script_written:
+            HTMLReportWriter.write(self, PAGED_REPORT_SCRIPT)
+            self._script_written = True
+
+    def start_page(self, path, title):
+        if self._page is not None:
+            self.end_page()
+        if self.page_count == 0:
+            self._write_script()
+            HTMLReportWriter.write(self, PAGED_REPORT_SEARCH)
+        HTMLReportWriter.write(self, "<p><a href=\"", path, "\">", title, "</a></p>")
+        # the pages are not previewed
+        self._page = HTMLReportWriter(EncodingSink(self.folder.get_writer(self.directory + "/" + path)), 0)
+        self._page.write(HTML_HEADER)
+        self._page_path = path
+        self.page_count += 1
+
+    def end_page(self):
+        if self._page is None:
+            return
+        self._page.write(HTML_FOOTER)
+        self._page.close()
+        self._page = None
+        self._page_path = ""
+
+    def write(self, *parts):
+        if self._page is not None:
+            self._page.write(*parts)
+        else:
+            HTMLReportWriter.write(self, *parts)
+
+    def write_records(self, section, project_key, records):
+        if self.search_entries is None or self._search_sink is None:
+            return
+        page_entries = []
+        for object_type, object_project_key, name, keywords in self.search_entries(section, records):
+            entry = [object_type, object_project_key, name, self._page_path, keywords]
+            self._search_sink.write(("," if self._search_count > 0 else "") + json.dumps(entry))
+            self._search_count += 1
+            page_entries.append([object_type, object_project_key, name])
+        if len(page_entries) == 0:
+            return
+        # written to the index page, whatever the page being written
+        self._write_script()
+        HTMLReportWriter.write(self, "<script>gdprAdd(", json.dumps(self._page_path), ", ",
+                               json.dumps(page_entries).replace("</", "<\\/"), ");</script>")
+
+    def close(self):
+        self.end_page()
+        if self._search_sink is not None:
+            self._search_sink.write("]}")
+            self._search_sink.close()
+            self._search_sink = None
+        HTMLReportWriter.close(self)
+
+
+class HTMLFragment(object):
+    """
+    Part of a report rendered in memory, written to the report in one go once
+    complete
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, *parts):
+        self._parts.extend(parts)
+
+    def get_html(self):
+        return "".join(self._parts)
+
+
+class ReportOutput(object):
+    """
+    Where a macro streams its report: the configured report folder, if any,
+    and the preview returned as the macro result
+    """
+
+    def __init__(self, default_project_key, config, prefix, search_entries=None):
+        self.folder_project_key = None
+        self.folder_id = None
+        self.path = None
+        layout = config.get("reportLayout", "SINGLE")
+        if layout not in REPORT_LAYOUTS:
+            raise Exception("Unknown report layout: " + str(layout))
+        folder_ref = config.get("reportFolder", None)
+        if folder_ref is None or len(folder_ref) == 0:
+            if layout == "PAGED":
+                raise Exception("Select a report folder to write a paged report")
+            # the macro result is the only copy of the report, it is never truncated
+            self.report = HTMLReportWriter(None, None)
+            return
+        self.folder_project_key, self.folder_id = split_smart_name(folder_ref, default_project_key)
+        folder = dataiku.Folder(self.folder_id, project_key=self.folder_project_key)
+        name = prefix + "-" + datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        if layout == "PAGED":
+            self.path = name + "/index.html"
+            self.report = PagedReportWriter(folder, name, get_preview_max_size(config), search_entries)
+        else:
+            self.path = name + ".html"
+            self.report = HTMLReportWriter(EncodingSink(folder.get_writer(self.path)), get_preview_max_size(config))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.report.close()
+
+    def get_link(self):
+        return "<a href=\"/projects/" + self.folder_project_key + "/managedfolder/" + self.folder_id + "/view/\" target=\"_blank\">" \
+            + self.folder_project_key + "." + self.folder_id + "/" + self.path + "</a>"
+
+    def finalize(self):
+        self.report.write(HTML_FOOTER)
+        self.report.close()
+        if self.path is None:
+            return self.report.get_preview()
+        if self.report.truncated:
+            return self.report.get_preview("The full report is available in " + self.get_link() + ".")
+        preview = self.report.get_preview()
+        return preview[:-len(HTML_FOOTER)] + "<p>Report saved to " + self.get_link() + ".</p>" + HTML_FOOTER
@@ -0,0 +1,187 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import calendar
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIME_BUDGET = 300
+
+# retention periods written as "90 days", "6 months", "1 year" or ISO 8601 "P1Y6M"
+PERIOD_DAYS = {"d": 1, "w": 7, "m": 30, "y": 365}
+RETENTION_PERIOD = re.compile(r"^\s*(\d+)\s*(days?|d|weeks?|w|months?|m|years?|y)\s*$", re.IGNORECASE)
+ISO_PERIOD = re.compile(r"^\s*P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?\s*$", re.IGNORECASE)
+
+# a time partition holds the data of its whole period, it expires with its end
+PARTITION_PERIODS = {"YEAR": 1, "MONTH": 2, "DAY": 3, "HOUR": 4}
+
+
+def parse_retention_period(text):
+    """
+    Retention period in days of a free-text policy, None when it is not a period
+    """
+    if text is None:
+        return None
+    match = RETENTION_PERIOD.match(str(text))
+    if match is not None:
+        return int(match.group(1)) * PERIOD_DAYS[match.group(2)[0].lower()]
+    match = ISO_PERIOD.match(str(text))
+    if match is not None and any(match.groups()):
+        years, months, weeks, days = [int(group) if group else 0 for group in match.groups()]
+        return years * 365 + months * 30 + weeks * 7 + days
+    return None
+
+
+def get_retention_days(dataset):
+    """
+    Retention in days of a dataset summary: the structured gdpr_retention_days
+    field, otherwise its retention policy when it reads as a period
+    """
+    try:
+        days = int(dataset.retention_days or 0)
+    except (TypeError, ValueError):
+        days = 0
+    if days > 0:
+        return days
+    return parse_retention_period(dataset.retention_policy)
+
+
+def get_partition_end(partition_id, dimension_index, period):
+    """
+    UTC epoch seconds of the end of the period of a time partition, None when
+    its identifier does not read as a date
+    """
+    values = partition_id.split("|")
+    if dimension_index >= len(values) or period not in PARTITION_PERIODS:
+        return None
+    try:
+        parts = [int(part) for part in values[dimension_index].split("-")]
+        if len(parts) != PARTITION_PERIODS[period]:
+            return None
+        if period == "YEAR":
+            end = datetime(parts[0] + 1, 1, 1)
+        elif period == "MONTH":
+            end = datetime(parts[0] + parts[1] // 12, parts[1] % 12 + 1, 1)
+        elif period == "DAY":
+            end = datetime(parts[0], parts[1], parts[2]) + timedelta(days=1)
+        else:
+            end = datetime(parts[0], parts[1], parts[2], parts[3]) + timedelta(hours=1)
+    except ValueError:
+        return None
+    return calendar.timegm(end.timetuple())
+
+
+class RetentionChecker(object):
+    """
+    Compares the data of the datasets to their retention period, from metadata
+    only: the partition identifiers of the datasets partitioned by time, the last
+    build date of the others, or their last modification when never built.
+
+    The checks of a run share a time budget, the datasets left once it is spent
+    are reported as not checked.
+    """
+
+    def __init__(self, inventory, time_budget=DEFAULT_TIME_BUDGET, now=None):
+        self.inventory = inventory
+        self.time_budget = time_budget
+        self.now = now if now is not None else time.time()
+        self.skipped = 0
+        self._deadline = None
+        self._lock = threading.Lock()
+
+    def _is_over_budget(self):
+        with self._lock:
+            if self._deadline is None:
+                self._deadline = time.time() + self.time_budget
+            if time.time() <= self._deadline:
+                return False
+            if self.skipped == 0:
+                logger.warning("Retention time budget of %ss exceeded, the remaining datasets are not checked", self.time_budget)
+            self.skipped += 1
+            return True
+
+    def _check_partitions(self, project_key, dataset_name, time_dimension, limit):
+        dimension_index, period = time_dimension
+        partition_ids = self.inventory.get_dataset_partitions(project_key, dataset_name)
+        expired = []
+        undated = 0
+        for partition_id in partition_ids:
+            end = get_partition_end(partition_id, dimension_index, period)
+            if end is None:
+                undated += 1
+            elif end <= limit:
+                expired.append(partition_id)
+        detail = str(len(expired)) + " of " + str(len(partition_ids)) + " partitions expired"
+        if undated > 0:
+            detail += ", " + str(undated) + " without date"
+        return ("EXPIRED" if len(expired) > 0 else "OK"), detail, len(partition_ids), sorted(expired)
+
+    def _check_dates(self, project_key, dataset_name, dataset, limit):
+        reference_date = self.inventory.get_dataset_last_build_date(project_key, dataset_name)
+        detail = "last built "
+        if reference_date == 0:
+            reference_date = dataset.modified_on
+            detail = "last modified "
+        if reference_date == 0:
+            return "UNKNOWN", "no build or modification date", None, []
+        detail += datetime.utcfromtimestamp(reference_date).strftime('%Y-%m-%d')
+        return ("EXPIRED" if reference_date <= limit else "OK"), detail, None, []
+
+    def check(self, project_key, dataset_name, dataset):
+        """
+        Retention record of a dataset summary, None for the datasets without
+        personal data nor retention period
+        """
+        status = dataset.contains_personal_data
+        retention_days = get_retention_days(dataset)
+        if retention_days is None and status == "NO":
+            return None
+        record = {
+            "project_key": project_key,
+            "dataset": dataset_name,
+            "contains_personal_data": status,
+            "retention_policy": dataset.retention_policy,
+            "retention_days": retention_days,
+            "partitions": None,
+            "expired_partitions": [],
+            "status": "NO_POLICY",
+            "detail": ""
+        }
+        if retention_days is None:
+            return record
+        if self._is_over_budget():
+            record["status"] = "NOT_CHECKED"
+            record["detail"] = "time budget exceeded"
+            return record
+        limit = self.now - retention_days * 86400
+        try:
+            if dataset.time_dimension is not None:
+                result = self._check_partitions(project_key, dataset_name, dataset.time_dimension, limit)
+            else:
+                result = self._check_dates(project_key, dataset_name, dataset, limit)
+        except Exception as e:
+            logger.info("Failed to check the retention of %s.%s: %s", project_key, dataset_name, e)
+            result = ("UNKNOWN", "check failed: " + str(e), None, [])
+        record["status"], record["detail"], record["partitions"], record["expired_partitions"] = result
+        return record
+
+
+def build_retention_records(inventory, project_key, checker):
+    items = list(inventory.iter_dataset_summaries(project_key))
+    records = inventory.fetcher.map(lambda item: checker.check(project_key, item[0], item[1]), items)
+    return [record for record in records if record is not None]
+
+
+def get_retention_checker(inventory, config):
+    try:
+        time_budget = float(config.get("retentionTimeBudget", DEFAULT_TIME_BUDGET))
+    except (TypeError, ValueError):
+        time_budget = DEFAULT_TIME_BUDGET
+    return RetentionChecker(inventory, max(0, time_budget))
@@ -0,0 +1,135 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import re
+
+import dataiku
+
+DEFAULT_SAMPLE_ROWS = 10000
+DEFAULT_CHUNK_ROWS = 1000
+
+# a column is classified once this many non-empty values were scanned, when a
+# detector matches at least CONFIDENT_RATIO of them or none matches MIN_REPORTED_RATIO
+CONFIDENT_MIN_VALUES = 500
+CONFIDENT_RATIO = 0.9
+MIN_REPORTED_RATIO = 0.05
+
+SCANNED_TYPES = ["string"]
+
+PII_PATTERNS = [
+    ("email", re.compile(r"^[^@\s]+@[^@\s]+\.[A-Za-z]{2,}$")),
+    # 8 to 15 digits from a + or 00 country code, or a national 0 prefix, in groups
+    # whose separators are not shaped like a date
+    ("phone", re.compile(r"^(?=(?:\D*\d){8,15}\D*$)(?!\d{1,2}([./-])\d{1,2}\1\d{2,4}$)"
+                         + r"(?:(?:\+|00)[1-9]\d{0,2}(?:[\s.-]?\(0?\d{1,4}\))?(?:[\s.-]?\d{1,4}){2,6}"
+                         + r"|(?:\(0[1-9]\d{0,3}\)|0[1-9]\d{0,3})(?:[\s.-]?\d{2,4}){2,6})$")),
+    ("iban", re.compile(r"^[A-Z]{2}\d{2}(?: ?[A-Z0-9]){11,30}$")),
+    # IPv4, or IPv6 as 8 hex groups or compressed with a single "::", but not clock
+    # times such as 10::30
+    ("ip_address", re.compile(r"^(?:(?:25[0-5]|2[0-4]\d|1?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|1?\d?\d)$"
+                              + r"|^(?!\d{1,2}(?::+\d{1,2})+$)(?:(?:[0-9a-fA-F]{1,4}:){7}[0-9a-fA-F]{1,4}"
+                              + r"|(?!.*::.*::)(?:[0-9a-fA-F]{1,4}(?::[0-9a-fA-F]{1,4}){0,6})?::(?:[0-9a-fA-F]{1,4}(?::[0-9a-fA-F]{1,4}){0,6})?)$")),
+    ("date_of_birth", re.compile(r"^(?:19\d{2}|20[01]\d)[-/.](?:0?[1-9]|1[0-2])[-/.](?:0?[1-9]|[12]\d|3[01])$"
+                                 + r"|^(?:0?[1-9]|[12]\d|3[01])[-/.](?:0?[1-9]|1[0-2])[-/.](?:19\d{2}|20[01]\d)$"))
+]
+
+# dates and timestamps, whatever their format: the phone numbers of a column
+# holding mostly dates are dates written with dots or dashes
+DATE_LIKE = re.compile(r"^\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}(?:[ T]\d{1,2}:\d{2}.*)?$")
+MAX_PHONE_DATE_RATIO = 0.5
+
+# most frequent first names, matched on the first word of the values
+FIRST_NAMES = frozenset([
+    "james", "john", "robert", "michael", "william", "david", "richard", "joseph", "thomas", "charles",
+    "mary", "patricia", "jennifer", "linda", "elizabeth", "barbara", "susan", "jessica", "sarah", "karen",
+    "daniel", "matthew", "anthony", "mark", "paul", "steven", "andrew", "kevin", "brian", "george",
+    "nancy", "lisa", "betty", "margaret", "sandra", "ashley", "emily", "donna", "michelle", "laura",
+    "jean", "pierre", "michel", "philippe", "alain", "nicolas", "christophe", "francois", "laurent", "eric",
+    "marie", "nathalie", "isabelle", "sylvie", "catherine", "francoise", "sophie", "anne", "julie", "camille",
+    "hans", "peter", "heinz", "klaus", "wolfgang", "jurgen", "stefan", "andreas", "ursula", "monika",
+    "jose", "antonio", "manuel", "francisco", "juan", "maria", "carmen", "ana", "lucia", "elena",
+    "giuseppe", "giovanni", "marco", "luca", "alessandro", "giulia", "francesca", "chiara", "sara", "paola",
+    "mohamed", "ahmed", "ali", "fatima", "wei", "li", "hiroshi", "yuki", "olga", "ivan"
+])
+
+DETECTORS = [name for name, pattern in PII_PATTERNS] + ["first_name"]
+
+
+class _ColumnScan(object):
+    def __init__(self, name):
+        self.name = name
+        self.values = 0
+        self.hits = dict((detector, 0) for detector in DETECTORS)
+        self.dates = 0
+        self.classified = False
+
+    def scan(self, series):
+        values = series.dropna().astype(str).str.strip()
+        values = values[values.str.len() > 0]
+        if len(values) == 0:
+            return
+        self.values += len(values)
+        for detector, pattern in PII_PATTERNS:
+            self.hits[detector] += int(values.str.match(pattern).sum())
+        self.dates += int(values.str.match(DATE_LIKE).sum())
+        first_words = values.str.split(n=1).str[0].str.lower()
+        self.hits["first_name"] += int(first_words.isin(FIRST_NAMES).sum())
+        if self.values >= CONFIDENT_MIN_VALUES:
+            max_ratio = max(self.get_ratios().values())
+            self.classified = max_ratio >= CONFIDENT_RATIO or max_ratio < MIN_REPORTED_RATIO
+
+    def get_ratios(self):
+        """
+        Share of the values matched by each detector, phone numbers left out of
+        the columns holding mostly dates
+        """
+        ratios = dict((detector, (1.0 * hits / self.values) if self.values > 0 else 0.0) for detector, hits in self.hits.items())
+        if self.values > 0 and 1.0 * self.dates / self.values >= MAX_PHONE_DATE_RATIO:
+            ratios["phone"] = 0.0
+        return ratios
+
+    def get_detections(self):
+        """
+        Detectors matching a significant share of the values, from the best one
+        """
+        ratios = self.get_ratios()
+        detections = [(detector, ratio) for detector, ratio in ratios.items() if ratio >= MIN_REPORTED_RATIO]
+        detections.sort(key=lambda detection: -detection[1])
+        return detections
+
+
+def get_scanned_columns(dataset):
+    return [column.name for column in dataset.columns if column.type in SCANNED_TYPES]
+
+
+def scan_dataset(project_key, dataset_name, columns, sample_rows=DEFAULT_SAMPLE_ROWS, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Runs the PII detectors on the first rows of the string columns of a dataset,
+    one chunk at a time so that memory stays bounded. Columns are dropped from
+    the scan once classified, and the scan stops when all of them are.
+
+    Returns (column name, rows scanned, [(detector, hit ratio)]) per column with
+    detections.
+    """
+    if len(columns) == 0:
+        return []
+    scans = [_ColumnScan(column) for column in columns]
+    dataset = dataiku.Dataset(dataset_name, project_key=project_key)
+    for chunk in dataset.iter_dataframes(chunksize=chunk_rows, infer_with_pandas=False, sampling="head", limit=sample_rows,
+                                         columns=columns):
+        pending = [scan for scan in scans if not scan.classified]
+        for scan in pending:
+            if scan.name in chunk:
+                scan.scan(chunk[scan.name])
+        if len([scan for scan in scans if not scan.classified]) == 0:
+            break
+    return [(scan.name, scan.values, scan.get_detections()) for scan in scans if len(scan.get_detections()) > 0]
+
+
+def format_detections(column_detections):
+    lines = []
+    for column, values, detections in column_detections:
+        lines.append(column + ": " + ", ".join([detector + " " + ("%d%%" % round(100 * ratio)) for detector, ratio in detections]))
+    return lines
@@ -0,0 +1,105 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import fnmatch
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+PATTERN_TYPES = ["GLOB", "REGEX"]
+
+
+def _get_list_param(config, param_name):
+    return [value.strip() for value in (config.get(param_name, None) or []) if value is not None and len(value.strip()) > 0]
+
+
+def compile_project_key_pattern(pattern, pattern_type="GLOB"):
+    if pattern_type == "GLOB":
+        return re.compile(fnmatch.translate(pattern))
+    if pattern_type == "REGEX":
+        # the whole key must match, whatever the alternatives of the pattern
+        return re.compile("(?:" + pattern + ")\\Z")
+    raise Exception("Unknown project key pattern type: " + str(pattern_type))
+
+
+def _find_project_folder(client, path):
+    folder = client.get_root_project_folder()
+    for name in [part for part in path.split("/") if len(part) > 0]:
+        child = None
+        for candidate in folder.list_child_folders():
+            if candidate.get_name() == name:
+                child = candidate
+                break
+        if child is None:
+            raise Exception("Project folder not found: " + path)
+        folder = child
+    return folder
+
+
+def list_folder_project_keys(client, path, recursive=True):
+    """
+    Keys of the projects in a project folder, given by its path from the root
+    folder such as /Business units/Finance
+    """
+    project_keys = set()
+    folders = [_find_project_folder(client, path)]
+    while len(folders) > 0:
+        folder = folders.pop()
+        project_keys.update(folder.list_project_keys())
+        if recursive:
+            folders.extend(folder.list_child_folders())
+    return project_keys
+
+
+class ProjectScope(object):
+    """
+    Projects covered by a macro run: the current project, or the projects of
+    the instance narrowed down by key list, key pattern, tags and project folder.
+
+    The filters only use the project listing and the folder tree, so that no
+    per-project call is made for the projects left out.
+    """
+
+    def __init__(self, config, current_project_key):
+        self.current_project_key = current_project_key
+        self.all_projects = config.get('allProjects', False)
+        self.project_keys = _get_list_param(config, 'projectKeys')
+        pattern = (config.get('projectKeyPattern', None) or "").strip()
+        self.pattern = compile_project_key_pattern(pattern, config.get('projectKeyPatternType', "GLOB")) if len(pattern) > 0 else None
+        self.tags = set(_get_list_param(config, 'projectTags'))
+        self.folder_path = (config.get('projectFolder', None) or "").strip()
+        self.folder_recursive = config.get('projectFolderRecursive', True)
+
+    def _get_project_tags(self, client, project_item):
+        tags = project_item.get("tags", None)
+        if tags is not None:
+            return tags
+        # only the projects the listing carries no tags for cost a metadata call
+        return client.get_project(project_item["projectKey"]).get_metadata().get("tags", [])
+
+    def resolve(self, client):
+        """
+        Keys of the selected projects, in the order of the project listing
+        """
+        if not self.all_projects:
+            return [self.current_project_key]
+
+        project_items = client.list_projects()
+        if len(self.project_keys) > 0:
+            listed_keys = set(item["projectKey"] for item in project_items)
+            unknown_keys = [key for key in self.project_keys if key not in listed_keys]
+            if len(unknown_keys) > 0:
+                logger.warning("Projects not found: %s", ", ".join(unknown_keys))
+            selected_keys = set(self.project_keys)
+            project_items = [item for item in project_items if item["projectKey"] in selected_keys]
+        if self.pattern is not None:
+            project_items = [item for item in project_items if self.pattern.match(item["projectKey"]) is not None]
+        if len(self.folder_path) > 0:
+            folder_keys = list_folder_project_keys(client, self.folder_path, self.folder_recursive)
+            project_items = [item for item in project_items if item["projectKey"] in folder_keys]
+        if len(self.tags) > 0:
+            project_items = [item for item in project_items if len(self.tags.intersection(self._get_project_tags(client, item))) > 0]
+        return [item["projectKey"] for item in project_items]
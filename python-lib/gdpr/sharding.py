@@ -0,0 +1,375 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import gzip
+import json
+import logging
+import multiprocessing
+from datetime import datetime
+
+import dataiku
+
+from gdpr.inventory import split_smart_name
+from gdpr.model import DatasetSummary
+
+logger = logging.getLogger(__name__)
+
+SHARD_DIR = "gdpr-audit-shards"
+SHARD_FORMAT_VERSION = 2
+DEFAULT_SHARD_COUNT = 4
+SHARD_MODES = ["NONE", "LOCAL", "WORKER", "MERGE"]
+
+# outputs of the merge run, never written by the local workers
+WORKER_OUTPUT_PARAMS = ["reportFolder", "exportFolder", "snapshotFolder", "checkpointFolder", "cacheFolder"]
+
+# the instance-wide parts need all the projects: each shard writes what they read
+# of its own projects to this section, and the merge renders them from it
+FLOW_SECTION = "flow"
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+def get_shard_indices(project_keys, shard_count):
+    """
+    Shard auditing each project, by project key: the projects are dealt
+    round-robin, so that the shards get a similar mix of large and small projects
+    """
+    return dict((project_key, position % shard_count) for position, project_key in enumerate(project_keys))
+
+
+def get_shard_project_keys(project_keys, shard_index, shard_count):
+    return project_keys[shard_index::shard_count]
+
+
+def get_project_flow(inventory, project_key, include_recipes):
+    """
+    What the instance-wide parts read of one project, for ShardFlows: the
+    connection and declaration of its datasets, and its recipes and dataset
+    shares for the lineage. A failed read is kept as its message, raised again
+    by the merge.
+    """
+    flow = {}
+    try:
+        flow["datasets"] = [[dataset_name, dataset.connection, dataset.contains_personal_data]
+                            for dataset_name, dataset in inventory.iter_dataset_summaries(project_key)]
+    except Exception as e:
+        logger.warning("Failed to read the datasets of project %s: %s", project_key, e)
+        flow["datasetsError"] = str(e)
+    if include_recipes:
+        try:
+            flow["recipes"] = [{"name": recipe.get("name", ""), "inputs": recipe.get("inputs", {}), "outputs": recipe.get("outputs", {})}
+                               for recipe in inventory.list_project_recipes(project_key)]
+            flow["datasetShares"] = inventory.get_dataset_shares(project_key)
+        except Exception as e:
+            logger.warning("Failed to read the flow of project %s: %s", project_key, e)
+            flow["flowError"] = str(e)
+    return flow
+
+
+class ShardFlows(object):
+    """
+    Inventory calls of the instance-wide parts, the connections and the lineage,
+    answered from the flows written by the shards instead of the instance. The
+    projects are first read in order, then kept in memory.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self._flows = {}
+
+    def _get_flow(self, project_key, error_key):
+        if project_key not in self._flows:
+            try:
+                self._flows[project_key] = self.reader.load(FLOW_SECTION, project_key)[1]
+            except Exception as e:
+                self._flows[project_key] = {"datasetsError": str(e), "flowError": str(e)}
+        flow = self._flows[project_key]
+        if error_key in flow:
+            raise Exception(flow[error_key])
+        return flow
+
+    def prefetch_projects(self, project_keys, **kwargs):
+        pass
+
+    def iter_dataset_summaries(self, project_key, from_listing=False):
+        for dataset_name, connection, contains_personal_data in self._get_flow(project_key, "datasetsError")["datasets"]:
+            yield dataset_name, DatasetSummary(connection=connection, contains_personal_data=contains_personal_data)
+
+    def list_project_recipes(self, project_key):
+        return self._get_flow(project_key, "flowError")["recipes"]
+
+    def get_dataset_shares(self, project_key):
+        return self._get_flow(project_key, "flowError")["datasetShares"]
+
+
+class ShardWriter(object):
+    """
+    Partial result of one shard of an audit: the rendered HTML and records of
+    each of its parts, or the error that failed it, streamed to one gzipped JSON
+    lines file per section. The manifest is written last, a shard without one
+    is not complete.
+    """
+
+    def __init__(self, folder, shard_index, shard_count, fingerprint, project_keys):
+        self.folder = folder
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.fingerprint = fingerprint
+        self.project_keys = project_keys
+        self.part_count = 0
+        self.error_count = 0
+        self._sections = []
+        self._streams = {}
+
+    def _get_path(self, name):
+        return SHARD_DIR + "/" + str(self.shard_index) + "/" + name
+
+    def _write_entry(self, section, entry):
+        if section not in self._streams:
+            writer = self.folder.get_writer(self._get_path(section + ".jsonl.gz"))
+            self._streams[section] = (writer, gzip.GzipFile(fileobj=writer, mode="wb"))
+            self._sections.append(section)
+        self._streams[section][1].write((json.dumps(entry, default=str) + "\n").encode("utf-8"))
+
+    def write_part(self, section, project_key, html, records, errors):
+        """
+        errors: (section, project key, message) of the projects that failed
+        while rendering the part, without failing it
+        """
+        self._write_entry(section, {"projectKey": project_key, "html": html, "records": records, "errors": errors})
+        self.part_count += 1
+
+    def write_error(self, section, project_key, error, errors):
+        self._write_entry(section, {"projectKey": project_key, "error": str(error), "errors": errors})
+        self.error_count += 1
+
+    def _close(self):
+        streams = self._streams
+        self._streams = {}
+        for writer, stream in streams.values():
+            stream.close()
+            writer.close()
+
+    def commit(self):
+        self._close()
+        self.folder.write_json(self._get_path("manifest.json"), {
+            "format": SHARD_FORMAT_VERSION,
+            "fingerprint": self.fingerprint,
+            "shardIndex": self.shard_index,
+            "shardCount": self.shard_count,
+            "projectKeys": list(self.project_keys),
+            "createdOn": datetime.utcnow().strftime(DATE_FORMAT),
+            "sections": self._sections,
+            "parts": self.part_count,
+            "errors": self.error_count
+        })
+
+    def get_summary_html(self):
+        return "<p>Shard " + str(self.shard_index + 1) + " of " + str(self.shard_count) + ": " \
+            + str(len(get_shard_project_keys(self.project_keys, self.shard_index, self.shard_count))) + " projects, " \
+            + str(self.part_count) + " parts written, " + str(self.error_count) + " failed. " \
+            + "Run the audit in \"Merge\" mode once all the shards are complete.</p>"
+
+
+class ShardReader(object):
+    """
+    Parts of the complete shards of an audit, read back in the order of the
+    single-process audit: each section is streamed from its shard files, one
+    part at a time, so that memory stays flat whatever the size of the instance
+    """
+
+    def __init__(self, folder, manifests):
+        self.folder = folder
+        self.manifests = manifests
+        self.shard_count = len(manifests)
+        self.project_keys = manifests[0]["projectKeys"]
+        self.fingerprint = manifests[0]["fingerprint"]
+        self._shard_indices = get_shard_indices(self.project_keys, self.shard_count)
+        self._streams = {}
+        self._iterators = {}
+
+    def _iter_entries(self, shard_index, section):
+        if section not in self.manifests[shard_index]["sections"]:
+            return
+        stream = self.folder.get_download_stream(SHARD_DIR + "/" + str(shard_index) + "/" + section + ".jsonl.gz")
+        self._streams[(shard_index, section)] = stream
+        for line in gzip.GzipFile(fileobj=stream, mode="rb"):
+            if len(line.strip()) > 0:
+                yield json.loads(line.decode("utf-8"))
+
+    def load(self, section, project_key, errors=None):
+        """
+        Rendered HTML and records of a part, raising the error of the shard if
+        it failed there. Parts are read in order, skipped ones are passed over.
+        The errors of the projects that failed while rendering the part are
+        added to errors.
+        """
+        shard_index = self._shard_indices[project_key]
+        key = (shard_index, section)
+        if key not in self._iterators:
+            self._iterators[key] = self._iter_entries(shard_index, section)
+        for entry in self._iterators[key]:
+            if entry["projectKey"] != project_key:
+                continue
+            if errors is not None:
+                for error_section, error_project_key, message in entry["errors"]:
+                    errors.add_message(error_section, error_project_key, message)
+            if "error" in entry:
+                raise Exception(entry["error"])
+            return entry["html"], entry["records"]
+        raise Exception("Missing from the results of shard " + str(shard_index + 1))
+
+    def close(self):
+        streams = self._streams
+        self._streams = {}
+        self._iterators = {}
+        for stream in streams.values():
+            stream.close()
+
+    def get_summary_html(self):
+        created_on = sorted([manifest["createdOn"] for manifest in self.manifests])
+        return "<p>Merged from " + str(self.shard_count) + " shards completed between " + created_on[0][:16].replace("T", " ") \
+            + " and " + created_on[-1][:16].replace("T", " ") + " UTC</p>"
+
+
+def _run_local_worker(run_worker, worker_config):
+    try:
+        run_worker(worker_config)
+    except Exception:
+        logger.exception("Shard %d of the audit failed", worker_config["shardIndex"] + 1)
+        raise
+
+
+class AuditShards(object):
+    """
+    Sharded execution of an audit: the projects are split into shards, each
+    audited by a worker writing its partial result to a managed folder, then a
+    merge run combines them into the report of a single-process run.
+
+    The workers are either local processes started by the audit itself, or
+    separate runs of the macro in "Worker" mode, for instance steps of scenarios
+    running on other nodes, followed by a run in "Merge" mode.
+    """
+
+    def __init__(self, default_project_key, config):
+        self.config = config
+        self.folder = None
+        self._reader = None
+        self.mode = config.get("shardMode", "NONE")
+        if self.mode not in SHARD_MODES:
+            raise Exception("Unknown shard mode: " + str(self.mode))
+        self.shard_count = max(1, int(config.get("shardCount", DEFAULT_SHARD_COUNT)))
+        self.shard_index = int(config.get("shardIndex", 0))
+        if self.mode == "NONE":
+            return
+        if not 0 <= self.shard_index < self.shard_count:
+            raise Exception("The shard index must be between 0 and " + str(self.shard_count - 1))
+        if config.get("incremental", False):
+            raise Exception("Sharded audits cannot share the incremental cache, disable the incremental mode")
+        folder_ref = config.get("shardFolder", None)
+        if folder_ref is None or len(folder_ref) == 0:
+            raise Exception("Select a shard folder to run a sharded audit")
+        folder_project_key, folder_id = split_smart_name(folder_ref, default_project_key)
+        self.folder = dataiku.Folder(folder_id, project_key=folder_project_key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def is_local(self):
+        return self.mode == "LOCAL"
+
+    def is_worker(self):
+        return self.mode == "WORKER"
+
+    def is_merge(self):
+        return self.mode in ["LOCAL", "MERGE"]
+
+    def get_summary_html(self):
+        return self._reader.get_summary_html() if self._reader is not None else ""
+
+    def get_project_keys(self, project_keys):
+        return get_shard_project_keys(project_keys, self.shard_index, self.shard_count)
+
+    def _list_paths(self, shard_index):
+        prefix = SHARD_DIR + "/" + str(shard_index) + "/"
+        return [path.lstrip("/") for path in self.folder.list_paths_in_partition() if path.lstrip("/").startswith(prefix)]
+
+    def _delete_shard(self, shard_index):
+        for path in self._list_paths(shard_index):
+            self.folder.delete_path(path)
+
+    def open_writer(self, fingerprint, project_keys):
+        # the previous result of this shard is replaced
+        self._delete_shard(self.shard_index)
+        return ShardWriter(self.folder, self.shard_index, self.shard_count, fingerprint, project_keys)
+
+    def get_worker_config(self, shard_index):
+        worker_config = dict(self.config)
+        worker_config["shardMode"] = "WORKER"
+        worker_config["shardIndex"] = shard_index
+        # the report of a local worker is only its summary, logged by the worker,
+        # and the outputs of the audit are only written by the merge
+        worker_config["reportLayout"] = "SINGLE"
+        for param_name in WORKER_OUTPUT_PARAMS:
+            worker_config.pop(param_name, None)
+        return worker_config
+
+    def run_local_workers(self, run_worker):
+        """
+        Runs the shards in parallel local processes, each one with its own
+        connection to the DSS backend
+        """
+        context = multiprocessing.get_context("fork") if hasattr(multiprocessing, "get_context") else multiprocessing
+        processes = []
+        for shard_index in range(self.shard_count):
+            process = context.Process(target=_run_local_worker, args=(run_worker, self.get_worker_config(shard_index)))
+            process.start()
+            processes.append(process)
+        failed = []
+        for shard_index, process in enumerate(processes):
+            process.join()
+            if process.exitcode != 0:
+                failed.append(str(shard_index + 1))
+        if len(failed) > 0:
+            raise Exception("Audit shards failed: " + ", ".join(failed) + ", see the logs of the macro")
+
+    def open_reader(self, fingerprint_for):
+        """
+        Reader of the partial results of all the shards. fingerprint_for gives
+        the run fingerprint of this audit over the given projects, the shards
+        must have been written by workers of the same audit.
+        """
+        manifests = []
+        missing = []
+        for shard_index in range(self.shard_count):
+            path = SHARD_DIR + "/" + str(shard_index) + "/manifest.json"
+            manifest = self.folder.read_json(path) if path in self._list_paths(shard_index) else None
+            if manifest is None or manifest.get("format", None) != SHARD_FORMAT_VERSION or manifest.get("shardCount", None) != self.shard_count:
+                missing.append(str(shard_index + 1))
+            else:
+                manifests.append(manifest)
+        if len(missing) > 0:
+            raise Exception("Shards " + ", ".join(missing) + " of " + str(self.shard_count) + " are not complete")
+        project_keys = manifests[0]["projectKeys"]
+        fingerprint = fingerprint_for(project_keys)
+        for manifest in manifests:
+            if manifest["projectKeys"] != project_keys or manifest["fingerprint"] != fingerprint:
+                raise Exception("Shard " + str(manifest["shardIndex"] + 1) + " was written by an audit with other parameters or projects")
+        self._reader = ShardReader(self.folder, manifests)
+        return self._reader
+
+    def clear(self):
+        """
+        Deletes the merged partial results, so that they are never merged twice
+        """
+        if self._reader is None:
+            return
+        for shard_index in range(self.shard_count):
+            self._delete_shard(shard_index)
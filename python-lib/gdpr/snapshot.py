@@ -0,0 +1,275 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import gzip
+import json
+import logging
+from datetime import datetime
+
+import dataiku
+
+from gdpr.checkpoint import get_run_fingerprint
+from gdpr.diff import ObjectHashes, hash_object, iter_normalized_objects
+from gdpr.inventory import split_smart_name
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = "gdpr-audit-snapshots"
+SNAPSHOT_FORMAT_VERSION = 1
+DEFAULT_SNAPSHOT_RETENTION = 10
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+def get_snapshot_fingerprint(config, current_project_key):
+    """
+    Snapshots are served to the audits with the same sections, columns and scope,
+    whatever the projects found by the scope at the time. Without allProjects,
+    the scope is the project the macro runs from.
+    """
+    scope_project_keys = [] if config.get("allProjects", False) else [current_project_key]
+    return get_run_fingerprint(config, scope_project_keys)
+
+
+def format_age(seconds):
+    seconds = max(0, int(seconds))
+    for unit, length in [("day", 86400), ("hour", 3600), ("minute", 60)]:
+        if seconds >= length:
+            count = seconds // length
+            return str(count) + " " + unit + ("s" if count > 1 else "")
+    return "less than a minute"
+
+
+class SnapshotRecorder(object):
+    """
+    Report tee recording what an audit writes, HTML and records of each part in
+    order, to a gzipped JSON lines file of the snapshot folder. The normalized
+    objects of the parts go to a second file, and their hashes to a third one
+    read by the diffs. The snapshot only becomes visible once committed, when
+    its manifest is written.
+
+    Without a folder, it only forwards to the report. Without a report, it only
+    records.
+    """
+
+    def __init__(self, report, folder=None, snapshot_id=None, fingerprint=None):
+        self.report = report
+        self.folder = folder
+        self.snapshot_id = snapshot_id
+        self.fingerprint = fingerprint
+        self.committed = False
+        self._html = []
+        self._streams = None
+        self._part_count = 0
+        self._object_hashes = ObjectHashes()
+        if folder is not None:
+            self._streams = {}
+            for name in ["parts", "objects"]:
+                writer = folder.get_writer(self._get_path(name + ".jsonl.gz"))
+                self._streams[name] = (writer, gzip.GzipFile(fileobj=writer, mode="wb"))
+
+    def _get_path(self, name):
+        return SNAPSHOT_DIR + "/" + self.snapshot_id + "/" + name
+
+    def _write_entry(self, entry, name="parts"):
+        self._streams[name][1].write((json.dumps(entry, default=str) + "\n").encode("utf-8"))
+
+    def _flush_html(self):
+        if len(self._html) > 0:
+            self._write_entry({"html": "".join(self._html)})
+            self._html = []
+
+    def write(self, *parts):
+        if self.report is not None:
+            self.report.write(*parts)
+        if self._streams is not None:
+            self._html.extend(parts)
+
+    def start_page(self, path, title):
+        if self.report is not None:
+            self.report.start_page(path, title)
+        if self._streams is not None:
+            self._flush_html()
+            self._write_entry({"page": path, "title": title})
+
+    def end_page(self):
+        if self.report is not None:
+            self.report.end_page()
+        if self._streams is not None:
+            self._flush_html()
+            self._write_entry({"endPage": True})
+
+    def write_records(self, section, project_key, records):
+        if self.report is not None:
+            self.report.write_records(section, project_key, records)
+        if self._streams is None:
+            return
+        self._flush_html()
+        self._write_entry({"section": section, "projectKey": project_key, "records": records})
+        self._part_count += 1
+        for group, object_id, fields in iter_normalized_objects(section, records):
+            self._object_hashes.add(group, object_id, hash_object(fields))
+            self._write_entry({"id": object_id, "fields": fields}, "objects")
+
+    def _close(self):
+        if self._streams is None:
+            return
+        self._flush_html()
+        for writer, stream in self._streams.values():
+            stream.close()
+            writer.close()
+        self._streams = None
+
+    def commit(self, project_keys):
+        if self.folder is None:
+            return
+        self._close()
+        self.folder.write_json(self._get_path("hashes.json"), self._object_hashes.to_json())
+        manifest = {
+            "id": self.snapshot_id,
+            "format": SNAPSHOT_FORMAT_VERSION,
+            "fingerprint": self.fingerprint,
+            "createdOn": datetime.utcnow().strftime(DATE_FORMAT),
+            "projectKeys": list(project_keys),
+            "parts": self._part_count
+        }
+        self.folder.write_json(self._get_path("manifest.json"), manifest)
+        self.committed = True
+        return AuditSnapshot(self.folder, manifest)
+
+    def discard(self):
+        if self.folder is None:
+            return
+        self._close()
+        for name in ["parts.jsonl.gz", "objects.jsonl.gz"]:
+            self.folder.delete_path(self._get_path(name))
+
+    def get_summary_html(self):
+        if not self.committed:
+            return ""
+        return "<p>Snapshot " + self.snapshot_id + " saved, served by the next runs until refreshed</p>"
+
+
+class AuditSnapshot(object):
+    """
+    Committed snapshot of an audit, read back as a stream of entries
+    """
+
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.manifest = manifest
+        self.snapshot_id = manifest["id"]
+
+    def get_created_on(self):
+        return datetime.strptime(self.manifest["createdOn"], DATE_FORMAT)
+
+    def _get_path(self, name):
+        return SNAPSHOT_DIR + "/" + self.snapshot_id + "/" + name
+
+    def _iter_lines(self, name):
+        with self.folder.get_download_stream(self._get_path(name)) as stream:
+            for line in gzip.GzipFile(fileobj=stream, mode="rb"):
+                if len(line.strip()) > 0:
+                    yield json.loads(line.decode("utf-8"))
+
+    def iter_entries(self):
+        """
+        {"html": ...} for the rendered report, {"section", "projectKey", "records"}
+        for the records of each part, {"page", "title"} and {"endPage"} around
+        the parts written to separate pages, in the order the audit wrote them
+        """
+        return self._iter_lines("parts.jsonl.gz")
+
+    def get_object_hashes(self):
+        return ObjectHashes.from_json(self.folder.read_json(self._get_path("hashes.json")))
+
+    def load_objects(self, object_ids):
+        """
+        Normalized fields of the given objects, in one pass over the objects file
+        """
+        objects = {}
+        if len(object_ids) == 0:
+            return objects
+        for entry in self._iter_lines("objects.jsonl.gz"):
+            if entry["id"] in object_ids:
+                objects[entry["id"]] = entry["fields"]
+        return objects
+
+    def iter_parts(self):
+        for entry in self.iter_entries():
+            if "records" in entry:
+                yield entry["section"], entry["projectKey"], entry["records"]
+
+    def get_age_html(self):
+        created_on = self.get_created_on()
+        age = (datetime.utcnow() - created_on).total_seconds()
+        return "<p><b>Snapshot of " + created_on.strftime('%Y-%m-%d %H:%M') + " UTC (" + format_age(age) + " old).</b> " \
+            + "Run the audit with \"Force refresh\" for live results.</p>"
+
+
+class AuditSnapshots(object):
+    """
+    Versioned snapshots of the audit in a managed folder, one directory per run:
+    a scheduled run, such as a scenario step running the macro with "Force refresh",
+    takes them in the background, and the interactive runs serve the latest one
+    instead of crawling the instance.
+
+    Without a folder, there are no snapshots.
+    """
+
+    def __init__(self, default_project_key, config):
+        self.folder = None
+        self.fingerprint = get_snapshot_fingerprint(config, default_project_key)
+        self.retention = max(1, int(config.get("snapshotRetention", DEFAULT_SNAPSHOT_RETENTION)))
+        folder_ref = config.get("snapshotFolder", None)
+        if folder_ref is not None and len(folder_ref) > 0:
+            folder_project_key, folder_id = split_smart_name(folder_ref, default_project_key)
+            self.folder = dataiku.Folder(folder_id, project_key=folder_project_key)
+
+    def is_enabled(self):
+        return self.folder is not None
+
+    def _list_paths(self):
+        paths = [path.lstrip("/") for path in self.folder.list_paths_in_partition()]
+        return [path for path in paths if path.startswith(SNAPSHOT_DIR + "/")]
+
+    def list_snapshots(self):
+        """
+        Committed snapshots with the same content as this audit, latest first
+        """
+        if self.folder is None:
+            return []
+        snapshots = []
+        for path in self._list_paths():
+            if not path.endswith("/manifest.json"):
+                continue
+            manifest = self.folder.read_json(path)
+            if manifest.get("format", None) == SNAPSHOT_FORMAT_VERSION and manifest.get("fingerprint", None) == self.fingerprint:
+                snapshots.append(AuditSnapshot(self.folder, manifest))
+        snapshots.sort(key=lambda snapshot: snapshot.manifest["createdOn"], reverse=True)
+        return snapshots
+
+    def get_latest(self):
+        snapshots = self.list_snapshots()
+        return snapshots[0] if len(snapshots) > 0 else None
+
+    def open_recorder(self, report):
+        if self.folder is None:
+            return SnapshotRecorder(report)
+        snapshot_id = datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')
+        return SnapshotRecorder(report, self.folder, snapshot_id, self.fingerprint)
+
+    def prune(self):
+        """
+        Deletes the snapshots of this audit beyond the retention count
+        """
+        if self.folder is None:
+            return
+        expired_ids = set(snapshot.snapshot_id for snapshot in self.list_snapshots()[self.retention:])
+        for path in self._list_paths():
+            if path.split("/")[1] in expired_ids:
+                self.folder.delete_path(path)
+        if len(expired_ids) > 0:
+            logger.info("Deleted %d expired audit snapshots", len(expired_ids))
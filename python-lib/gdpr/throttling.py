@@ -0,0 +1,227 @@
+#
+# Copyright (c) Dataiku SAS 2019-2023
+#
+# This plugin is distributed under the terms of the Apache License version 2.0
+#
+import logging
+import random
+import re
+import threading
+import time
+
+from gdpr.crawler import get_max_concurrent_requests
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+# read-only calls, safe to send again; iter_ calls are left out, their generators
+# fail while iterated, after the call returned
+IDEMPOTENT_PREFIXES = ("get_", "list_")
+
+TRANSIENT_STATUS_CODES = set([429, 500, 502, 503, 504])
+# dataikuapi turns most HTTP errors into a DataikuException, without the response:
+# the status is only read from its message, next to the words that name it, so that
+# other numbers of the message (ids, counts, sizes) are not taken for a status
+TRANSIENT_MESSAGE = re.compile(r"\b(?:HTTP(?: code| status| error)?|status(?: code)?)\s*[:=]?\s*(?:429|500|502|503|504)\b"
+                               + r"|too many requests|service unavailable|bad gateway|gateway time-?out"
+                               + r"|timed? ?out|connection (?:aborted|reset|refused)", re.IGNORECASE)
+
+# the concurrency budget is halved when the smoothed latency of an endpoint goes
+# over SLOWDOWN_RATIO times its best smoothed latency, by at least SLOWDOWN_MIN_DELAY
+# seconds, and grows back by one once a budget worth of calls completed at a
+# normal latency
+LATENCY_SMOOTHING = 0.2
+SLOWDOWN_RATIO = 2.0
+SLOWDOWN_MIN_DELAY = 0.05
+MIN_LATENCY_SAMPLES = 5
+
+
+def is_idempotent(method_name):
+    return method_name.startswith(IDEMPOTENT_PREFIXES)
+
+
+def is_transient_error(error):
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code is not None:
+        return status_code in TRANSIENT_STATUS_CODES
+    if type(error).__name__ in ["ConnectionError", "Timeout", "ReadTimeout", "ConnectTimeout", "ChunkedEncodingError"]:
+        return True
+    return TRANSIENT_MESSAGE.search(str(error)) is not None
+
+
+def get_retry_delay(attempt, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """
+    Exponential backoff with full jitter: uniform between 0 and the capped
+    exponential delay, so that the retries of parallel calls spread out
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class _EndpointLatency(object):
+    def __init__(self):
+        self.samples = 0
+        self.smoothed = None
+        self.best = None
+
+    def add(self, duration):
+        self.samples += 1
+        self.smoothed = duration if self.smoothed is None else (LATENCY_SMOOTHING * duration + (1 - LATENCY_SMOOTHING) * self.smoothed)
+        if self.samples >= MIN_LATENCY_SAMPLES and (self.best is None or self.smoothed < self.best):
+            self.best = self.smoothed
+
+    def is_slow(self):
+        return self.best is not None and self.smoothed > SLOWDOWN_RATIO * self.best and self.smoothed - self.best > SLOWDOWN_MIN_DELAY
+
+
+class RequestThrottle(object):
+    """
+    Budget of the DSS API calls of a run, shared by all the crawling threads:
+    at most max_rate calls per second (0 for no limit) and at most a concurrency
+    budget of calls in flight. When adaptive, the budget shrinks as soon as the
+    backend slows down or answers with transient errors, and grows back to
+    max_concurrency once it recovered.
+
+    Idempotent calls failing with a transient error are retried with jittered
+    exponential backoff, other errors are raised at once.
+    """
+
+    def __init__(self, max_rate=0, max_concurrency=4, max_retries=DEFAULT_MAX_RETRIES, adaptive=True):
+        self.max_rate = max_rate
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.adaptive = adaptive
+        self.concurrency = self.max_concurrency
+        self.min_concurrency_reached = self.max_concurrency
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled_calls = 0
+        self.throttled_time = 0.0
+        self.slowdowns = 0
+        self.retries = {}
+        self.failed_retries = 0
+        self._next_slot = 0.0
+        self._calm_calls = 0
+        self._completed_calls = 0
+        self._latencies = {}
+        self._condition = threading.Condition()
+
+    def _acquire(self):
+        start = time.time()
+        # only the waits caused by the rate or a lowered budget count as throttling
+        throttled = False
+        with self._condition:
+            while self.in_flight >= self.concurrency:
+                throttled = throttled or self.concurrency < self.max_concurrency
+                self._condition.wait()
+            self.in_flight += 1
+            self.calls += 1
+            delay = 0.0
+            if self.max_rate > 0:
+                now = time.time()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + 1.0 / self.max_rate
+                delay = slot - now
+        if delay > 0:
+            throttled = True
+            time.sleep(delay)
+        if throttled:
+            with self._condition:
+                self.throttled_calls += 1
+                self.throttled_time += time.time() - start
+
+    def _release(self, endpoint, duration, transient_error=False):
+        with self._condition:
+            self.in_flight -= 1
+            if self.adaptive:
+                self._adapt(endpoint, duration, transient_error)
+            self._condition.notify_all()
+
+    def _adapt(self, endpoint, duration, transient_error):
+        latency = self._latencies.get(endpoint)
+        if latency is None:
+            latency = _EndpointLatency()
+            self._latencies[endpoint] = latency
+        if not transient_error:
+            latency.add(duration)
+        self._completed_calls += 1
+        if transient_error or latency.is_slow():
+            self._calm_calls = 0
+            # at most once per budget worth of calls, to let the lower budget take effect
+            if self.concurrency > 1 and self._completed_calls >= self.concurrency:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.min_concurrency_reached = min(self.min_concurrency_reached, self.concurrency)
+                self.slowdowns += 1
+                self._completed_calls = 0
+                logger.info("DSS backend slowing down, concurrency budget lowered to %d", self.concurrency)
+        else:
+            self._calm_calls += 1
+            if self._calm_calls >= self.concurrency and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._calm_calls = 0
+
+    def call(self, endpoint, method_name, func, args, kwargs):
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                transient = is_transient_error(e)
+                self._release(endpoint, time.time() - start, transient)
+                if not transient or not is_idempotent(method_name):
+                    raise
+                if attempt >= self.max_retries:
+                    with self._condition:
+                        self.failed_retries += 1
+                    raise
+                delay = get_retry_delay(attempt)
+                logger.warning("Transient error on %s, retrying in %.1fs: %s", endpoint, delay, str(e))
+                with self._condition:
+                    self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._release(endpoint, time.time() - start)
+            return result
+
+    def get_retry_count(self):
+        return sum(self.retries.values())
+
+    def log_summary(self, macro):
+        logger.info("API throttling %s: %d calls, %d throttled for %.1fs, %d slowdowns (min concurrency %d), %d retries, %d failed after retries",
+                    macro, self.calls, self.throttled_calls, self.throttled_time, self.slowdowns, self.min_concurrency_reached,
+                    self.get_retry_count(), self.failed_retries)
+
+    def get_summary_html(self):
+        if self.throttled_calls == 0 and self.slowdowns == 0 and len(self.retries) == 0:
+            return ""
+        html = "<h3>Throttling and retries</h3><ul>" \
+            + "<li>" + str(self.throttled_calls) + " of " + str(self.calls) + " API calls delayed by the request budget, " \
+            + ("%.1f" % self.throttled_time) + "s of cumulated waits</li>" \
+            + "<li>Concurrency lowered " + str(self.slowdowns) + " times as the backend slowed down or failed, down to " \
+            + str(self.min_concurrency_reached) + " of " + str(self.max_concurrency) + " concurrent calls</li>" \
+            + "<li>" + str(self.get_retry_count()) + " calls retried after a transient error"
+        if len(self.retries) > 0:
+            html += ": " + ", ".join([endpoint + " (" + str(count) + ")" for endpoint, count in sorted(self.retries.items())])
+        html += "</li>"
+        if self.failed_retries > 0:
+            html += "<li>" + str(self.failed_retries) + " calls still failing after " + str(self.max_retries) + " retries</li>"
+        return html + "</ul>"
+
+
+def get_request_throttle(config):
+    try:
+        max_rate = float(config.get("maxRequestsPerSecond", 0) or 0)
+    except (TypeError, ValueError):
+        max_rate = 0
+    try:
+        max_retries = int(config.get("maxRetries", DEFAULT_MAX_RETRIES))
+    except (TypeError, ValueError):
+        max_retries = DEFAULT_MAX_RETRIES
+    return RequestThrottle(max(0, max_rate), get_max_concurrent_requests(config), max(0, max_retries),
+                           config.get("adaptiveThrottling", True))
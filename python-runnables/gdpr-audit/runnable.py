@@ -5,10 +5,36 @@
 #
 from dataiku.runnables import Runnable
 import dataiku
-import re
-import calendar
-from datetime import datetime
-import dateutil.parser
+import logging
+from gdpr.audit_report import write_connections_section, write_projects_header, write_project_row, write_projects_footer, \
+    write_all_objects_header, write_project_objects_header, write_datasets_table, write_analyses_table, write_saved_models_table, \
+    write_lineage_section, write_changes_section, write_retention_header, write_retention_table, iter_search_entries
+from gdpr.cache import open_audit_cache
+from gdpr.checkpoint import AuditCheckpoint, ProjectErrors, get_run_fingerprint
+from gdpr.classifier import get_schema_classifier
+from gdpr.crawler import ParallelFetcher, get_max_concurrent_requests
+from gdpr.diff import build_change_records
+from gdpr.export import AuditExporter
+from gdpr.instrumentation import ApiProfiler, InstrumentedClient
+from gdpr.inventory import InstanceInventory
+from gdpr.lineage import build_lineage_records
+from gdpr.ml_inventory import MLInventory
+from gdpr.planner import AuditPlan
+from gdpr.progress import ProgressTracker, count_listed
+from gdpr.records import build_connection_records, build_project_record, build_dataset_records, build_analysis_records, \
+    build_saved_model_records
+from gdpr.report import HTML_HEADER, HTMLFragment, ReportOutput
+from gdpr.retention import build_retention_records, get_retention_checker
+from gdpr.scope import ProjectScope
+from gdpr.sharding import FLOW_SECTION, AuditShards, ShardFlows, get_project_flow
+from gdpr.snapshot import AuditSnapshots
+from gdpr.throttling import get_request_throttle
+
+logger = logging.getLogger(__name__)
+
+# key of the instance-wide parts of the audit in the checkpoints
+INSTANCE_KEY = "_instance"
+EXPORTED_TABLES = ["connections", "projects", "datasets", "analyses", "saved_models", "retention", "lineage"]
 
 class GDPRAuditRunnable(Runnable):
     def __init__(self, project_key, config, plugin_config):
@@ -21,511 +47,363 @@ class GDPRAuditRunnable(Runnable):
         return (100, 'NONE')
 
     def run(self, progress_callback):
-        if self.config.get('allProjects', False):
-            project_key_list = [prj['projectKey'] for prj in self.client.list_projects()]
+        include_profile = self.config.get('includeProfile', False)
+        profiler = ApiProfiler(estimate_payloads=include_profile)
+        throttle = get_request_throttle(self.config)
+        progress = ProgressTracker(progress_callback, profiler, INSTANCE_KEY)
+        shards = AuditShards(self.project_key, self.config)
+        if shards.is_local():
+            # workers forked before any connection or thread is opened, then merged below
+            shards.run_local_workers(lambda worker_config: GDPRAuditRunnable(self.project_key, worker_config, self.plugin_config).run(lambda progress: None))
+        with InstrumentedClient(self.client, profiler, throttle) as client, \
+                ParallelFetcher(get_max_concurrent_requests(self.config)) as fetcher, \
+                ReportOutput(self.project_key, self.config, "gdpr-audit", iter_search_entries) as output, \
+                open_audit_cache(self.project_key, self.config) as cache, \
+                AuditExporter(self.project_key, self.config) as exporter, \
+                shards:
+            if shards.is_worker():
+                self._run_shard(progress, client, fetcher, output.report, shards)
+            else:
+                self._run(progress, client, fetcher, output.report, cache, exporter, shards)
+            progress.finish()
+            profiler.log_summary("gdpr-audit")
+            throttle.log_summary("gdpr-audit")
+            progress.log_summary("gdpr-audit")
+            output.report.write(throttle.get_summary_html())
+            output.report.write(progress.get_summary_html())
+            if include_profile:
+                output.report.write(profiler.get_summary_html())
+            return output.finalize()
+
+    def _run(self, progress, client, fetcher, report, cache, exporter, shards):
+        snapshots = AuditSnapshots(self.project_key, self.config)
+        changes_only = self.config.get('reportMode', "FULL") == "CHANGES"
+        if changes_only and not snapshots.is_enabled():
+            raise Exception("Select a snapshot folder to report the changes between snapshots")
+        previous_snapshots = snapshots.list_snapshots()
+        if len(previous_snapshots) > 0 and not self.config.get('forceRefresh', False) and not shards.is_merge():
+            if changes_only:
+                report.write(HTML_HEADER)
+                self._write_changes(report, exporter, previous_snapshots[1] if len(previous_snapshots) > 1 else None,
+                                    previous_snapshots[0])
+                report.write(exporter.get_summary_html())
+            else:
+                self._serve_snapshot(report, exporter, previous_snapshots[0])
+            return
+        if snapshots.is_enabled():
+            logger.info("Running the audit live to take a new snapshot")
+
+        plan = AuditPlan(self.config)
+        errors = ProjectErrors()
+        if shards.is_merge():
+            # the parts are read from the results of the shards instead of the instance
+            reader = shards.open_reader(lambda project_keys: get_run_fingerprint(self.config, project_keys))
+            project_key_list = reader.project_keys
+            render_part = self._get_merged_part_renderer(client, reader, project_key_list, errors)
         else:
-            project_key_list = [self.project_key]
-
-        callback_progression = 0
-        include_connections = self.config.get('includeConnections', True)
-        if include_connections:
-            callback_progression += 1
-        include_projects = self.config.get('includeProjects', True)
-        if include_projects:
-            callback_progression += 1
-        include_all_objects = self.config.get('includeAllObjects', True)
-        if include_all_objects:
-            callback_progression += 1
-
-        callback_progression = (100 / callback_progression) if callback_progression > 0 else 100
-        progress = 0;
-        progress_callback(progress)
-        html_ret = "<html><head><style>" \
-            + "h3 { margin-top: 1em; } " \
-            + "table { border-collapse: collapse; } " \
-            + "thead { font-weight: bold; } " \
-            + "table, th, td { border: 1px solid black; }" \
-            + "</style></head><body>"
+            progress.start_phase("listing")
+            project_key_list = ProjectScope(self.config, self.project_key).resolve(client)
+            inventory = InstanceInventory(client, fetcher, cache)
+            render_part = self._get_part_renderer(client, inventory, plan, project_key_list, errors)
+        checkpoint = AuditCheckpoint(self.project_key, self.config, project_key_list)
+
+        # fan out the calls shared by the sections before rendering them in order, only
+        # for the projects left to audit when resuming a checkpoint
+        pending_parts = [part for part in self._get_parts(plan, project_key_list) if not checkpoint.is_done(part[0], part[1])]
+        audited_project_keys = checkpoint.get_pending(plan.get_project_sections(), project_key_list)
+        if shards.is_merge():
+            # the merged parts are read at about the same pace, one unit each
+            for section, project_key in pending_parts:
+                progress.add_part(section, project_key, 1)
+        else:
+            if (plan.include_connections and not checkpoint.is_done("connections", INSTANCE_KEY)) \
+                    or (plan.include_lineage and not checkpoint.is_done("lineage", INSTANCE_KEY)):
+                pending_project_keys = project_key_list
+            else:
+                pending_project_keys = audited_project_keys
+            self._prefetch(progress, inventory, plan, pending_project_keys, pending_parts, project_key_list)
+
+        report.write(HTML_HEADER)
+        report.write(checkpoint.get_summary_html())
+        report.write(shards.get_summary_html())
+        # the parts are also recorded into a new snapshot, when enabled, and only
+        # recorded when reporting the changes
+        summary_report = report
+        report = snapshots.open_recorder(None if changes_only else summary_report)
 
         # connections
-        if include_connections:
-            # header
-            html_ret += "<h3>Connections</h3>"
-            html_ret += "<table><thead>" \
-                + "<tr>" \
-                + "<th rowspan=\"2\">Connection</th>" \
-                + "<th rowspan=\"2\">Type</th>" \
-                + "<th rowspan=\"2\">Host</th>" \
-                + "<th colspan=\"2\">DSS Groups</th>" \
-                + "<th rowspan=\"2\">Datasets with personal data</th>" \
-                + "</tr>" \
-                + "<tr>" \
-                + "<th>Read</th>" \
-                + "<th>Usage</th>" \
-                + "</tr>" \
-                + "</thead><tbody>"
-
-            connections = self.client.list_connections()
-
-            # prebuild the dataset per connection map
-            datasets_per_conn = {}
+        if plan.include_connections:
+            progress.start_phase("connections")
+            self._write_part(report, exporter, checkpoint, errors, progress, "connections", INSTANCE_KEY,
+                             lambda: render_part("connections", INSTANCE_KEY))
+
+        if plan.include_projects:
+            progress.start_phase("projects")
+            write_projects_header(report)
             for project_key in project_key_list:
-                # project
-                project = self.client.get_project(project_key)
-                project_metadata = project.get_metadata()
-                for dataset_name in [ds["name"] for ds in project.list_datasets()]:
-                    dataset = project.get_dataset(dataset_name)
-                    dataset_definition = dataset.get_definition()
-                    dataset_conn = dataset_definition.get("params", {}).get("connection", "")
-                    has_pers_data = dataset_definition.get("customFields", {}).get("gdpr_contains_personal_data", "UNSURE")
-                    if has_pers_data != "NO":
-                        if not dataset_conn in datasets_per_conn:
-                            datasets_per_conn[dataset_conn] = []
-                        datasets_per_conn[dataset_conn].append(project_key + "." + dataset_name + " (" + has_pers_data + ")")
-
-            # crawl over the connections
-            for conn_name, conn in connections.items():
-                if "host" in conn.get("params", {}):
-                    url = conn.get("params", {}).get("host", "") + ":" + str(conn.get("params", {}).get("port", ""))
-                elif "jdbcurl" in conn.get("params", {}):
-                    m = re.match(".*:\\/\\/([^\\/]*)\\/.*", conn.get("params", {}).get("jdbcurl", ""))
-                    url = m.group(1) if m is not None else ""
-                else:
-                    url = ""
-                html_ret += "<tr>" \
-                    + "<td>" + conn_name + "</td>" \
-                    + "<td>" + conn.get("type", "") + "</td>" \
-                    + "<td>" + url + "</td>" \
-                    + "<td>"
-                
-                readability = conn.get("detailsReadability", {})
-                if readability.get("readableBy", "NONE") == "NONE":
-                    html_ret += "NONE"
-                elif readability.get("readableBy", "NONE") == "ALL":
-                    html_ret += "ALL"
-                elif readability.get("readableBy", "NONE") == "ALLOWED":
-                    first = True
-                    html_ret += "<pre>"
-                    for grp in readability.get("allowedGroups", []):
-                        if not first:
-                            html_ret += "\n"
-                        html_ret += grp
-                        first = False
-                    html_ret += "</pre>"
-                html_ret += "</td>" \
-                    + "<td>"
-                if conn.get("usableBy", "ALL") == "ALL":
-                    html_ret += "ALL"
-                elif conn.get("usableBy", "ALLOWED") == "ALLOWED":
-                    first = True
-                    html_ret += "<pre>"
-                    for grp in conn.get("allowedGroups", []):
-                        if not first:
-                            html_ret += "\n"
-                        html_ret += grp
-                        first = False
-                    html_ret += "</pre>"
-                html_ret += "</td>" \
-                    + "<td>"
-
-                if conn_name in datasets_per_conn:
-                    html_ret += "<pre>" + "\n".join(datasets_per_conn[conn_name]) + "</pre>"
-
-                html_ret += "</td>" \
-                    + "</tr>"
-
-            html_ret += "</tbody></table>"
-            progress += callback_progression
-            progress_callback(progress)
-
-        if include_projects:
-            # header
-            html_ret += "<h3>Projects</h3>"
-            html_ret += "<table><thead>" \
-                + "<tr>" \
-                + "<th rowspan=\"2\">Project</th>" \
-                + "<th colspan=\"2\">DSS groups</th>" \
-                + "<th colspan=\"5\">GDPR fields</th>" \
-                + "<th colspan=\"4\">Dataset counts</th>" \
-                + "<th colspan=\"2\">Model counts</th>" \
-                + "</tr>" \
-                + "<tr>" \
-                + "<th>Read</th>" \
-                + "<th>Write</th>" \
-                + "<th>Forbid DS sharing</th>" \
-                + "<th>Forbid DS export</th>" \
-                + "<th>Forbid model creation</th>" \
-                + "<th>Forbid uploaded datasets</th>" \
-                + "<th>Forbidden connections</th>" \
-                + "<th>Pers. data</th>" \
-                + "<th>Unsure</th>" \
-                + "<th>No pers. data</th>" \
-                + "<th>Total</th>" \
-                + "<th>Pers. data or unsure</th>" \
-                + "<th>Total</th>" \
-                + "</tr>" \
-                + "</thead><tbody>"
+                self._write_part(report, exporter, checkpoint, errors, progress, "projects", project_key,
+                                 lambda: render_part("projects", project_key))
+            write_projects_footer(report)
 
+        if plan.include_all_objects:
+            progress.start_phase("all objects")
+            write_all_objects_header(report)
             for project_key in project_key_list:
-                # project
-                project = self.client.get_project(project_key)
-                project_metadata = project.get_metadata()
-
-                html_ret += "<tr>" \
-                    + "<td>" + project_metadata.get("label", project_key) + " (" + project_key + ")" + "</td>"
-
-                # permissions
-                permissions = project.get_permissions()
-                read_grps = []
-                write_grps = []
-                for perm in permissions.get("permissions", []):
-                    if "group" in perm:
-                        if perm.get("writeProjectContent", False):
-                            write_grps.append(perm.get("group", ""))
-                            read_grps.append(perm.get("group", ""))
-                            continue
-                        if perm.get("readProjectContent", False):
-                            read_grps.append(perm.get("group", ""))
-
-                html_ret += "<td>"
-                if len(read_grps) > 0:
-                    html_ret += "<pre>" + "\n".join(read_grps) + "</pre>"
-                html_ret += "</td>" \
-                    + "<td>"
-                if len(write_grps) > 0:
-                    html_ret += "<pre>" + "\n".join(write_grps) + "</pre>"
-                html_ret += "</td>"
-
-                # custom fields
-                html_ret += "<td>" + str(project_metadata.get("customFields", {}).get("gdpr_forbid_dataset_sharing", False)) + "</td>" \
-                    + "<td>" + str(project_metadata.get("customFields", {}).get("gdpr_forbid_dataset_export", False)) + "</td>" \
-                    + "<td>" + str(project_metadata.get("customFields", {}).get("gdpr_forbid_model_creation", False)) + "</td>" \
-                    + "<td>" + str(project_metadata.get("customFields", {}).get("gdpr_forbid_uploaded_datasets", False)) + "</td>" \
-                    + "<td>"
-
-                allowed_connections = project_metadata.get("customFields", {}).get("gdpr_forbidden_connections", [])
-                if len(allowed_connections) > 0:
-                    html_ret += "<pre>" + "\n".join(allowed_connections) + "</pre>"
-                html_ret += "</td>"
-
-                # dataset counts
-                ds_yes = 0
-                ds_unsure = 0
-                ds_no = 0
-                ds_total = 0
-                for dataset_name in [ds["name"] for ds in project.list_datasets()]:
-                    ds_total += 1
-                    dataset = project.get_dataset(dataset_name)
-                    dataset_definition = dataset.get_definition()
-                    has_pers_data = dataset_definition.get("customFields", {}).get("gdpr_contains_personal_data", "UNSURE")
-                    if has_pers_data == "YES":
-                        ds_yes += 1
-                    elif has_pers_data == "UNSURE":
-                        ds_unsure += 1
-                    elif has_pers_data == "NO":
-                        ds_no += 1
-                html_ret += "<td>" + str(ds_yes) + "</td>" \
-                    + "<td>" + str(ds_unsure) + "</td>" \
-                    + "<td>" + str(ds_no) + "</td>" \
-                    + "<td>" + str(ds_total) + "</td>"
-
-                # model counts
-                ml_tasks = project.list_ml_tasks().get("mlTasks", [])
-                count_mlt_total = 0
-                count_mlt_pers_data = 0
-                for ml_task in ml_tasks:
-                    count_mlt_total += 1
-                    ml_ds_smartname = ml_task.get("inputDataset", "")
-                    if len(ml_ds_smartname) > 0:
-                        ml_pkey = project_key if not "." in ml_ds_smartname else ml_ds_smartname.split(".")[0]
-                        ml_input_ds = ml_ds_smartname if not "." in ml_ds_smartname else ml_ds_smartname.split(".")[1]
-                        ml_dataset = self.client.get_project(ml_pkey).get_dataset(ml_input_ds)
-                        ml_dataset_definition = ml_dataset.get_definition()
-                        ml_ds_has_pers_data = ml_dataset_definition.get("customFields", {}).get("gdpr_contains_personal_data", "UNSURE")
-                        if ml_ds_has_pers_data != "NO":
-                            count_mlt_pers_data += 1
-                html_ret += "<td>" + str(count_mlt_pers_data) + "</td>" \
-                    + "<td>" + str(count_mlt_total) + "</td>" \
-                    + "</tr>"
-
-            html_ret += "</tbody></table>"
-            progress += callback_progression
-            progress_callback(progress)
-
-        if include_all_objects:
-            # header
-            html_ret += "<h3>All objects</h3>"
-
+                # one page per project in the paged reports
+                report.start_page("projects/" + project_key + ".html", project_key)
+                self._write_part(report, exporter, checkpoint, errors, progress, "objects", project_key,
+                                 lambda: render_part("objects", project_key))
+                report.end_page()
+
+        if plan.include_retention:
+            progress.start_phase("retention")
+            write_retention_header(report)
             for project_key in project_key_list:
-                # project
-                project = self.client.get_project(project_key)
-                project_metadata = project.get_metadata()
-                project_settings = project.get_settings().settings
-                project_exposed_objects = project_settings.get("exposedObjects", {}).get("objects", [])
-
-                # project header
-                html_ret += "<h4>Project " + project_metadata.get("label", project_key) + " (" + project_key + ")" + "</h4>"
-
-                # dataset
-                html_ret += "<h5>Datasets</h5>" \
-                    + "<table><thead>" \
-                    + "<tr>" \
-                    + "<th rowspan=\"2\">Dataset</td>" \
-                    + "<th rowspan=\"2\">Is source?</td>" \
-                    + "<th colspan=\"4\">Columns</th>" \
-                    + "<th rowspan=\"2\">Creation date</th>" \
-                    + "<th rowspan=\"2\">Last build date</th>" \
-                    + "<th rowspan=\"2\">Projects shared with</th>" \
-                    + "<th rowspan=\"2\">Description</th>" \
-                    + "<th colspan=\"4\">GDPR fields</th>" \
-                    + "</tr>" \
-                    + "<tr>" \
-                    + "<th>Name</th>" \
-                    + "<th>Type</th>" \
-                    + "<th>Comment</th>" \
-                    + "<th>Meaning</th>" \
-                    + "<th>Contains pers. data</th>" \
-                    + "<th>Purposes</th>" \
-                    + "<th>Retention policy</th>" \
-                    + "<th>Legal consent</th>" \
-                    + "</tr>" \
-                    + "</thead><tbody>"
-
-                for dataset_name in [ds["name"] for ds in project.list_datasets()]:
-                    dataset = project.get_dataset(dataset_name)
-                    dataset_definition = dataset.get_definition()
-                    dataset_metadata = dataset.get_metadata()
-                    dataset_metrics = dataset.get_last_metric_values()
-                    dataset_columns = dataset_definition.get("schema", {}).get("columns", [])
-                    dataset_usages = dataset.get_usages()
-                    dataset_is_source = len([item for item in dataset_usages if item.get("type", "") == "RECIPE_OUTPUT"]) == 0
-
-                    # get the number of columns for the rowspan layout
-                    dataset_col_nb = len(dataset_columns)
-                    dataset_rowspan_html = " rowspan=\"" + str(dataset_col_nb) + "\"" if dataset_col_nb > 1 else ""
-
-                    html_ret += "<tr>" \
-                        + "<td" + dataset_rowspan_html + ">" + dataset_name + "</td>" \
-                        + "<td" + dataset_rowspan_html + ">" + ("YES" if dataset_is_source else "") + "</td>"
-
-                    if dataset_col_nb > 0:
-                        column = dataset_columns[0]
-                        html_ret += "<td>" + column.get("name", "") + "</td>" \
-                            + "<td>" + column.get("type", "") + "</td>" \
-                            + "<td>" + column.get("comment", "") + "</td>" \
-                            + "<td>" + column.get("meaning", "") + "</td>"
-                    else:
-                        html_ret += "<td></td>" \
-                            + "<td></td>" \
-                            + "<td></td>" \
-                            + "<td></td>"
-
-                    ds_creation_date = dataset_definition.get("creationTag", {}).get("lastModifiedOn", 0) / 1000
-                    date_str = datetime.utcfromtimestamp(ds_creation_date).strftime('%Y-%m-%d %H:%M:%S') if ds_creation_date > 0 else ""
-                    html_ret += "<td" + dataset_rowspan_html + ">" + date_str + "</td>" \
-                        + "<td" + dataset_rowspan_html + ">"
-                    if "reporting:BUILD_START_DATE" in dataset_metrics.get_all_ids():
-                        max_timestamp = 0
-                        for val in dataset_metrics.get_metric_by_id("reporting:BUILD_START_DATE").get("lastValues", []):
-                            timestamp = calendar.timegm(dateutil.parser.parse(val.get("value", "")).timetuple())
-                            if timestamp > max_timestamp:
-                                max_timestamp = timestamp
-                        if max_timestamp > 0:
-                            html_ret += datetime.utcfromtimestamp(max_timestamp).strftime('%Y-%m-%d %H:%M:%S')
-                    html_ret += "</td>"
-
-                    project_shared = []
-                    for obj in project_exposed_objects:
-                        if obj.get("type", "") == "DATASET" and obj.get("localName", "") == dataset_name:
-                            for rule in obj.get("rules", []):
-                                target_prj = rule.get("targetProject", "")
-                                if target_prj != "":
-                                    project_shared.append(target_prj)
-                    html_ret += "<td" + dataset_rowspan_html + ">"
-                    if len(project_shared) > 0:
-                        html_ret += "<pre>" + "\n".join(project_shared) + "</pre>"
-                    html_ret += "</td>" \
-                        + "<td" + dataset_rowspan_html + ">" + dataset_metadata.get("description", "") + "</td>" \
-                        + "<td" + dataset_rowspan_html + ">" + dataset_definition.get("customFields", {}).get("gdpr_contains_personal_data", "UNSURE") + "</td>" \
-                        + "<td" + dataset_rowspan_html + ">" + dataset_definition.get("customFields", {}).get("gdpr_purposes", "") + "</td>" \
-                        + "<td" + dataset_rowspan_html + ">" + dataset_definition.get("customFields", {}).get("gdpr_retention_policy", "") + "</td>" \
-                        + "<td" + dataset_rowspan_html + ">" + dataset_definition.get("customFields", {}).get("gdpr_legal_consent", "") + "</td>" \
-                        + "</tr>"
-
-                    if dataset_col_nb > 1:
-                        for i in range(1, dataset_col_nb):
-                            column = dataset_columns[i]
-                            html_ret += "<tr>" \
-                                + "<td>" + column.get("name", "") + "</td>" \
-                                + "<td>" + column.get("type", "") + "</td>" \
-                                + "<td>" + column.get("comment", "") + "</td>" \
-                                + "<td>" + column.get("meaning", "") + "</td>" \
-                                + "</tr>"
-
-                html_ret += "</tbody></table>"
-
-                # analyses
-                html_ret += "<h5>Analysis</h5>" \
-                    + "<table><thead>" \
-                    + "<tr>" \
-                    + "<th rowspan=\"2\">ID</th>" \
-                    + "<th rowspan=\"2\">Name</th>" \
-                    + "<th rowspan=\"2\">Creation date</th>" \
-                    + "<th rowspan=\"2\">Dataset</th>" \
-                    + "<th colspan=\"3\">Models</th>" \
-                    + "</tr>" \
-                    + "<tr>" \
-                    + "<th>Type</th>" \
-                    + "<th>Features</th>" \
-                    + "<th>Last train date</th>" \
-                    + "</tr>" \
-                    + "</thead><tobdy>"
-
-                for analysis_info in project.list_analyses():
-                    analysis_id = analysis_info.get("analysisId", "")
-                    analysis = project.get_analysis(analysis_id)
-                    analysis_definition = analysis.get_definition().get_raw()
-                    analysis_ml_tasks = analysis.list_ml_tasks().get("mlTasks", [])
-
-                    # get the number of ml tasks
-                    analysis_ml_tasks_nb = len(analysis_ml_tasks)
-                    analysis_rowspan_html = " rowspan=\"" + str(analysis_ml_tasks_nb) + "\"" if analysis_ml_tasks_nb > 1 else ""
-
-                    html_ret += "<tr>" \
-                        + "<td" + analysis_rowspan_html + ">" + analysis_definition.get("id", "") + "</td>" \
-                        + "<td" + analysis_rowspan_html + ">" + analysis_definition.get("name", "") + "</td>"
-
-                    analysis_creation_date = analysis_definition.get("creationTag", {}).get("lastModifiedOn", 0) / 1000
-                    date_str = datetime.utcfromtimestamp(analysis_creation_date).strftime('%Y-%m-%d %H:%M:%S') if analysis_creation_date > 0 else ""
-                    html_ret += "<td" + analysis_rowspan_html + ">" + date_str + "</td>" \
-                        + "<td" + analysis_rowspan_html + ">" + analysis_definition.get("inputDatasetSmartName", "") + "</td>"
-
-                    if analysis_ml_tasks_nb > 0:
-                        analysis_ml_task = analysis_ml_tasks[0]
-                        ml_task = project.get_ml_task(analysis_id, analysis_ml_task.get("mlTaskId", ""))
-                        ml_task_settings = ml_task.get_settings().get_raw()
-
-                        ml_task_type = ml_task_settings.get("taskType", "")
-                        ml_task_sub_type = (": " + ml_task_settings.get("predictionType", "")) if ml_task_type == "PREDICTION" else ""
-                        html_ret += "<td>" + ml_task_type + ml_task_sub_type + "</td>" \
-                            + "<td>"
-
-                        features = []
-                        for feat_name, feat_info in ml_task_settings.get("preprocessing", {}).get("per_feature", {}).items():
-                            feat_role = feat_info.get("role", "REJECT")
-                            if feat_role == "REJECT":
-                                continue
-                            features.append(feat_name + ((" (" + feat_role + ")") if feat_role != "INPUT" else ""))
-                        if len(features) > 0:
-                            html_ret += "<pre>" + "\n".join(features) + "</pre>"
-                        html_ret += "</td>" \
-                            + "<td>"
-
-                        max_train_date = 0
-                        for trained_model_id in ml_task.get_trained_models_ids():
-                            trained_model = ml_task.get_trained_model_details(trained_model_id)
-                            train_date = trained_model.get_train_info().get("startTime", 0) / 1000
-                            if train_date > max_train_date:
-                                max_train_date = train_date
-                        if max_train_date > 0:
-                            html_ret += datetime.utcfromtimestamp(max_train_date).strftime('%Y-%m-%d %H:%M:%S')
-                        html_ret += "</td>"
-                    else:
-                        html_ret += "<td></td>" \
-                            + "<td></td>" \
-                            + "<td></td>"
-
-                    html_ret += "</tr>"
-
-                    if analysis_ml_tasks_nb > 1:
-                        for i in range(1, analysis_ml_tasks_nb):
-                            analysis_ml_task = analysis_ml_tasks[i]
-                            ml_task = project.get_ml_task(analysis_id, analysis_ml_task.get("mlTaskId", ""))
-                            ml_task_settings = ml_task.get_settings().get_raw()
-
-                            ml_task_type = ml_task_settings.get("taskType", "")
-                            ml_task_sub_type = (": " + ml_task_settings.get("predictionType", "")) if ml_task_type == "PREDICTION" else ""
-                            html_ret += "<td>" + ml_task_type + ml_task_sub_type + "</td>" \
-                                + "<td>"
-
-                            features = []
-                            for feat_name, feat_info in ml_task_settings.get("preprocessing", {}).get("per_feature", {}).items():
-                                feat_role = feat_info.get("role", "REJECT")
-                                if feat_role == "REJECT":
-                                    continue
-                                features.append(feat_name + ((" (" + feat_role + ")") if feat_role != "INPUT" else ""))
-                            if len(features) > 0:
-                                html_ret += "<pre>" + "\n".join(features) + "</pre>"
-                            html_ret += "</td>" \
-                                + "<td>"
-
-                            max_train_date = 0
-                            for trained_model_id in ml_task.get_trained_models_ids():
-                                trained_model = ml_task.get_trained_model_details(trained_model_id)
-                                train_date = trained_model.get_train_info().get("startTime", 0) / 1000
-                                if train_date > max_train_date:
-                                    max_train_date = train_date
-                            if max_train_date > 0:
-                                html_ret += datetime.utcfromtimestamp(max_train_date).strftime('%Y-%m-%d %H:%M:%S')
-                            html_ret += "</td>" \
-                                + "</tr>"
-
-                html_ret += "</tbody></table>"
-
-                # saved models
-                html_ret += "<h5>Saved models</h5>" \
-                    + "<table><thead>" \
-                    + "<tr>" \
-                    + "<th>Name</th>" \
-                    + "<th>Type</th>" \
-                    + "<th>Features</th>" \
-                    + "<th>Original analysis ID</th>" \
-                    + "<th>Train date</th>" \
-                    + "</tr>" \
-                    + "</thead><tobdy>"
-
-                for saved_model_info in project.list_saved_models():
-                    saved_model_id = saved_model_info.get("id", "")
-                    saved_model_name = saved_model_info.get("name", "")
-                    saved_model_type = saved_model_info.get("type", "")
-                    saved_model = project.get_saved_model(saved_model_id)
-
-                    saved_model_version_info = saved_model.get_active_version()
-                    saved_model_version_train_date = saved_model_version_info.get("trainDate", 0) / 1000
-                    saved_model_version_id = saved_model_version_info.get("id", "")
-                    saved_model_version = saved_model.get_version_details(saved_model_version_id).details
-                    saved_model_sub_type = (": " + saved_model_version.get("coreParams", {}).get("prediction_type", "")) if saved_model_type == "PREDICTION" else ""
-
-                    html_ret += "<tr>" \
-                        + "<td>" + saved_model_name + "</td>" \
-                        + "<td>" + saved_model_type + saved_model_sub_type + "</td>" \
-                        + "<td>"
-
-                    features = []
-                    for feat_name, feat_info in saved_model_version.get("preprocessing", {}).get("per_feature", {}).items():
-                        feat_role = feat_info.get("role", "REJECT")
-                        if feat_role == "REJECT":
-                            continue
-                        features.append(feat_name + ((" (" + feat_role + ")") if feat_role != "INPUT" else ""))
-                    if len(features) > 0:
-                        html_ret += "<pre>" + "\n".join(features) + "</pre>"
-                    html_ret += "</td>" \
-                        + "<td>"
-
-                    full_model_id = saved_model_version.get("smOrigin", {}).get("fullModelId", "")
-                    if full_model_id != "":
-                        full_model_id_parts = full_model_id.split("-")
-                        if len(full_model_id_parts) > 2:
-                            html_ret += full_model_id_parts[2]
-
-                    html_ret += "</td>" \
-                        + "<td>"
-                    if saved_model_version_train_date > 0:
-                        html_ret += datetime.utcfromtimestamp(saved_model_version_train_date).strftime('%Y-%m-%d %H:%M:%S')
-                    html_ret += "</td>" \
-                        + "</tr>"
-
-                html_ret += "</tbody></table>"
-
-        html_ret += "</body></html>"
-        return html_ret
+                report.start_page("retention/" + project_key + ".html", project_key)
+                self._write_part(report, exporter, checkpoint, errors, progress, "retention", project_key,
+                                 lambda: render_part("retention", project_key))
+                report.end_page()
+
+        if plan.include_lineage:
+            progress.start_phase("lineage")
+            self._write_part(report, exporter, checkpoint, errors, progress, "lineage", INSTANCE_KEY,
+                             lambda: render_part("lineage", INSTANCE_KEY))
+
+        # a snapshot missing some projects is never served
+        progress.start_phase("finalize")
+        if len(errors) == 0:
+            snapshot = report.commit(project_key_list)
+            snapshots.prune()
+            if changes_only:
+                self._write_changes(summary_report, exporter, previous_snapshots[0] if len(previous_snapshots) > 0 else None, snapshot)
+        else:
+            report.discard()
+            if changes_only:
+                summary_report.write("<p><b>The changes are not reported, some projects could not be audited.</b></p>")
+        summary_report.write(report.get_summary_html())
+        report = summary_report
+
+        if cache is not None:
+            # the projects replayed from the checkpoint were not looked up
+            cache.purge(audited_project_keys)
+            report.write(cache.get_summary_html())
+        report.write(exporter.get_summary_html())
+        report.write(errors.get_summary_html())
+        # failed projects are retried by the next resumed run
+        if len(errors) == 0:
+            checkpoint.clear()
+            shards.clear()
+
+    def _run_shard(self, progress, client, fetcher, report, shards):
+        """
+        Audits the projects of one shard into its partial result, with what the
+        instance-wide parts read of them. The report only summarizes it.
+        """
+        progress.start_phase("listing")
+        project_key_list = ProjectScope(self.config, self.project_key).resolve(client)
+        shard_project_keys = shards.get_project_keys(project_key_list)
+        inventory = InstanceInventory(client, fetcher)
+        plan = AuditPlan(self.config)
+        errors = ProjectErrors()
+        part_renderer = self._get_part_renderer(client, inventory, plan, project_key_list, errors)
+
+        def render_part(section, project_key):
+            if section == FLOW_SECTION:
+                return "", get_project_flow(inventory, project_key, plan.include_lineage)
+            return part_renderer(section, project_key)
+
+        # the instance-wide parts are rendered by the merge, from the flows of the shards
+        parts = self._get_parts(plan, shard_project_keys, False)
+        if plan.include_connections or plan.include_lineage:
+            parts.extend([(FLOW_SECTION, project_key) for project_key in shard_project_keys])
+        self._prefetch(progress, inventory, plan, shard_project_keys, parts, project_key_list)
+
+        writer = shards.open_writer(get_run_fingerprint(self.config, project_key_list), project_key_list)
+        current_section = None
+        for section, project_key in parts:
+            if section != current_section:
+                progress.start_phase(section)
+                current_section = section
+            error_count = len(errors)
+            try:
+                html, records = render_part(section, project_key)
+            except Exception as e:
+                writer.write_error(section, project_key, e, errors.errors[error_count:])
+                errors.add(section, project_key, e)
+            else:
+                writer.write_part(section, project_key, html, records, errors.errors[error_count:])
+            progress.complete_part(section, project_key)
+        writer.commit()
+
+        report.write(HTML_HEADER)
+        report.write(writer.get_summary_html())
+        report.write(errors.get_summary_html())
+
+    def _prefetch(self, progress, inventory, plan, project_keys, parts, project_key_list):
+        """
+        Fans out the calls shared by the given parts. The progress is sized in
+        between, from the listings: the objects of the parts, and the datasets
+        prefetched.
+        """
+        progress.start_phase("prefetch")
+        plan.prefetch_projects(inventory, project_keys)
+        for section, project_key in parts:
+            progress.add_part(section, project_key, plan.count_objects(inventory, section, project_key, project_key_list))
+        progress.add_part("prefetch", INSTANCE_KEY, sum([count_listed(inventory.list_dataset_names, key) for key in project_keys]))
+        plan.prefetch_datasets(inventory, project_keys, lambda objects: progress.advance_part("prefetch", INSTANCE_KEY, objects))
+        progress.complete_part("prefetch", INSTANCE_KEY)
+
+    def _get_parts(self, plan, project_key_list, instance_parts=True):
+        """
+        (section, project key) of the parts of the report, in order
+        """
+        parts = []
+        if plan.include_connections and instance_parts:
+            parts.append(("connections", INSTANCE_KEY))
+        for section in plan.get_project_sections():
+            parts.extend([(section, project_key) for project_key in project_key_list])
+        if plan.include_lineage and instance_parts:
+            parts.append(("lineage", INSTANCE_KEY))
+        return parts
+
+    def _get_part_renderer(self, client, inventory, plan, project_key_list, errors):
+        """
+        Renders the part of a section about one project from the instance, as
+        (HTML, records per table)
+        """
+        classifier = get_schema_classifier(self.config)
+        ml_inventory = MLInventory(inventory, classifier)
+        retention_checker = get_retention_checker(inventory, self.config)
+
+        def render_part(section, project_key):
+            if section == "connections":
+                return self._render_connections(client, inventory, project_key_list, errors)
+            if section == "projects":
+                return self._render_project_row(inventory, ml_inventory, project_key)
+            if section == "objects":
+                return self._render_project_objects(inventory, ml_inventory, plan, classifier, project_key)
+            if section == "retention":
+                return self._render_project_retention(inventory, retention_checker, project_key)
+            return self._render_lineage(inventory, project_key_list, errors)
+        return render_part
+
+    def _get_merged_part_renderer(self, client, reader, project_key_list, errors):
+        """
+        Reads the parts of the projects from the results of the shards, and
+        renders the instance-wide parts from the flows they wrote
+        """
+        flows = ShardFlows(reader)
+
+        def render_part(section, project_key):
+            if section == "connections":
+                return self._render_connections(client, flows, project_key_list, errors)
+            if section == "lineage":
+                return self._render_lineage(flows, project_key_list, errors)
+            return reader.load(section, project_key, errors)
+        return render_part
+
+    def _serve_snapshot(self, report, exporter, snapshot):
+        report.write(HTML_HEADER)
+        report.write(snapshot.get_age_html())
+        for entry in snapshot.iter_entries():
+            if "html" in entry:
+                report.write(entry["html"])
+            elif "page" in entry:
+                report.start_page(entry["page"], entry["title"])
+            elif "endPage" in entry:
+                report.end_page()
+            else:
+                report.write_records(entry["section"], entry["projectKey"], entry["records"])
+                for table in EXPORTED_TABLES:
+                    if table in entry["records"]:
+                        exporter.write(table, entry["records"][table])
+        report.write(exporter.get_summary_html())
+
+    def _write_changes(self, report, exporter, old_snapshot, new_snapshot):
+        if old_snapshot is None:
+            report.write(new_snapshot.get_age_html())
+            report.write("<p>No previous snapshot to compare with yet.</p>")
+            return
+        change_records = build_change_records(old_snapshot, new_snapshot)
+        write_changes_section(report, change_records, old_snapshot.get_created_on(), new_snapshot.get_created_on())
+        exporter.write("changes", change_records)
+
+    def _write_part(self, report, exporter, checkpoint, errors, progress, section, project_key, render):
+        """
+        Writes the part of a section about one project, replayed from the
+        checkpoint or rendered then checkpointed. A failure only skips the part.
+        The report records the parts into the snapshot being taken.
+        """
+        if checkpoint.is_done(section, project_key):
+            html, records = checkpoint.load(section, project_key)
+        else:
+            error_count = len(errors)
+            try:
+                html, records = render()
+            except Exception as e:
+                errors.add(section, project_key, e)
+                error_html = errors.get_error_html(section, project_key, e)
+                # keep the projects table well-formed
+                report.write(("<tr><td colspan=\"14\">" + error_html + "</td></tr>") if section == "projects" else error_html)
+                progress.complete_part(section, project_key)
+                return
+            # parts missing some projects are redone by the next run
+            if len(errors) == error_count:
+                checkpoint.save(section, project_key, html, records)
+        report.write(html)
+        report.write_records(section, project_key, records)
+        for table in EXPORTED_TABLES:
+            if table in records:
+                exporter.write(table, records[table])
+        progress.complete_part(section, project_key)
+
+    def _render_connections(self, client, inventory, project_key_list, errors):
+        # projects whose datasets cannot be read are reported, without the connection usage
+        readable_project_keys = []
+        for project_key in project_key_list:
+            try:
+                list(inventory.iter_dataset_summaries(project_key))
+                readable_project_keys.append(project_key)
+            except Exception as e:
+                errors.add("connections", project_key, e)
+        connection_records = build_connection_records(client.list_connections(), inventory, readable_project_keys)
+        fragment = HTMLFragment()
+        write_connections_section(fragment, connection_records)
+        return fragment.get_html(), {"connections": connection_records}
+
+    def _render_lineage(self, inventory, project_key_list, errors):
+        lineage_records = build_lineage_records(inventory, project_key_list,
+                                                lambda project_key, e: errors.add("lineage", project_key, e))
+        fragment = HTMLFragment()
+        write_lineage_section(fragment, lineage_records)
+        return fragment.get_html(), {"lineage": lineage_records}
+
+    def _render_project_row(self, inventory, ml_inventory, project_key):
+        project_record = build_project_record(inventory, project_key, ml_inventory)
+        fragment = HTMLFragment()
+        write_project_row(fragment, project_record)
+        return fragment.get_html(), {"projects": [project_record]}
+
+    def _render_project_retention(self, inventory, retention_checker, project_key):
+        retention_records = build_retention_records(inventory, project_key, retention_checker)
+        fragment = HTMLFragment()
+        write_retention_table(fragment, inventory.get_project_label(project_key), project_key, retention_records)
+        return fragment.get_html(), {"retention": retention_records}
+
+    def _render_project_objects(self, inventory, ml_inventory, plan, classifier, project_key):
+        fragment = HTMLFragment()
+        records = {}
+        write_project_objects_header(fragment, inventory.get_project_label(project_key), project_key)
+
+        if plan.include_datasets:
+            records["datasets"] = build_dataset_records(inventory, project_key, plan.dataset_columns, classifier)
+            write_datasets_table(fragment, records["datasets"], plan.dataset_columns)
+
+        if plan.include_analyses:
+            records["analyses"] = build_analysis_records(inventory, project_key, plan.analysis_columns, ml_inventory)
+            write_analyses_table(fragment, records["analyses"], plan.analysis_columns)
+
+        if plan.include_saved_models:
+            records["saved_models"] = build_saved_model_records(inventory, project_key, plan.saved_model_columns, ml_inventory)
+            write_saved_models_table(fragment, records["saved_models"], plan.saved_model_columns)
+        return fragment.get_html(), records
@@ -5,6 +5,20 @@
 #
 from dataiku.runnables import Runnable
 import dataiku
+import logging
+from gdpr.checkpoint import ProjectErrors
+from gdpr.classifier import format_matched_column, get_schema_classifier
+from gdpr.crawler import ParallelFetcher, get_max_concurrent_requests
+from gdpr.instrumentation import ApiProfiler, InstrumentedClient
+from gdpr.inventory import InstanceInventory
+from gdpr.lineage import build_lineage_records
+from gdpr.progress import ProgressTracker, count_listed
+from gdpr.report import HTML_HEADER, ReportOutput
+from gdpr.scanner import DEFAULT_SAMPLE_ROWS, format_detections, get_scanned_columns, scan_dataset
+from gdpr.scope import ProjectScope
+from gdpr.throttling import get_request_throttle
+
+logger = logging.getLogger(__name__)
 
 class GDPRDSCheckUpRunnable(Runnable):
     def __init__(self, project_key, config, plugin_config):
@@ -17,53 +31,132 @@ class GDPRDSCheckUpRunnable(Runnable):
         return (100, 'NONE')
 
     def run(self, progress_callback):
-        if self.config.get('allProjects', False):
-            project_key_list = [prj['projectKey'] for prj in self.client.list_projects()]
-        else:
-            project_key_list = [self.project_key]
+        include_profile = self.config.get('includeProfile', False)
+        profiler = ApiProfiler(estimate_payloads=include_profile)
+        throttle = get_request_throttle(self.config)
+        progress = ProgressTracker(progress_callback, profiler)
+        errors = ProjectErrors()
+        with InstrumentedClient(self.client, profiler, throttle) as client, \
+                ParallelFetcher(get_max_concurrent_requests(self.config)) as fetcher, \
+                ReportOutput(self.project_key, self.config, "gdpr-ds-check-up") as output:
+            self._run(progress, client, fetcher, output.report, errors)
+            progress.finish()
+            profiler.log_summary("gdpr-ds-check-up")
+            throttle.log_summary("gdpr-ds-check-up")
+            progress.log_summary("gdpr-ds-check-up")
+            output.report.write(errors.get_summary_html())
+            output.report.write(throttle.get_summary_html())
+            output.report.write(progress.get_summary_html())
+            if include_profile:
+                output.report.write(profiler.get_summary_html())
+            return output.finalize()
+
+    def _run(self, progress, client, fetcher, report, errors):
+        progress.start_phase("listing")
+        project_key_list = ProjectScope(self.config, self.project_key).resolve(client)
+        inventory = InstanceInventory(client, fetcher)
+        # one listing call per project, definitions only for the datasets it lacks fields of
+        from_listing = self.config.get('readFromListing', True)
+        progress.start_phase("prefetch")
+        inventory.prefetch_projects(project_key_list)
+
+        # progress in objects: the datasets prefetched, then each project and its
+        # datasets, counted from the listings
+        dataset_counts = [count_listed(inventory.list_dataset_names, project_key) for project_key in project_key_list]
+        progress.add_part("prefetch", None, sum(dataset_counts))
+        if self.config.get('checkLineage', False):
+            progress.add_part("lineage", None, len(project_key_list) + sum(dataset_counts))
+        for project_key, dataset_count in zip(project_key_list, dataset_counts):
+            progress.add_part("datasets", project_key, 1 + dataset_count)
+        inventory.prefetch_datasets(project_key_list, from_listing=from_listing,
+                                    on_progress=lambda objects: progress.advance_part("prefetch", None, objects))
+        progress.complete_part("prefetch", None)
+
+        # datasets derived from personal data, grouped by project
+        lineage_mismatches = {}
+        if self.config.get('checkLineage', False):
+            progress.start_phase("lineage")
+            # a project that cannot be read is listed with the errors, not fatal
+            on_error = lambda project_key, e: errors.add("lineage", project_key, e)
+            for record in build_lineage_records(inventory, project_key_list, on_error, from_listing):
+                lineage_mismatches.setdefault(record["project_key"], []).append(record)
+            progress.complete_part("lineage", None)
+        progress.start_phase("datasets")
+
+        classifier = get_schema_classifier(self.config)
+        scan_unsure = self.config.get('scanUnsure', False)
+        scan_sample_rows = int(self.config.get('scanSampleRows', DEFAULT_SAMPLE_ROWS))
 
-        callback_progression = (100 / len(project_key_list)) if len(project_key_list) > 0 else 100
-        progress = 0;
-        progress_callback(progress)
-        html_ret = "<html><head><style>" \
-            + "h3 { margin-top: 1em; } " \
-            + "table { border-collapse: collapse; } " \
-            + "thead { font-weight: bold; } " \
-            + "table, th, td { border: 1px solid black; }" \
-            + "</style></head><body>"
+        report.write(HTML_HEADER)
 
         for project_key in project_key_list:
             # header
-            project = self.client.get_project(project_key)
-            project_metadata = project.get_metadata()
-            html_ret += "<h3>Project " + project_metadata.get("label", project_key) + "</h3>"
+            project_metadata = inventory.get_project_metadata(project_key)
+            report.write("<h3>Project ", project_metadata.get("label", project_key), "</h3>")
 
             # datasets
-            html_ret += "<table><thead>" \
-                + "<tr>" \
-                + "<th>Dataset</th>" \
-                + "<th>Contains personal data</th>" \
-                + "<th>Purpose</th>" \
-                + "<th>Retention policy</th>" \
-                + "<th>Legal consent</th>" \
-                + "</tr>" \
-                + "</thead><tbody>"
-            for dataset_name in [ds["name"] for ds in project.list_datasets()]:
-                dataset = project.get_dataset(dataset_name)
-                dataset_definition = dataset.get_definition()
-                if self.config.get('onlyUnsure', True) and dataset_definition.get("customFields", {}).get("gdpr_contains_personal_data", "UNSURE") != "UNSURE":
-                    continue
-                html_ret += "<tr>" \
-                    + "<td>" + dataset_name + "</td>" \
-                    + "<td>" + dataset_definition.get("customFields", {}).get("gdpr_contains_personal_data", "UNSURE") + "</td>" \
-                    + "<td>" + dataset_definition.get("customFields", {}).get("gdpr_purposes", "") + "</td>" \
-                    + "<td>" + dataset_definition.get("customFields", {}).get("gdpr_retention_policy", "") + "</td>" \
-                    + "<td>" + dataset_definition.get("customFields", {}).get("gdpr_legal_consent", "") + "</td>" \
-                    + "</tr>"
-            html_ret += "</tbody></table>"
+            dataset_items = [(dataset_name, dataset) for dataset_name, dataset in inventory.iter_dataset_summaries(project_key, from_listing)
+                             if not (self.config.get('onlyUnsure', True) and dataset.contains_personal_data != "UNSURE")]
+            if scan_unsure:
+                # sample the data of the datasets left to decide
+                def scan(item):
+                    dataset_name, dataset = item
+                    if dataset.contains_personal_data != "UNSURE":
+                        return None
+                    try:
+                        return format_detections(scan_dataset(project_key, dataset_name, get_scanned_columns(dataset), scan_sample_rows))
+                    except Exception as e:
+                        logger.exception("Failed to scan dataset %s.%s", project_key, dataset_name)
+                        return ["Scan failed: " + str(e)]
+                dataset_detections = fetcher.map(scan, dataset_items)
+            report.write("<table><thead>",
+                "<tr>",
+                "<th>Dataset</th>",
+                "<th>Contains personal data</th>",
+                "<th>Purpose</th>",
+                "<th>Retention policy</th>",
+                "<th>Legal consent</th>",
+                "<th>Suggested from schema</th>")
+            if scan_unsure:
+                report.write("<th>Detected in sample</th>")
+            report.write("</tr>",
+                "</thead><tbody>")
+            for index, (dataset_name, dataset) in enumerate(dataset_items):
+                report.write("<tr>",
+                    "<td>", dataset_name, "</td>",
+                    "<td>", dataset.contains_personal_data, "</td>",
+                    "<td>", dataset.purposes, "</td>",
+                    "<td>", dataset.retention_policy, "</td>",
+                    "<td>", dataset.legal_consent, "</td>")
+                suggestion, matched_columns = classifier.classify(dataset)
+                report.write("<td>", suggestion)
+                if len(matched_columns) > 0:
+                    report.write("<pre>", "\n".join([format_matched_column(matched_column) for matched_column in matched_columns]), "</pre>")
+                report.write("</td>")
+                if scan_unsure:
+                    report.write("<td>")
+                    if dataset_detections[index] is not None and len(dataset_detections[index]) > 0:
+                        report.write("<pre>", "\n".join(dataset_detections[index]), "</pre>")
+                    report.write("</td>")
+                report.write("</tr>")
+            report.write("</tbody></table>")
 
-            progress += callback_progression
-            progress_callback(progress)
+            # lineage
+            if len(lineage_mismatches.get(project_key, [])) > 0:
+                report.write("<p>Datasets derived from datasets with personal data, but not declared so:</p>",
+                    "<table><thead>",
+                    "<tr>",
+                    "<th>Dataset</th>",
+                    "<th>Contains personal data</th>",
+                    "<th>Derived from</th>",
+                    "</tr>",
+                    "</thead><tbody>")
+                for record in lineage_mismatches[project_key]:
+                    report.write("<tr>",
+                        "<td>", record["dataset"], "</td>",
+                        "<td>", record["declared"], "</td>",
+                        "<td>", record["origin"], "</td>",
+                        "</tr>")
+                report.write("</tbody></table>")
 
-        html_ret += "</body></html>"
-        return html_ret
+            progress.complete_part("datasets", project_key)